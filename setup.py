@@ -48,7 +48,7 @@ SFFTK_CLASSIFIERS = [
 ]
 SFFTK_PYTHON3_INSTALL_REQUIRES = [
     "sfftk-rw>=0.8.1", "numpy", "ahds", "styled", "mrcfile", "bitarray", "requests",
-    "mock", "numpy-stl", "gemmi",
+    "mock", "numpy-stl", "gemmi", "scipy",
 ]
 
 if sys.version_info[1] == 5:
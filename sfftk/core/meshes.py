@@ -0,0 +1,343 @@
+"""
+``sfftk.core.meshes``
+==========================
+
+This module consists of utilities to condition triangle meshes (vertex arrays and triangle arrays referring to rows
+of the vertex array) during conversion of mesh-based segmentations.
+"""
+import numpy
+
+from .utils import pool_size
+
+__author__ = 'Paul K. Korir, PhD'
+__email__ = 'pkorir@ebi.ac.uk, paul.korir@gmail.com'
+__date__ = '2026-10-17'
+
+
+def _cell_pairs(order, starts, counts, cells_a, cells_b):
+    """All pairs of vertices with one vertex in each of the given pairs of cells
+
+    :param order: vertex indices sorted by cell
+    :param starts: the offset of each cell in ``order``
+    :param counts: the number of vertices in each cell
+    :param cells_a: the first cell of each pair of cells
+    :param cells_b: the second cell of each pair of cells
+    :return: two arrays of vertex indices
+    :rtype: tuple
+    """
+    count_a, count_b = counts[cells_a], counts[cells_b]
+    pair_counts = count_a * count_b
+    cell_pair = numpy.repeat(numpy.arange(len(cells_a)), pair_counts)
+    # the index of each vertex pair within its pair of cells
+    k = numpy.arange(pair_counts.sum()) - numpy.repeat(numpy.cumsum(pair_counts) - pair_counts, pair_counts)
+    vertices_a = order[starts[cells_a][cell_pair] + k // count_b[cell_pair]]
+    vertices_b = order[starts[cells_b][cell_pair] + k % count_b[cell_pair]]
+    return vertices_a, vertices_b
+
+
+def weld_vertices(vertices, triangles, tolerance):
+    """Merge vertices that are within ``tolerance`` of each other
+
+    Vertices are hashed into a grid of cubic cells of side ``tolerance`` (the quantised coordinates are the keys) so
+    that any two vertices to be merged lie in the same or in neighbouring cells. We compare the pairs of vertices in
+    each cell and in each of its 13 'forward' neighbours (the other 13 are covered by symmetry) and merge every
+    connected group of close vertices into one vertex at their mean. Triangles which collapse (two or more corners
+    merged) are dropped together with vertices no longer referred to.
+
+    The tolerance should be small compared with the edges of the mesh i.e. a cell should hold only a handful of
+    vertices.
+
+    :param vertices: ``float32`` vertices (``shape = (N, 3)``)
+    :type vertices: :py:class:`numpy.ndarray`
+    :param triangles: triangles (``shape = (M, 3)``) referring to rows of ``vertices``
+    :type triangles: :py:class:`numpy.ndarray`
+    :param float tolerance: the largest distance between merged vertices
+    :return: the welded vertices and triangles (``uint32``)
+    :rtype: tuple
+    """
+    from scipy import sparse
+    from scipy.sparse import csgraph
+    vertices = numpy.asarray(vertices, dtype=numpy.float32)
+    triangles = numpy.asarray(triangles)
+    if len(vertices) == 0:
+        return vertices, triangles.astype(numpy.uint32)
+    keys = numpy.floor(vertices / tolerance).astype(numpy.int64)
+    # each row as an opaque 24 byte key: sorting and searching agree and the coordinates may be of any magnitude
+    key_dtype = numpy.dtype((numpy.void, keys.dtype.itemsize * 3))
+    cell_keys, cell_of_vertex, counts = numpy.unique(
+        keys.view(key_dtype).ravel(), return_inverse=True, return_counts=True
+    )
+    order = numpy.argsort(cell_of_vertex, kind='stable')
+    starts = numpy.cumsum(counts) - counts
+    cell_coords = cell_keys.view(numpy.int64).reshape(-1, 3)
+    cells = numpy.arange(len(cell_keys))
+    pairs_a, pairs_b = list(), list()
+    for offset in numpy.ndindex(3, 3, 3):
+        offset = numpy.array(offset) - 1
+        if tuple(offset) < (0, 0, 0):  # the backward half
+            continue
+        if not offset.any():
+            cells_a = cells_b = cells[counts > 1]
+        else:
+            neighbours = numpy.ascontiguousarray(cell_coords + offset).view(key_dtype).ravel()
+            found = numpy.minimum(numpy.searchsorted(cell_keys, neighbours), len(cell_keys) - 1)
+            exists = cell_keys[found] == neighbours
+            cells_a, cells_b = cells[exists], found[exists]
+        vertices_a, vertices_b = _cell_pairs(order, starts, counts, cells_a, cells_b)
+        if not offset.any():
+            distinct = vertices_a < vertices_b
+            vertices_a, vertices_b = vertices_a[distinct], vertices_b[distinct]
+        close = numpy.sum((vertices[vertices_a] - vertices[vertices_b]) ** 2, axis=1) <= tolerance ** 2
+        pairs_a.append(vertices_a[close])
+        pairs_b.append(vertices_b[close])
+    pairs_a, pairs_b = numpy.concatenate(pairs_a), numpy.concatenate(pairs_b)
+    graph = sparse.coo_matrix(
+        (numpy.ones(len(pairs_a), dtype=numpy.int8), (pairs_a, pairs_b)), shape=(len(vertices), len(vertices))
+    )
+    # labels are in order of first vertex
+    group_count, groups = csgraph.connected_components(graph, directed=False)
+    group_sizes = numpy.bincount(groups, minlength=group_count)
+    welded_vertices = numpy.stack([
+        numpy.bincount(groups, weights=vertices[:, axis], minlength=group_count) / group_sizes for axis in range(3)
+    ], axis=1).astype(numpy.float32)
+    welded_triangles = groups[triangles]
+    collapsed = (welded_triangles[:, 0] == welded_triangles[:, 1]) | \
+                (welded_triangles[:, 1] == welded_triangles[:, 2]) | \
+                (welded_triangles[:, 0] == welded_triangles[:, 2])
+    welded_triangles = welded_triangles[~collapsed]
+    # drop vertices only referred to by collapsed triangles
+    used, welded_triangles = numpy.unique(welded_triangles, return_inverse=True)
+    return (
+        numpy.ascontiguousarray(welded_vertices[used]),
+        welded_triangles.reshape(-1, 3).astype(numpy.uint32)
+    )
+
+
+#: the weight of the planes through boundary edges (relative to the triangle planes) which keep open boundaries in place
+BOUNDARY_WEIGHT = 1000.0
+
+
+def _edges(triangles, vertex_count):
+    """The distinct edges of the triangles
+
+    :return: the edges (``shape = (E, 2)``, lower vertex first), the number of triangles of each edge and a
+        triangle of each edge
+    :rtype: tuple
+    """
+    half_edges = triangles[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2).astype(numpy.int64)
+    half_edges.sort(axis=1)
+    # vertex counts fit in 32 bits so the pair fits in one 64 bit key
+    keys, first, counts = numpy.unique(
+        half_edges[:, 0] * vertex_count + half_edges[:, 1], return_index=True, return_counts=True
+    )
+    edges = numpy.stack([keys // vertex_count, keys % vertex_count], axis=1)
+    return edges, counts, first // 3
+
+
+def _vertex_quadrics(vertices, triangles):
+    """The error quadric of each vertex
+
+    Each triangle contributes the (area weighted) quadric of its plane to its three vertices and each boundary edge
+    contributes the quadric of the plane through it perpendicular to its triangle to its two vertices.
+
+    :return: quadrics with ``shape = (N, 4, 4)``
+    :rtype: :py:class:`numpy.ndarray`
+    """
+    corners = vertices[triangles]
+    normals = numpy.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    double_areas = numpy.linalg.norm(normals, axis=1)
+    normals /= numpy.where(double_areas > 0, double_areas, 1)[:, numpy.newaxis]
+    planes = numpy.concatenate([normals, -numpy.sum(normals * corners[:, 0], axis=1)[:, numpy.newaxis]], axis=1)
+    face_quadrics = 0.5 * double_areas[:, numpy.newaxis, numpy.newaxis] * \
+        planes[:, :, numpy.newaxis] * planes[:, numpy.newaxis, :]
+    quadrics = numpy.zeros((len(vertices), 4, 4))
+    for corner in range(3):
+        numpy.add.at(quadrics, triangles[:, corner], face_quadrics)
+    edges, counts, edge_triangles = _edges(triangles, len(vertices))
+    boundary = counts == 1
+    if numpy.any(boundary):
+        edges, edge_triangles = edges[boundary], edge_triangles[boundary]
+        directions = vertices[edges[:, 1]] - vertices[edges[:, 0]]
+        perpendiculars = numpy.cross(directions, normals[edge_triangles])
+        lengths = numpy.linalg.norm(perpendiculars, axis=1)
+        perpendiculars /= numpy.where(lengths > 0, lengths, 1)[:, numpy.newaxis]
+        planes = numpy.concatenate([
+            perpendiculars, -numpy.sum(perpendiculars * vertices[edges[:, 0]], axis=1)[:, numpy.newaxis]
+        ], axis=1)
+        edge_quadrics = BOUNDARY_WEIGHT * numpy.sum(directions ** 2, axis=1)[:, numpy.newaxis, numpy.newaxis] * \
+            planes[:, :, numpy.newaxis] * planes[:, numpy.newaxis, :]
+        for end in range(2):
+            numpy.add.at(quadrics, edges[:, end], edge_quadrics)
+    return quadrics
+
+
+def _collapse_costs(vertices, quadrics, edges):
+    """The position minimising the error of collapsing each edge and the error
+
+    We solve for the optimal position relative to the midpoint of the edge with the pseudo-inverse so that flat or
+    straight neighbourhoods (singular quadrics) give the point nearest the midpoint.
+
+    :return: positions (``shape = (E, 3)``) and costs (``shape = (E,)``)
+    :rtype: tuple
+    """
+    edge_quadrics = quadrics[edges[:, 0]] + quadrics[edges[:, 1]]
+    midpoints = 0.5 * (vertices[edges[:, 0]] + vertices[edges[:, 1]])
+    residuals = numpy.einsum('eij,ej->ei', edge_quadrics[:, :3, :3], midpoints) + edge_quadrics[:, :3, 3]
+    positions = midpoints - numpy.einsum(
+        'eij,ej->ei', numpy.linalg.pinv(edge_quadrics[:, :3, :3], rcond=1e-6), residuals
+    )
+    # far-flung optima of ill-conditioned quadrics fall back to the midpoint
+    edge_lengths = numpy.linalg.norm(vertices[edges[:, 1]] - vertices[edges[:, 0]], axis=1)
+    far = numpy.linalg.norm(positions - midpoints, axis=1) > edge_lengths
+    positions[far] = midpoints[far]
+    homogeneous = numpy.concatenate([positions, numpy.ones((len(positions), 1))], axis=1)
+    costs = numpy.einsum('ei,eij,ej->e', homogeneous, edge_quadrics, homogeneous)
+    return positions, numpy.maximum(costs, 0)
+
+
+def _collapse(vertices, triangles, edges, positions):
+    """Collapse each edge onto its position
+
+    Edges must not share vertices. Collapses which would flip a triangle are rejected.
+
+    :return: the new vertices and triangles and the number of collapses
+    :rtype: tuple
+    """
+    collapse_of_vertex = numpy.full(len(vertices), -1)
+    accepted = numpy.ones(len(edges), dtype=bool)
+    old_corners = vertices[triangles]
+    old_normals = numpy.cross(old_corners[:, 1] - old_corners[:, 0], old_corners[:, 2] - old_corners[:, 0])
+    while True:
+        collapse_of_vertex[:] = -1
+        collapse_of_vertex[edges[accepted, 0]] = numpy.flatnonzero(accepted)
+        collapse_of_vertex[edges[accepted, 1]] = numpy.flatnonzero(accepted)
+        new_vertices = vertices.copy()
+        new_vertices[edges[accepted, 0]] = positions[accepted]
+        remap = numpy.arange(len(vertices))
+        remap[edges[accepted, 1]] = edges[accepted, 0]
+        new_triangles = remap[triangles]
+        degenerate = (new_triangles[:, 0] == new_triangles[:, 1]) | (new_triangles[:, 1] == new_triangles[:, 2]) | \
+                     (new_triangles[:, 0] == new_triangles[:, 2])
+        new_corners = new_vertices[new_triangles]
+        new_normals = numpy.cross(new_corners[:, 1] - new_corners[:, 0], new_corners[:, 2] - new_corners[:, 0])
+        flipped = ~degenerate & (numpy.sum(old_normals * new_normals, axis=1) <= 0)
+        rejected = numpy.unique(collapse_of_vertex[triangles[flipped]])
+        rejected = rejected[rejected >= 0]
+        if len(rejected) == 0:
+            break
+        accepted[rejected] = False
+    new_triangles = new_triangles[~degenerate]
+    # collapsing can leave two copies of a triangle
+    _, distinct = numpy.unique(numpy.sort(new_triangles, axis=1), axis=0, return_index=True)
+    return new_vertices, new_triangles[numpy.sort(distinct)], int(accepted.sum())
+
+
+def decimate_mesh(vertices, triangles, target):
+    """Simplify the mesh to at most ``target`` triangles by quadric error edge collapses
+
+    This is a batched version of Garland and Heckbert's algorithm: rather than collapsing the cheapest edge one at a
+    time we collapse, in each pass, every edge which is the cheapest edge of both its vertices (such edges never
+    share a vertex) up to the number of collapses still needed, then recompute the quadrics. Open boundaries are held
+    in place by heavily weighted planes through the boundary edges.
+
+    :param vertices: vertices (``shape = (N, 3)``)
+    :type vertices: :py:class:`numpy.ndarray`
+    :param triangles: triangles (``shape = (M, 3)``) referring to rows of ``vertices``
+    :type triangles: :py:class:`numpy.ndarray`
+    :param int target: the largest number of triangles to keep
+    :return: the simplified vertices (``float32``) and triangles (``uint32``); the simplification stops early if no
+        edge can be collapsed without flipping a triangle
+    :rtype: tuple
+    """
+    vertices = numpy.asarray(vertices, dtype=numpy.float64)
+    triangles = numpy.asarray(triangles, dtype=numpy.int64)
+    random = numpy.random.default_rng(0)  # reproducible
+    while len(triangles) > target:
+        quadrics = _vertex_quadrics(vertices, triangles)
+        edges, _, _ = _edges(triangles, len(vertices))
+        positions, costs = _collapse_costs(vertices, quadrics, edges)
+        # the rank of each edge by cost and the cheapest rank at each vertex; ties (e.g. flat regions cost nothing)
+        # are broken at random otherwise the edges which are cheapest at both ends would be few
+        ranks = numpy.empty(len(edges), dtype=numpy.int64)
+        ranks[numpy.lexsort((random.random(len(edges)), costs))] = numpy.arange(len(edges))
+        cheapest = numpy.full(len(vertices), len(edges))
+        numpy.minimum.at(cheapest, edges[:, 0], ranks)
+        numpy.minimum.at(cheapest, edges[:, 1], ranks)
+        candidates = numpy.flatnonzero((ranks == cheapest[edges[:, 0]]) & (ranks == cheapest[edges[:, 1]]))
+        # each interior collapse removes two triangles
+        needed = (len(triangles) - target + 1) // 2
+        candidates = candidates[numpy.argsort(ranks[candidates])][:needed]
+        vertices, triangles, collapses = _collapse(vertices, triangles, edges[candidates], positions[candidates])
+        if collapses == 0:
+            break
+    used, triangles = numpy.unique(triangles, return_inverse=True)
+    return vertices[used].astype(numpy.float32), triangles.reshape(-1, 3).astype(numpy.uint32)
+
+
+def vertex_normals(vertices, triangles):
+    """Unit normals at the vertices as the area weighted mean of the normals of their triangles
+
+    :return: normals (``shape = (N, 3)``)
+    :rtype: :py:class:`numpy.ndarray`
+    """
+    corners = vertices[triangles].astype(numpy.float64)
+    # the cross product has a length of twice the area
+    face_normals = numpy.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    normals = numpy.zeros((len(vertices), 3))
+    for corner in range(3):
+        numpy.add.at(normals, triangles[:, corner], face_normals)
+    lengths = numpy.linalg.norm(normals, axis=1)
+    return (normals / numpy.where(lengths > 0, lengths, 1)[:, numpy.newaxis]).astype(numpy.float32)
+
+
+def _decimate_mesh_task(vertices, triangles, target, normals):
+    """Decimate one mesh in a worker process
+
+    :return: the simplified vertices and triangles and their normals if ``normals`` is true
+    :rtype: tuple
+    """
+    vertices, triangles = decimate_mesh(vertices, triangles, target)
+    return vertices, triangles, vertex_normals(vertices, triangles) if normals else None
+
+
+def decimate_segmentation(segmentation, decimate, jobs=None, verbose=False):
+    """Decimate every mesh of the segmentation in place
+
+    Meshes are decimated in a pool of processes (see :py:func:`decimate_mesh`). Meshes with normals get new normals
+    computed from the simplified triangles.
+
+    :param segmentation: a converted segmentation
+    :type segmentation: :py:class:`sfftkrw.SFFSegmentation`
+    :param decimate: the fraction of triangles to keep if less than one otherwise the number of triangles to keep per
+        mesh
+    :type decimate: float or int
+    :param int jobs: the number of processes [default: the number of CPUs (limited by the available memory)]
+    :param bool verbose: report the triangles before and after
+    """
+    import concurrent.futures
+
+    import sfftkrw.schema.adapter_v0_8_0_dev1 as schema
+    from sfftkrw.core.print_tools import print_date
+    meshes = [
+        mesh for segment in segmentation.segment_list if segment.mesh_list is not None for mesh in segment.mesh_list
+    ]
+    if not meshes:
+        return
+    tasks = list()
+    for mesh in meshes:
+        triangles = mesh.triangles.data_array
+        target = max(1, int(round(len(triangles) * decimate))) if decimate < 1 else int(decimate)
+        tasks.append((mesh.vertices.data_array, triangles, target, mesh.normals is not None))
+    # the quadrics and costs take about a kilobyte per triangle
+    workers = pool_size(len(tasks), 1024 * max(len(task[1]) for task in tasks)) if jobs is None else jobs
+    before = sum(len(task[1]) for task in tasks)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(_decimate_mesh_task, *zip(*tasks))
+        for mesh, (vertices, triangles, normals) in zip(meshes, results):
+            mesh.vertices = schema.SFFVertices.from_array(vertices, mode=mesh.vertices.mode)
+            mesh.triangles = schema.SFFTriangles.from_array(triangles, mode=mesh.triangles.mode)
+            if normals is not None:
+                mesh.normals = schema.SFFNormals.from_array(normals, mode=mesh.normals.mode)
+    if verbose:
+        after = sum(mesh.triangles.num_triangles for mesh in meshes)
+        print_date(f"Decimated {len(meshes)} mesh(es) from {before} to {after} triangles using {workers} worker(s)")
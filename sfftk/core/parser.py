@@ -31,7 +31,10 @@ __updated__ = '2018-02-14'
 VERBOSITY_RANGE = _xrange(4)
 MULTI_FILE_FORMATS = ['stl', 'map', 'mrc', 'rec', 'star']
 PREPABLE_FILE_FORMATS = ['mrc', 'map', 'rec']
-RESCALABLE_FILE_FORMATS = ['stl']
+RESCALABLE_FILE_FORMATS = ['stl', 'map', 'mrc', 'rec']
+WELDABLE_FILE_FORMATS = ['stl', 'surf']
+DECIMATABLE_FILE_FORMATS = ['stl', 'surf', 'mod']
+ROI_FILE_FORMATS = ['map', 'mrc', 'rec', 'h5', 'seg']
 # some file extensions are used by multiple file types
 # this dictionary lists indices that may be used for subtypes by extension
 # each value of each extension is a tuple of a friendly name and the FQN for the corresponding class
@@ -270,6 +273,43 @@ binmap_prep_parser.add_argument(
     type=float,
     help='value (exclusive) about which to threshold [default: 0.0]'
 )
+binmap_prep_parser.add_argument(
+    '-C', '--contour-levels',
+    nargs='+',
+    type=float,
+    help='several increasing contour levels for a labelled mask instead of a binary mask; voxels above (exclusive) '
+         'the k-th level (but not the next) have label k and all others are zero; overrides -c/--contour-level and '
+         '-m/--mask-value'
+)
+binmap_prep_parser.add_argument(
+    '--components',
+    action='store_true',
+    help="label each connected component of the binarised map instead of setting the mask value; the labels are "
+         "described in a JSON file (<output>.json) so that the output can be converted like a merged mask "
+         "[default: False]"
+)
+binmap_prep_parser.add_argument(
+    '--connectivity',
+    default=1,
+    type=int,
+    choices=[1, 2, 3],
+    help="with --components, voxels up to this many steps apart (1: faces, 2: edges, 3: corners) are connected "
+         "[default: 1]"
+)
+binmap_prep_parser.add_argument(
+    '--bin-factor',
+    default=None,
+    type=int,
+    help="downsample (instead of binarise) the map by this factor in each dimension e.g. to make a preview; each "
+         "block of factor^3 voxels becomes one voxel (see --pooling) [default: None]"
+)
+binmap_prep_parser.add_argument(
+    '--pooling',
+    default=None,
+    choices=['mean', 'max', 'majority'],
+    help="with --bin-factor, how to combine each block of voxels: 'mean' for densities, 'max' or 'majority' (the most "
+         "common value) for masks [default: 'mean' for floating point maps otherwise 'majority']"
+)
 binmap_prep_parser.add_argument(
     '--negate',
     default=False,
@@ -283,6 +323,13 @@ binmap_prep_parser.add_argument(
     choices=[1, 2, 4, 8, 16],
     help='number of bytes per voxel [default: 1]'
 )
+binmap_prep_parser.add_argument(
+    '-j', '--jobs',
+    default=None,
+    type=int,
+    help="the number of threads to binarise with; each thread binarises a different slab of sections "
+         "[default: the number of CPUs (limited by the available memory)]"
+)
 binmap_prep_parser.add_argument(
     '--infix',
     default='prep',
@@ -301,7 +348,7 @@ transform_prep_parser = prep_subparsers.add_parser(
 # todo: add a new option for the voxel coordinates e.g. --voxel-size <v_x> <v_y> <v_z> which is
 #  mutually exclusive with --lengths and --indices
 transform_prep_parser.add_argument(
-    'from_file', help="the name of the segmentation file"
+    'from_file', nargs='+', help="the name of the segmentation file; several STL files may be transformed at once"
 )
 add_args(transform_prep_parser, config_path)
 add_args(transform_prep_parser, shipped_configs)
@@ -330,6 +377,19 @@ transform_prep_parser.add_argument(
     default=None,
     help='output file name [default: <infile>_transformed.<ext>]'
 )
+transform_prep_parser.add_argument(
+    '-j', '--jobs',
+    default=None,
+    type=int,
+    help="the number of processes used to transform several STL files or the slabs of a map [default: "
+         "the number of CPUs (limited by the available memory)]"
+)
+transform_prep_parser.add_argument(
+    '--overwrite',
+    default=False,
+    action='store_true',
+    help="overwrite an existing output map [default: False]"
+)
 transform_prep_parser.add_argument(
     '--infix',
     default='transformed',
@@ -374,6 +434,46 @@ mergemask_prep_parser.add_argument(
     action='store_true',
     help="use this option to avoid the lengthy task of assessing the masks to make sure they are binary [default: False]"
 )
+mergemask_prep_parser.add_argument(
+    '--sample-sections',
+    default=16,
+    type=int,
+    help="the number of randomly chosen sections of each mask to assess; masks with no more sections are assessed "
+         "in full [default: 16]"
+)
+mergemask_prep_parser.add_argument(
+    '--full-assessment',
+    action='store_true',
+    help="after assessing the sampled sections verify every voxel of each mask before merging so that every "
+         "non-binary mask is reported; this reads each mask an extra time because merging verifies every voxel "
+         "anyway but stops at the first non-binary mask [default: False]"
+)
+mergemask_prep_parser.add_argument(
+    '--out-of-core',
+    action='store_true',
+    help="merge directly into a memory-mapped output file instead of holding the merged mask in memory; use this for "
+         "volumes larger than the available memory [default: False]"
+)
+mergemask_prep_parser.add_argument(
+    '--slab-size',
+    default=128,
+    type=int,
+    help="the maximum size (in MiB) of each slab of sections read from a mask or the merged mask; this bounds the "
+         "memory used when merging [default: 128]"
+)
+mergemask_prep_parser.add_argument(
+    '-j', '--jobs',
+    default=1,
+    type=int,
+    help="the number of processes to merge with; each process merges a different slab of sections [default: 1]"
+)
+mergemask_prep_parser.add_argument(
+    '--bit-planes',
+    action='store_true',
+    help="record which masks each voxel belongs to as bit-planes (one bit per mask) then label each distinct "
+         "combination of masks; mask N has label N and overlaps have the following labels; use this for many "
+         "(overlapping) masks [default: False]"
+)
 mergemask_prep_parser.add_argument(
     '--allow-overlap',
     action='store_true',
@@ -381,6 +481,48 @@ mergemask_prep_parser.add_argument(
          "label_tree [default: False]"
 )
 # =========================================================================
+# prep: splitmask
+# =========================================================================
+splitmask_prep_parser = prep_subparsers.add_parser(
+    'splitmask',
+    description='Split a merged mask back into the binary masks it was merged from',
+    help='split a merged mask into binary masks',
+)
+add_args(splitmask_prep_parser, config_path)
+add_args(splitmask_prep_parser, shipped_configs)
+add_args(splitmask_prep_parser, verbose)
+splitmask_prep_parser.add_argument(
+    'merged_mask',
+    help="a merged mask produced by 'sff prep mergemask' e.g. merged_mask.mrc"
+)
+splitmask_prep_parser.add_argument(
+    '--label-tree',
+    default=None,
+    help="the JSON file with the label tree and the mask names [default: the merged mask with a .json extension]"
+)
+splitmask_prep_parser.add_argument(
+    '-d', '--output-directory',
+    default='.',
+    help="the directory to write the binary masks to; each mask has the name it had when merged [default: '.']"
+)
+splitmask_prep_parser.add_argument(
+    '--overwrite',
+    action='store_true',
+    help="if the output already exists overwrite it [default: False]"
+)
+splitmask_prep_parser.add_argument(
+    '--slab-size',
+    default=128,
+    type=int,
+    help="the maximum size (in MiB) of each slab of sections read from the merged mask [default: 128]"
+)
+splitmask_prep_parser.add_argument(
+    '-j', '--jobs',
+    default=None,
+    type=int,
+    help="the number of threads writing masks [default: the number of CPUs (limited by the available memory)]"
+)
+# =========================================================================
 # prep: starsplit
 # =========================================================================
 starsplit_prep_parser = prep_subparsers.add_parser(
@@ -501,6 +643,58 @@ multi_or_label_mutex_parser.add_argument(
 #     '--subtomogram-average',
 #     help="the result of subtomogram averaging in CCP4 format (.mrc, .map, .rec)"
 # )
+convert_parser.add_argument(
+    '--roi',
+    default=None,
+    help="only convert the region of interest 'z0:z1,y0:y1,x0:x1' (sections, rows, cols) of a volume segmentation; "
+         "omitted bounds extend to the edge e.g. ':,10:50,' [default: None i.e. the whole volume]; only works for the "
+         "following filetypes: {}".format(', '.join(ROI_FILE_FORMATS))
+)
+convert_parser.add_argument(
+    '--components',
+    action='store_true',
+    help="make each connected component of a binary mask (.map, .mrc, .rec) a segment of its own [default: False]"
+)
+convert_parser.add_argument(
+    '--connectivity',
+    default=1,
+    type=int,
+    choices=[1, 2, 3],
+    help="with --components, voxels up to this many steps apart (1: faces, 2: edges, 3: corners) are connected "
+         "[default: 1]"
+)
+convert_parser.add_argument(
+    '--weld-tolerance',
+    default=None,
+    type=float,
+    help=(
+        "merge mesh vertices closer than this distance e.g. repeated vertices differing by float noise; only works "
+        "for the following filetypes: {} [default: None i.e. only identical vertices are merged]"
+    ).format(
+        ', '.join(WELDABLE_FILE_FORMATS),
+    )
+)
+convert_parser.add_argument(
+    '--decimate',
+    default=None,
+    metavar='RATIO|TRIANGLES',
+    help="simplify each mesh to this fraction (less than 1) or number of its triangles; only works for the following "
+         "filetypes: {} [default: None i.e. full resolution]".format(', '.join(DECIMATABLE_FILE_FORMATS))
+)
+convert_parser.add_argument(
+    '--lods',
+    default=0,
+    type=int,
+    help="with --decimate, also write this many further levels of detail each with half the triangles of the "
+         "previous level to <output>_lod<level>.<ext> [default: 0]"
+)
+convert_parser.add_argument(
+    '-j', '--jobs',
+    default=None,
+    type=int,
+    help="the number of processes used to decimate meshes [default: the number of CPUs (limited by the available "
+         "memory)]"
+)
 convert_parser.add_argument(
     '--subtomogram-average',
     help="the result of subtomogram averaging or a particle mask for visualisation in CCP4 format (.mrc, .map, .rec)"
@@ -1149,6 +1343,65 @@ def check_multi_file_formats(file_names):
     return is_valid_format, file_format, invalid_formats
 
 
+def _parse_roi(roi, shape=None):
+    """Parse a region of interest of the form 'z0:z1,y0:y1,x0:x1'
+
+    Any bound may be omitted in which case the range extends to the edge of the volume.
+
+    :param str roi: the region of interest
+    :param tuple shape: an optional shape (sections, rows, cols) of the volume the region must lie in
+    :return: a triple of slices for sections, rows and cols
+    :rtype: tuple[slice, slice, slice]
+    :raises ValueError: if the region of interest is malformed, empty or outside the volume
+    """
+    ranges = roi.split(',')
+    if len(ranges) != 3:
+        raise ValueError("expected three ranges (z0:z1,y0:y1,x0:x1) but got {}".format(len(ranges)))
+    region = list()
+    for _range in ranges:
+        if _range.strip() == '':
+            region.append(slice(None))
+            continue
+        match = re.match(r"^\s*(\d*)\s*:\s*(\d*)\s*$", _range)
+        if not match:
+            raise ValueError("invalid range '{}'".format(_range))
+        start, stop = (int(bound) if bound else None for bound in match.groups())
+        if start is not None and stop is not None and stop <= start:
+            raise ValueError("empty range '{}'".format(_range))
+        region.append(slice(start, stop))
+    if shape is not None:
+        for _range, _slice, length in zip(ranges, region, shape):
+            if len(range(*_slice.indices(length))) == 0:
+                raise ValueError("range '{}' lies outside the volume of shape {}".format(_range, tuple(shape)))
+    return tuple(region)
+
+
+def _roi_volume_shape(fn, subtype_index=-1):
+    """The shape (sections, rows, cols) of the volume in a file that supports regions of interest
+
+    Only the header (or the HDF5 dataset description) is read.
+
+    :param str fn: the file name
+    :param int subtype_index: the subtype index for ambiguous extensions (see ``EXTENSION_SUBTYPE_INDICES``)
+    :return: the shape or ``None`` if it cannot be determined
+    :rtype: tuple
+    """
+    ext = _get_file_extension(fn).lower()
+    if ext in ['map', 'mrc', 'rec']:
+        from ..readers.mapreader import Map
+        this_map = Map(fn, header_only=True)
+        return this_map._ns, this_map._nr, this_map._nc
+    import h5py
+    with h5py.File(fn, 'r') as h:
+        if ext == 'seg':
+            return h['mask'].shape
+        elif ext == 'h5' and subtype_index == 0:  # SuRVoS
+            return h['/data'].shape
+        elif ext == 'h5' and subtype_index == 1:  # ilastik (zyxc)
+            return h['exported_data'].shape[:3]
+    return None
+
+
 def _set_subtype_index(args, ext):
     """Set the --subtype-index argument value
 
@@ -1390,6 +1643,29 @@ def parse_args(_args, use_shlex=False):
             if ext.lower() not in PREPABLE_FILE_FORMATS:
                 print_date("File format {} not available for prepping".format(ext.lower()))
                 return 64, configs
+            if args.jobs is not None and args.jobs < 1:
+                print_date(f"error: --jobs must be at least 1 ({args.jobs} provided)")
+                return 64, configs
+            if args.bin_factor is not None:
+                if args.bin_factor < 2:
+                    print_date(f"error: --bin-factor must be at least 2 ({args.bin_factor} provided)")
+                    return 64, configs
+                if args.components or args.contour_levels is not None:
+                    print_date("error: --bin-factor cannot be used with --components or -C/--contour-levels")
+                    return 64, configs
+            elif args.pooling is not None:
+                print_date("error: --pooling only applies with --bin-factor")
+                return 64, configs
+            if args.contour_levels is not None:
+                if any(lower >= upper for lower, upper in zip(args.contour_levels, args.contour_levels[1:])):
+                    print_date(f"error: contour levels must be increasing ({args.contour_levels} provided)")
+                    return 64, configs
+                if args.negate:
+                    print_date("error: --negate cannot be used with -C/--contour-levels")
+                    return 64, configs
+                if args.components:
+                    print_date("error: --components cannot be used with -C/--contour-levels")
+                    return 64, configs
             if args.output is None:
                 if args.infix != '':
                     args.output = '.'.join(args.from_file.split('.')[:-1]) + '_' + args.infix + '.' + ext
@@ -1400,25 +1676,42 @@ def parse_args(_args, use_shlex=False):
                     print_date("Output will be written to {}".format(args.output))
         # transform
         elif args.prep_subcommand == 'transform':
-            ext = args.from_file.split('.')[-1]
-            if ext.lower() not in RESCALABLE_FILE_FORMATS:
-                print_date("File format {} not available for transforming".format(ext.lower()))
+            for from_file in args.from_file:
+                ext = from_file.split('.')[-1]
+                if ext.lower() not in RESCALABLE_FILE_FORMATS:
+                    print_date("File format {} not available for transforming".format(ext.lower()))
+                    return 64, configs
+            if args.jobs is not None and args.jobs < 1:
+                print_date(f"error: --jobs must be at least 1 ({args.jobs} provided)")
+                return 64, configs
+            if len(args.from_file) > 1 and args.output is not None:
+                print_date("Cannot set -o/--output for several files; use --infix instead")
                 return 64, configs
             if args.output is None:
                 if args.infix != '':
-                    args.output = '.'.join(args.from_file.split('.')[:-1]) + '_' + args.infix + '.' + ext
+                    args.output = [
+                        '.'.join(from_file.split('.')[:-1]) + '_' + args.infix + '.' + from_file.split('.')[-1]
+                        for from_file in args.from_file
+                    ]
                 else:
                     print_date("Cannot overwrite input file")
                     return 64, configs
-                if args.verbose:
-                    print_date("Output will be written to {}".format(args.output))
+            else:
+                args.output = [args.output]
+            # a single file keeps plain strings
+            if len(args.from_file) == 1:
+                args.from_file, = args.from_file
+                args.output, = args.output
+            if args.verbose:
+                print_date("Output will be written to {}".format(args.output))
         # mergemask
         elif args.prep_subcommand == 'mergemask':
             if len(args.masks) < 2:
                 print_date("error: mergemask requires two or more masks")
                 return 64, configs
-            if len(args.masks) > 255:
-                print_date(f"error: mergemask can handle at most 255 masks ({len(args.masks)} provided)")
+            if len(args.masks) > 255 and not args.bit_planes:
+                print_date(f"error: mergemask can handle at most 255 masks ({len(args.masks)} provided); "
+                           f"use --bit-planes for more masks")
                 return 64, configs
             if not _masks_exist(args):
                 print_date("error: one or more masks missing; please verify that all paths are correct")
@@ -1433,6 +1726,32 @@ def parse_args(_args, use_shlex=False):
             if not _masks_have_mode_zero(args):
                 print_date("error: mode must be zero (0); please run `sff prep binmap` first on all masks")
                 return 65, configs
+            if args.sample_sections < 1:
+                print_date(f"error: --sample-sections must be at least 1 ({args.sample_sections} provided)")
+                return 64, configs
+            if args.slab_size < 1:
+                print_date(f"error: --slab-size must be at least 1 MiB ({args.slab_size} provided)")
+                return 64, configs
+            if args.jobs < 1:
+                print_date(f"error: --jobs must be at least 1 ({args.jobs} provided)")
+                return 64, configs
+            if args.bit_planes and args.jobs > 1:
+                print_date("error: --bit-planes cannot be used with --jobs")
+                return 64, configs
+        # splitmask
+        elif args.prep_subcommand == 'splitmask':
+            if args.label_tree is None:
+                args.label_tree = os.path.splitext(args.merged_mask)[0] + '.json'
+            for fn in (args.merged_mask, args.label_tree):
+                if not os.path.exists(fn):
+                    print_date(f"error: missing file: {fn}")
+                    return 65, configs
+            if args.slab_size < 1:
+                print_date(f"error: --slab-size must be at least 1 MiB ({args.slab_size} provided)")
+                return 64, configs
+            if args.jobs is not None and args.jobs < 1:
+                print_date(f"error: --jobs must be at least 1 ({args.jobs} provided)")
+                return 64, configs
         # starsplit
         elif args.prep_subcommand == 'starsplit':
             if args.output_prefix is None:
@@ -1487,8 +1806,8 @@ def parse_args(_args, use_shlex=False):
             # check if this is an ambiguous extension
             if ext in EXTENSION_SUBTYPE_INDICES.keys():
                 args = _set_subtype_index(args, ext)
-            # now, let's check that this file is strictly binary
-            if re.match(r".*\.(map|mrc|rec)$", args.from_file, re.IGNORECASE):
+            # now, let's check that this file is strictly binary (only the region of interest is checked below)
+            if re.match(r".*\.(map|mrc|rec)$", args.from_file, re.IGNORECASE) and args.roi is None:
                 if not check_mask_is_binary(args.from_file, verbose=args.verbose) and args.label_tree is None:
                     print_date(
                         "Error: non-binary mask; either use a binary mask or include the label "
@@ -1525,6 +1844,70 @@ def parse_args(_args, use_shlex=False):
             else:
                 print_date("Please use -m/--multi-file argument for multi-file segmentations")
                 return 64, configs
+        if args.components:
+            from_files = args.from_file if isinstance(args.from_file, list) else [args.from_file]
+            if any(_get_file_extension(fn).lower() not in ['map', 'mrc', 'rec'] for fn in from_files) or \
+                    args.label_tree is not None:
+                print_date("Invalid file type for --components: should be binary masks (.map, .mrc, .rec)")
+                return 64, configs
+        if args.weld_tolerance is not None:
+            from_files = args.from_file if isinstance(args.from_file, list) else [args.from_file]
+            if any(_get_file_extension(fn).lower() not in WELDABLE_FILE_FORMATS for fn in from_files):
+                print_date("Invalid file type for --weld-tolerance: should be only one of: {}".format(
+                    ', '.join(WELDABLE_FILE_FORMATS)))
+                return 64, configs
+            if args.weld_tolerance <= 0:
+                print_date(f"error: --weld-tolerance must be positive ({args.weld_tolerance} provided)")
+                return 64, configs
+        if args.decimate is not None:
+            from_files = args.from_file if isinstance(args.from_file, list) else [args.from_file]
+            if any(_get_file_extension(fn).lower() not in DECIMATABLE_FILE_FORMATS for fn in from_files):
+                print_date("Invalid file type for --decimate: should be only one of: {}".format(
+                    ', '.join(DECIMATABLE_FILE_FORMATS)))
+                return 64, configs
+            try:
+                decimate = float(args.decimate)
+            except ValueError:
+                print_date(f"error: --decimate should be a ratio or a number of triangles ({args.decimate} provided)")
+                return 64, configs
+            if decimate >= 1 and decimate.is_integer():
+                args.decimate = int(decimate)
+            elif 0 < decimate < 1:
+                args.decimate = decimate
+            else:
+                print_date(f"error: --decimate should be a ratio between 0 and 1 or a whole number of triangles "
+                           f"({args.decimate} provided)")
+                return 64, configs
+        if args.lods < 0 or (args.lods > 0 and args.decimate is None):
+            print_date("error: --lods should be a non-negative number used with --decimate")
+            return 64, configs
+        if args.jobs is not None and args.jobs < 1:
+            print_date(f"error: --jobs must be at least 1 ({args.jobs} provided)")
+            return 64, configs
+        # region of interest
+        if args.roi is not None:
+            from_files = args.from_file if isinstance(args.from_file, list) else [args.from_file]
+            for fn in from_files:
+                if _get_file_extension(fn).lower() not in ROI_FILE_FORMATS or (
+                        _get_file_extension(fn).lower() == 'h5' and args.subtype_index == 2):
+                    print_date("Invalid file type for --roi: {}; should be only one of: {}".format(
+                        fn, ', '.join(ROI_FILE_FORMATS)))
+                    return 64, configs
+            try:
+                args.roi = _parse_roi(args.roi, shape=_roi_volume_shape(from_files[0], args.subtype_index))
+            except ValueError as value_error:
+                print_date("Invalid value for --roi: {}".format(value_error))
+                return 64, configs
+            if not args.multi_file and re.match(r".*\.(map|mrc|rec)$", args.from_file, re.IGNORECASE):
+                if args.label_tree is None and not check_mask_is_binary(
+                        args.from_file, verbose=args.verbose, roi=args.roi):
+                    print_date(
+                        "Error: non-binary mask; either use a binary mask or include the label "
+                        "tree with --label-tree flag"
+                    )
+                    return 65, configs
+            if args.verbose:
+                print_date("Converting the region of interest {}".format(args.roi))
         # set the output file
         if args.output is None:
             if args.multi_file:
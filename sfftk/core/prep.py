@@ -5,11 +5,13 @@
 This module consists of preparation utilities to condition segmentation files prior to conversion.
 """
 import asyncio
+import concurrent.futures
+import functools
+import itertools
 import json
+import os
 import pathlib
 import re
-import sys
-from typing import List
 
 import mrcfile
 import numpy
@@ -18,7 +20,9 @@ from sfftkrw.core import _str
 from sfftkrw.core.print_tools import print_date
 from stl import Mesh
 
+from ..readers.mapreader import SLAB_BYTES
 from ..readers.starreader import RelionStarReader
+from .utils import pool_size
 
 
 def _label_generator():
@@ -158,6 +162,7 @@ class MergedMask:
         # we could use int8 but the overflow leads to negative numbers which break the flow
         # using int16 gives us a positive upper ceiling of 32k, much higher than 127 for int8
         self._label = 1  # initial label value
+        self._max_label = 0  # the largest value in the merged mask
         self._label_tree = dict()
         self._label_set = set()
         self._dtype = dtype
@@ -234,54 +239,452 @@ class MergedMask:
         # reset _mask_name
         self._mask_name = None
 
-    def _update_label(self):
-        """Update the label to the next value to use"""
+    def merge_slabs(self, slabs, mask_name=None):
+        """Merge a mask one slab of sections at a time
+
+        The merged mask must already have data of the full shape e.g. a memory-mapped output file. The slabs are
+        consecutive blocks along the first axis and only one slab is looked at any time.
+
+        .. code-block:: python
+
+            merged_mask = MergedMask(data=numpy.zeros(shape, dtype=numpy.int16))
+            for mask in masks:
+                merged_mask.merge_slabs(Map(mask, header_only=True).iter_slabs(), mask_name=mask)
+
+        :param slabs: an iterable of consecutive slabs of the mask
+        :param str mask_name: the name of the mask
+        """
+        self._mask_name = mask_name
+        self._merge_slabs(slabs)
+        self._mask_name = None
+
+    def adopt_data(self, data):
+        """Replace the merged voxels with voxels labelled elsewhere
+
+        The labels, label tree and mask names are kept so the voxels must have been labelled consistently with them
+        e.g. by summing the labels (see :py:attr:`mask_to_label`) of the masks in which each voxel is set. This is how
+        the slabs of a merged mask are labelled in parallel once the labels have been worked out.
+
+        :param data: the merged voxels
+        :type data: :py:class:`numpy.ndarray`
+        :raises ValueError: if the voxels are not of the type of the merged mask
+        """
+        if data.dtype != self._dtype:
+            raise ValueError(f"merged voxels must be of type {self._dtype} not {data.dtype}")
+        self._data = data
+
+    def _update_label(self, touched_labels):
+        """Update the label to the next value to use
+
+        Only the voxels touched by the current mask can have new labels so we never look at the rest of the merged
+        mask.
+
+        :param touched_labels: the sorted distinct labels of the voxels of the current mask after merging
+        :type touched_labels: :py:class:`numpy.ndarray`
+        """
         # first, add the current label to the label set and the label tree
         self._label_set.add(self._label)
         self._label_tree[str(self._label)] = 0  # this is a direct child of the root (0, repr. background)
         self._mask_to_label[self.mask_name] = int(self._label)
-        # get the new resulting labels: all those not already in the label set
-        new_labels = set(numpy.unique(self._data)).difference(self._label_set.union([0]))
+        # get the new resulting labels: the label is larger than all previous labels so every touched voxel is
+        # either the current label or a new label
+        new_labels = set(touched_labels.tolist()).difference([self._label])
         # determine the parentage for each new label
         for new_label in new_labels:
-            for _label in self._label_set:
-                # since we added the content of the merged mask to the new mask then any new labels are sum of
-                # current label and the label for the current mask i.e. new_label = previous_label + label;
-                # we are only interested in associating the pair to the new label; the new_label now becomes
-                # a leaf with parent nodes being the previous_label and the label for the last mask
-                # we store them sorted
-                if new_label == _label + self._label:
-                    self._label_tree[str(new_label)] = sorted([int(new_label - _label), int(new_label - self._label)])
+            # since we added the content of the merged mask to the new mask then any new labels are sum of
+            # current label and the label for the current mask i.e. new_label = previous_label + label;
+            # we are only interested in associating the pair to the new label; the new_label now becomes
+            # a leaf with parent nodes being the previous_label and the label for the last mask
+            # we store them sorted
+            previous_label = new_label - self._label
+            if previous_label in self._label_set:
+                self._label_tree[str(new_label)] = sorted([int(previous_label), int(self._label)])
         # finally, we should not forget to now include the new labels into the label set
         self._label_set |= new_labels
-        self._label = numpy.amax(self._data) + 1
+        if touched_labels.size > 0:
+            self._max_label = max(self._max_label, int(touched_labels[-1]))
+        self._label = self._max_label + 1
         self._mask_id += 1
 
-    def __add__(self, mask) -> 'MergedMask':
+    def _merge_slabs(self, slabs):
+        """Merge the current mask to the merged mask one slab at a time and label it uniquely"""
+        touched_labels = numpy.array([], dtype=self._dtype)
+        section = 0
+        for slab in slabs:
+            data = self._data[section:section + len(slab)]  # a view
+            touched = numpy.nonzero(slab)
+            data[touched] += self._label
+            touched_labels = numpy.union1d(touched_labels, data[touched])
+            section += len(slab)
+        self._update_label(touched_labels)
+
+    def _add(self, mask):
+        """Merge the current mask to the merged mask and label it uniquely"""
         self._init_data(mask)
-        self._data += mask * self._label  # merge the current mask to the merged mask and label it uniquely
-        self._update_label()
+        self._merge_slabs([mask])
         return self
 
+    def __add__(self, mask) -> 'MergedMask':
+        return self._add(mask)
+
     def __radd__(self, mask) -> 'MergedMask':
-        self._init_data(mask)
-        self._data += mask * self._label  # merge the current mask to the merged mask and label it uniquely
-        self._update_label()
-        return self
+        return self._add(mask)
 
     def __iadd__(self, mask) -> 'MergedMask':
-        self._init_data(mask)
-        self._data += mask * self._label  # merge the current mask to the merged mask and label it uniquely
-        self._update_label()
-        return self
+        return self._add(mask)
 
     def __eq__(self, other):
         return numpy.array_equal(self.data, other.data) and self.shape == other.shape and self.dtype == other.dtype
 
 
+def _label_dtype(max_label):
+    """The smallest MRC data type that holds labels up to ``max_label``"""
+    for dtype in (numpy.int16, numpy.uint16):
+        if max_label <= numpy.iinfo(dtype).max:
+            return numpy.dtype(dtype)
+    return numpy.dtype(numpy.float32)  # exact for integers up to 2 ** 24
+
+
+class BitPlaneMergedMask:
+    """A merged mask which records the membership of each voxel as bit-planes rather than as a sum of labels
+
+    Each voxel has one bit for each mask packed into ``uint64`` words so that the memory used is known in advance
+    (``8 * ceil(mask_count / 64)`` bytes per voxel) no matter how many masks overlap. Labels are only assigned once
+    all masks have been merged from the distinct bit patterns (memberships) found by a single call to
+    :py:func:`numpy.unique`:
+
+    - mask ``i`` (counting from zero) has label ``i + 1`` and is a direct child of the root (``0``);
+    - each distinct overlap of masks has the next free label and its parents are the labels of the masks that
+      overlap there.
+
+    Using the masks from :py:class:`MergedMask`:
+
+    .. code-block:: python
+
+        merged_mask = BitPlaneMergedMask(shape=(4,), mask_count=6)
+        for mask in masks:
+            merged_mask.merge(mask)
+        merged_mask.data # => [9, 7, 8, 4]
+        merged_mask.label_tree # => {'1': 0, ..., '6': 0, '7': [1, 2, 4], '8': [3, 4, 6], '9': [5, 6]}
+
+    :param tuple shape: the shape of the masks
+    :param int mask_count: the number of masks to be merged
+    """
+
+    def __init__(self, shape, mask_count, mask_name_prefix="mask_", zfill=4):
+        self._shape = tuple(shape)
+        self._mask_count = mask_count
+        self._planes = numpy.zeros(
+            (int(numpy.prod(self._shape, dtype=numpy.int64)), (mask_count + 63) // 64), dtype=numpy.dtype('<u8')
+        )
+        self._mask_index = 0
+        self._mask_to_label = dict()
+        self._label_tree = dict()
+        self._mask_name_prefix = mask_name_prefix
+        self._zfill = zfill
+        # set once labelled
+        self._memberships = None
+        self._labels = None
+        self._inverse = None
+        self._data = None
+
+    def __repr__(self):
+        return f"{self.__class__.__qualname__}(shape={self._shape}, mask_count={self._mask_count})"
+
+    def __array__(self):
+        return self.data
+
+    @property
+    def shape(self):
+        return self._shape
+
+    @property
+    def dtype(self):
+        self._label()
+        return _label_dtype(int(self._labels.max()))
+
+    @property
+    def data(self):
+        """The merged mask with the label of each voxel"""
+        if self._data is None:
+            self._data = numpy.empty(self._shape, dtype=self.dtype)
+            self.fill(self._data)
+        return self._data
+
+    @property
+    def label_tree(self):
+        self._label()
+        return self._label_tree
+
+    @property
+    def mask_to_label(self):
+        return self._mask_to_label
+
+    @property
+    def memberships(self):
+        """A boolean array with one row for each distinct membership and one column for each mask"""
+        self._label()
+        return self._memberships
+
+    def merge(self, mask: numpy.ndarray, mask_name=None):
+        """Merge the next mask"""
+        self.merge_slabs([mask], mask_name=mask_name)
+
+    def merge_slabs(self, slabs, mask_name=None):
+        """Merge the next mask one slab of sections at a time
+
+        :param slabs: an iterable of consecutive slabs of the mask
+        :param str mask_name: the name of the mask
+        """
+        if self._mask_index >= self._mask_count:
+            raise ValueError(f"cannot merge more than {self._mask_count} masks")
+        word, bit = divmod(self._mask_index, 64)
+        plane = self._planes[:, word]  # a view
+        voxel = 0
+        for slab in slabs:
+            slab = numpy.asarray(slab).reshape(-1)
+            plane[voxel:voxel + slab.size][slab != 0] |= numpy.uint64(1) << numpy.uint64(bit)
+            voxel += slab.size
+        if mask_name is None:
+            mask_name = f"{self._mask_name_prefix}{self._mask_index + 1:0>{self._zfill}}"
+        self._mask_to_label[mask_name] = self._mask_index + 1
+        self._label_tree[str(self._mask_index + 1)] = 0
+        self._mask_index += 1
+        self._memberships = None  # stale
+
+    def _label(self):
+        """Assign labels to the distinct memberships"""
+        if self._memberships is not None:
+            return
+        patterns, inverse = numpy.unique(self._planes, axis=0, return_inverse=True)
+        self._inverse = inverse.reshape(-1)
+        self._memberships = numpy.unpackbits(
+            patterns.view(numpy.uint8), axis=1, bitorder='little'
+        )[:, :self._mask_count].astype(bool)
+        mask_counts = self._memberships.sum(axis=1)
+        self._labels = numpy.zeros(len(patterns), dtype=numpy.int64)
+        single = mask_counts == 1
+        self._labels[single] = numpy.argmax(self._memberships[single], axis=1) + 1
+        overlaps = numpy.flatnonzero(mask_counts > 1)
+        self._labels[overlaps] = numpy.arange(self._mask_count + 1, self._mask_count + 1 + len(overlaps))
+        for overlap in overlaps:
+            self._label_tree[str(self._labels[overlap])] = (numpy.flatnonzero(self._memberships[overlap]) + 1).tolist()
+        self._data = None
+
+    def fill(self, data, chunk_size=2 ** 24):
+        """Write the labels into an array of the shape of the masks e.g. the data of a memory-mapped file
+
+        :param data: the C-contiguous array to write into
+        :type data: :py:class:`numpy.ndarray`
+        :param int chunk_size: the number of voxels to write at a time
+        """
+        self._label()
+        voxels = data.reshape(-1)  # a view for contiguous arrays
+        for start in range(0, voxels.size, chunk_size):
+            voxels[start:start + chunk_size] = self._labels[self._inverse[start:start + chunk_size]]
+
+    def __eq__(self, other):
+        return numpy.array_equal(self.data, other.data) and self.shape == other.shape
+
+
+#: header fields copied from the map to the binarised map
+BINMAP_HEADER_FIELDS = ['nxstart', 'nystart', 'nzstart', 'mx', 'my', 'mz', 'cella', 'cellb', 'mapc', 'mapr', 'maps',
+                        'origin']
+
+
+def _bin_slab(data, out_data, section, sections_per_slab, contour_level, mask_value, negate):
+    """Binarise one slab of sections straight into the output
+
+    :return: the number of voxels set to the mask value
+    :rtype: int
+    """
+    slab = data[section:section + sections_per_slab]
+    if negate:
+        selected = numpy.less(slab, contour_level)
+    else:
+        selected = numpy.greater(slab, contour_level)
+    # multiply into the output to avoid an int64 temporary and a cast copy
+    numpy.multiply(selected, mask_value, out=out_data[section:section + sections_per_slab], casting='unsafe')
+    return int(numpy.count_nonzero(selected))
+
+
+def _label_slab(data, out_data, section, sections_per_slab, contour_levels):
+    """Label one slab of sections straight into the output with the number of contour levels below each voxel
+
+    :return: the number of voxels with each label
+    :rtype: :py:class:`numpy.ndarray`
+    """
+    labels = numpy.digitize(data[section:section + sections_per_slab], contour_levels, right=True)
+    out_data[section:section + sections_per_slab] = labels
+    return numpy.bincount(labels.reshape(-1), minlength=len(contour_levels) + 1)
+
+
+def _bin_map_components(args, mrc):
+    """Binarise the map and label each connected component
+
+    The provisional labels are held in a temporary memory-mapped file so that the map is never held in memory.
+    Alongside the output we write a JSON file (``<output>.json``) in the format written by :py:func:`mergemask` with
+    one mask per component so that the output can be converted as a merged mask.
+
+    :param args: parsed arguments
+    :type args: :py:class:`argparse.Namespace`
+    :param mrc: the open map
+    :type mrc: :py:class:`mrcfile.mrcmemmap.MrcMemmap`
+    :return: exit status
+    :rtype: int
+    """
+    import tempfile
+    from ..readers.mapreader import label_components
+    sections_per_slab = max(1, SLAB_BYTES // max(1, mrc.data[0].nbytes))
+    compare = numpy.less if args.negate else numpy.greater
+    selections = (
+        compare(mrc.data[section:section + sections_per_slab], args.contour_level)
+        for section in range(0, mrc.data.shape[0], sections_per_slab)
+    )
+    label_dtype = numpy.int32 if mrc.data.size < numpy.iinfo(numpy.int32).max else numpy.int64
+    with tempfile.TemporaryFile() as label_file:
+        labels = numpy.memmap(label_file, dtype=label_dtype, mode='w+', shape=mrc.data.shape)
+        count = label_components(selections, labels, connectivity=args.connectivity)
+        if args.verbose:
+            print_date(f'Found {count} connected components')
+        out_type = _label_dtype(count)
+        try:
+            mrc2 = mrcfile.new_mmap(
+                args.output, mrc.data.shape, mrc_mode=mrcfile.utils.mode_from_dtype(out_type),
+                overwrite=args.overwrite
+            )
+        except ValueError:
+            print_date("Binarising preparation failed")
+            print_date("Attempting to overwrite without explicit --overwrite argument")
+            return 65
+        for section in range(0, mrc.data.shape[0], sections_per_slab):
+            mrc2.data[section:section + sections_per_slab] = labels[section:section + sections_per_slab]
+        del labels
+    for field in BINMAP_HEADER_FIELDS:
+        mrc2.header[field] = mrc.header[field]
+    _set_header_stats(mrc2, sections_per_slab)
+    mrc2.close()
+    stem = pathlib.Path(args.output).stem
+    mask_metadata = {
+        'mask_to_label': {f"{stem}_component_{label}": label for label in range(1, count + 1)},
+        'label_tree': {str(label): 0 for label in range(1, count + 1)},
+    }
+    label_tree_fn = pathlib.Path(args.output).with_suffix('.json')
+    if args.verbose:
+        print_date(f"Writing component labels to '{label_tree_fn}'...")
+    with open(label_tree_fn, 'w') as label_file:
+        print(json.dumps(mask_metadata, indent=4), file=label_file)
+    if args.verbose:
+        print_date('Binarising complete!')
+    return 0
+
+
+def _majority(blocks):
+    """The most common value of each row of ``blocks`` (the smallest value on ties)
+
+    Each row is sorted so that equal values form runs; the value at the end of the longest run is the majority.
+    """
+    blocks = numpy.sort(blocks, axis=1)
+    positions = numpy.arange(blocks.shape[1])
+    run_starts = numpy.ones(blocks.shape, dtype=bool)
+    run_starts[:, 1:] = blocks[:, 1:] != blocks[:, :-1]
+    run_lengths = positions - numpy.maximum.accumulate(numpy.where(run_starts, positions, 0), axis=1) + 1
+    return blocks[numpy.arange(blocks.shape[0]), numpy.argmax(run_lengths, axis=1)]
+
+
+def _pool_slab(data, out_data, section, sections_per_slab, bin_factor, pooling):
+    """Pool one slab of sections (a multiple of ``bin_factor`` sections) into the output
+
+    The slab is viewed as blocks of ``bin_factor ** 3`` voxels which are pooled in one vectorised operation.
+    """
+    k = bin_factor
+    sections = min(sections_per_slab, k * out_data.shape[0] - section) // k
+    rows, cols = out_data.shape[1:]
+    slab = data[section:section + sections * k, :rows * k, :cols * k]
+    blocks = slab.reshape(sections, k, rows, k, cols, k)
+    if pooling == 'mean':
+        pooled = blocks.mean(axis=(1, 3, 5), dtype=numpy.float64)
+    elif pooling == 'max':
+        pooled = blocks.max(axis=(1, 3, 5))
+    else:
+        pooled = _majority(blocks.transpose(0, 2, 4, 1, 3, 5).reshape(-1, k ** 3)).reshape(sections, rows, cols)
+    out_data[section // k:section // k + sections] = pooled
+
+
+def _bin_map_downsample(args, mrc):
+    """Downsample the map by ``args.bin_factor`` in each dimension
+
+    Each block of ``bin_factor ** 3`` voxels becomes one voxel: the mean for densities or the maximum or majority
+    (most common value) for label masks (``args.pooling``). Voxels beyond the last whole block are dropped. The
+    output voxels are ``bin_factor`` times larger so that the output covers the same physical space.
+
+    :param args: parsed arguments
+    :type args: :py:class:`argparse.Namespace`
+    :param mrc: the open map
+    :type mrc: :py:class:`mrcfile.mrcmemmap.MrcMemmap`
+    :return: exit status
+    :rtype: int
+    """
+    k = args.bin_factor
+    shape = tuple(length // k for length in mrc.data.shape)
+    if min(shape) < 1:
+        print_date(f"error: the map {mrc.data.shape} is too small to bin by a factor of {k}")
+        return 64
+    pooling = args.pooling
+    if pooling is None:
+        pooling = 'mean' if numpy.issubdtype(mrc.data.dtype, numpy.floating) else 'majority'
+    out_type = numpy.float32 if pooling == 'mean' else mrc.data.dtype
+    if args.verbose:
+        print_date(f'Binning {mrc.data.shape} by {k} to {shape} using {pooling} pooling...')
+    try:
+        mrc2 = mrcfile.new_mmap(
+            args.output, shape, mrc_mode=mrcfile.utils.mode_from_dtype(numpy.dtype(out_type)),
+            overwrite=args.overwrite
+        )
+    except ValueError:
+        print_date("Binning preparation failed")
+        print_date("Attempting to overwrite without explicit --overwrite argument")
+        return 65
+    # whole blocks of sections per slab
+    sections_per_slab = k * max(1, SLAB_BYTES // max(1, k * mrc.data[0].nbytes))
+    sections = range(0, shape[0] * k, sections_per_slab)
+    workers = pool_size(len(sections), 3 * SLAB_BYTES) if args.jobs is None else args.jobs
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(
+            functools.partial(
+                _pool_slab, mrc.data, mrc2.data, sections_per_slab=sections_per_slab, bin_factor=k, pooling=pooling
+            ),
+            sections
+        ))
+    for field in BINMAP_HEADER_FIELDS:
+        mrc2.header[field] = mrc.header[field]
+    # larger voxels over the same space: the grid, the cell and the start index all shrink by the bin factor
+    for field in ('nxstart', 'nystart', 'nzstart'):
+        mrc2.header[field] = mrc.header[field] // k
+    voxel_size = mrc.voxel_size
+    mrc2.header.mx, mrc2.header.my, mrc2.header.mz = shape[::-1]
+    mrc2.voxel_size = tuple(voxel_size[axis] * k for axis in 'xyz')
+    _set_header_stats(mrc2, max(1, sections_per_slab // k))
+    mrc2.close()
+    if args.verbose:
+        print_date('Binning complete!')
+    return 0
+
+
 def bin_map(args, configs):
     """Bin the CCP4 map
 
+    The map is binarised one slab of sections at a time in a pool of threads (numpy releases the GIL) with each slab
+    written straight into the memory-mapped output so that at most a few slabs are ever held in memory.
+
+    If several contour levels are given (``args.contour_levels``) we instead produce a labelled mask in the same
+    single pass: voxels above (exclusive) the k-th level but not above the next level have label k.
+
+    With ``args.components`` each connected component of the binarised map has its own label instead of the mask
+    value (see :py:func:`_bin_map_components`).
+
+    With ``args.bin_factor`` the map is not binarised but downsampled (see :py:func:`_bin_map_downsample`).
+
     :param args: parsed arguments
     :type args: :py:class:`argparse.Namespace`
     :param configs: configurations object
@@ -292,6 +695,8 @@ def bin_map(args, configs):
     if args.verbose:
         print_date('Reading in data from {}...'.format(args.from_file))
     with mrcfile.mmap(args.from_file) as mrc:
+        if args.bin_factor is not None:
+            return _bin_map_downsample(args, mrc)
         if args.bytes_per_voxel == 1:
             out_type = numpy.int8
         elif args.bytes_per_voxel == 2:
@@ -302,27 +707,73 @@ def bin_map(args, configs):
             out_type = numpy.int64
         elif args.bytes_per_voxel == 16:
             out_type = numpy.int128
+        if args.contour_levels is not None and len(args.contour_levels) > numpy.iinfo(out_type).max:
+            print_date(f"error: too many contour levels ({len(args.contour_levels)}) for {args.bytes_per_voxel} "
+                       f"byte(s) per voxel; use a larger value for -B/--bytes-per-voxel")
+            return 64
         if args.verbose:
             print_date('Voxels will be of type {}'.format(out_type))
-            print_date('Binarising to {} about contour-level of {}'.format(args.mask_value, args.contour_level))
-        if args.negate:
-            print_date('Negating...')
-            data = ((mrc.data < args.contour_level) * args.mask_value).astype(
-                out_type)  # only need a byte per voxel
-        else:
-            data = ((mrc.data > args.contour_level) * args.mask_value).astype(
-                out_type)  # only need a byte per voxel
+            if args.contour_levels is not None:
+                print_date('Labelling about contour-levels of {}'.format(args.contour_levels))
+            else:
+                print_date('Binarising to {} about contour-level of {}'.format(args.mask_value, args.contour_level))
+        if args.components:
+            return _bin_map_components(args, mrc)
         if args.verbose:
             print_date('Creating output file...')
         try:
-            mrc2 = mrcfile.new(args.output, data, overwrite=args.overwrite)
+            mrc2 = mrcfile.new_mmap(
+                args.output, mrc.data.shape, mrc_mode=mrcfile.utils.mode_from_dtype(numpy.dtype(out_type)),
+                overwrite=args.overwrite
+            )
         except ValueError:
             print_date("Binarising preparation failed")
             print_date("Attempting to overwrite without explicit --overwrite argument")
             return 65
+        if args.negate:
+            print_date('Negating...')
+        # the mask value as stored in the output type
+        mask_value = numpy.array(args.mask_value).astype(out_type)
+        sections_per_slab = max(1, SLAB_BYTES // max(1, mrc.data[0].nbytes))
+        sections = range(0, mrc.data.shape[0], sections_per_slab)
+        # each thread holds a slab and its selection
+        workers = pool_size(len(sections), 2 * SLAB_BYTES) if args.jobs is None else args.jobs
+        if args.verbose:
+            print_date(f'Binarising {len(sections)} slabs using {workers} thread(s)...')
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            if args.contour_levels is not None:
+                values = numpy.arange(len(args.contour_levels) + 1)
+                counts = sum(executor.map(
+                    functools.partial(
+                        _label_slab, mrc.data, mrc2.data, sections_per_slab=sections_per_slab,
+                        contour_levels=numpy.array(args.contour_levels)
+                    ),
+                    sections
+                ))
+            else:
+                selected_count = sum(executor.map(
+                    functools.partial(
+                        _bin_slab, mrc.data, mrc2.data, sections_per_slab=sections_per_slab,
+                        contour_level=args.contour_level, mask_value=mask_value, negate=args.negate
+                    ),
+                    sections
+                ))
+                values = numpy.array([0, int(mask_value)])
+                counts = numpy.array([mrc2.data.size - selected_count, selected_count])
         if args.verbose:
             print_date('Writing header data...')
-        mrc2.header.cella = mrc.header.cella
+        for field in BINMAP_HEADER_FIELDS:
+            mrc2.header[field] = mrc.header[field]
+        # the header statistics follow from the number of voxels with each value
+        if mrc2.data.size:
+            present = values[counts > 0]
+            mean = float(numpy.dot(values, counts)) / mrc2.data.size
+            mrc2.header.dmin = present.min()
+            mrc2.header.dmax = present.max()
+            mrc2.header.dmean = mean
+            mrc2.header.rms = numpy.sqrt(
+                max(0.0, float(numpy.dot(numpy.square(values, dtype=numpy.float64), counts)) / mrc2.data.size - mean ** 2)
+            )
         mrc2.flush()
         mrc2.close()
         if args.verbose:
@@ -330,8 +781,144 @@ def bin_map(args, configs):
     return 0
 
 
+def _transform_stl_file(from_file, output, transform):
+    """Transform one STL file in place in memory and save it
+
+    :return: the input file name
+    :rtype: str
+    """
+    mesh = Mesh.from_file(from_file)
+    transform_stl_mesh(mesh, transform, in_place=True)
+    mesh.save(output)
+    return from_file
+
+
+def _transform_slab(from_file, output, section, sections_per_slab, matrix, offset, order):
+    """Resample one slab of output sections
+
+    Only the window of the input that the slab maps back onto (with a one voxel margin for the interpolation) is
+    read so that neighbouring slabs read overlapping windows. Both maps are opened by name so that the slab can be
+    resampled in a worker process and written straight into the memory-mapped output.
+
+    :param str from_file: the input map
+    :param str output: the output map, already created with its final shape
+    :param int section: the first section of the slab
+    :param int sections_per_slab: the number of sections in the slab
+    :param matrix: the output-to-input array coordinate matrix
+    :type matrix: :py:class:`numpy.ndarray`
+    :param offset: the output-to-input array coordinate offset
+    :type offset: :py:class:`numpy.ndarray`
+    :param int order: the spline interpolation order (0 is nearest-neighbour)
+    """
+    with mrcfile.mmap(from_file) as mrc, mrcfile.mmap(output, mode='r+') as mrc2:
+        _transform_window(mrc.data, mrc2.data[section:section + sections_per_slab], section, matrix, offset, order)
+
+
+def _transform_window(data, out_slab, section, matrix, offset, order):
+    """Resample the output slab from the window of the input that it maps back onto
+
+    :param data: the input map data
+    :param out_slab: the output sections starting at ``section``
+    :param int section: the first section of the slab
+    :param matrix: the output-to-input array coordinate matrix
+    :type matrix: :py:class:`numpy.ndarray`
+    :param offset: the output-to-input array coordinate offset
+    :type offset: :py:class:`numpy.ndarray`
+    :param int order: the spline interpolation order (0 is nearest-neighbour)
+    """
+    from scipy import ndimage
+    stop = section + out_slab.shape[0]
+    # the extremes of an affine map over a box are at its corners
+    corners = numpy.array(list(itertools.product(
+        (section, stop - 1), (0, out_slab.shape[1] - 1), (0, out_slab.shape[2] - 1)
+    )), dtype=numpy.float64)
+    coords = numpy.dot(corners, matrix.T) + offset
+    lo = numpy.maximum(numpy.floor(coords.min(axis=0)).astype(int) - 1, 0)
+    hi = numpy.minimum(numpy.ceil(coords.max(axis=0)).astype(int) + 2, data.shape)
+    if numpy.any(hi <= lo):  # nothing of the input falls in this slab
+        out_slab[...] = 0
+        return
+    window = numpy.asarray(data[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]])
+    ndimage.affine_transform(
+        window, matrix, offset=numpy.dot(matrix, (section, 0, 0)) + offset - lo, output=out_slab, order=order,
+        mode='constant', cval=0
+    )
+
+
+def _transform_map(args, from_file, output, transform):
+    """Resample the map by the transform
+
+    The transform takes input voxel indices (x, y, z) to output voxel indices; the output grid starts at index zero
+    and extends to the furthest transformed voxel of the input. Masks (integer modes) are resampled by
+    nearest-neighbour interpolation so that no new labels appear; densities are interpolated linearly. Slabs of
+    output sections are resampled in a pool of processes (the interpolation holds the GIL), each straight into the
+    memory-mapped output. The output
+    keeps the voxel size and origin of the input.
+
+    :param args: parsed arguments
+    :type args: :py:class:`argparse.Namespace`
+    :param str from_file: the input map
+    :param str output: the output map
+    :param transform: numpy array with ``shape = (4, 4)``
+    :type transform: :py:class:`numpy.ndarray`
+    :return: exit status
+    :rtype: int
+    """
+    with mrcfile.mmap(from_file) as mrc:
+        # array axes are (z, y, x)
+        rotation = numpy.asarray(transform[2::-1, 2::-1], dtype=numpy.float64)
+        translation = numpy.asarray(transform[2::-1, 3], dtype=numpy.float64)
+        if numpy.isclose(numpy.linalg.det(rotation), 0):
+            print_date("error: the transformation matrix is singular")
+            return 64
+        corners = numpy.array(list(itertools.product(*((0, length - 1) for length in mrc.data.shape))))
+        extent = numpy.floor(numpy.dot(corners, rotation.T) + translation).max(axis=0).astype(int) + 1
+        if numpy.any(extent < 1):
+            print_date(f"error: the transformed map {from_file} lies entirely outside the output grid")
+            return 64
+        shape = tuple(extent)
+        matrix = numpy.linalg.inv(rotation)
+        offset = -numpy.dot(matrix, translation)
+        order = 0 if numpy.issubdtype(mrc.data.dtype, numpy.integer) else 1
+        if args.verbose:
+            print_date(f"Resampling {from_file} {mrc.data.shape} to {shape} using "
+                       f"{'nearest-neighbour' if order == 0 else 'linear'} interpolation...")
+        try:
+            mrc2 = mrcfile.new_mmap(
+                output, shape, mrc_mode=mrcfile.utils.mode_from_dtype(mrc.data.dtype), overwrite=args.overwrite
+            )
+        except ValueError:
+            print_date(f"error: {output} exists; use --overwrite to replace it")
+            return 65
+        sections_per_slab = max(1, SLAB_BYTES // mrc2.data[0].nbytes)
+        sections = range(0, shape[0], sections_per_slab)
+        # each slab needs its output and an input window about as large
+        workers = pool_size(len(sections), 3 * SLAB_BYTES) if args.jobs is None else args.jobs
+        # the workers open the output by name
+        mrc2.flush()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(
+                functools.partial(
+                    _transform_slab, from_file, output, sections_per_slab=sections_per_slab, matrix=matrix,
+                    offset=offset, order=order
+                ),
+                sections
+            ))
+        for field in BINMAP_HEADER_FIELDS:
+            mrc2.header[field] = mrc.header[field]
+        voxel_size = mrc.voxel_size
+        mrc2.header.mx, mrc2.header.my, mrc2.header.mz = shape[::-1]
+        mrc2.voxel_size = tuple(voxel_size[axis] for axis in 'xyz')
+        _set_header_stats(mrc2, sections_per_slab)
+        mrc2.close()
+    return 0
+
+
 def transform(args, configs):
-    """Rescale the STL mesh using the params in the arguments namespace
+    """Rescale the STL mesh or resample the map using the params in the arguments namespace
+
+    Several STL files (``args.from_file`` is a list with a matching list ``args.output``) are transformed in a pool
+    of processes. Maps are resampled one after the other (see :py:func:`_transform_map`).
 
     :param args: parsed arguments
     :type args: :py:class:`argparse.Namespace`
@@ -346,22 +933,39 @@ def transform(args, configs):
     if args.verbose:
         print_date("Transformation matrix: ")
         print_date(_str(transform), incl_date=False)
-    if re.match(r'.*\.stl$', args.from_file, re.IGNORECASE):
-        # mesh operations
-        in_mesh = Mesh.from_file(args.from_file)
-        out_mesh = transform_stl_mesh(in_mesh, transform)
-        if out_mesh is None:
-            return 65
-        if args.verbose:
-            print_date("Saving output...")
-        # save the output
-        out_mesh.save(args.output)
-        if args.verbose:
-            print_date("Done")
-        return 0
-    else:
+    from_files = args.from_file if isinstance(args.from_file, list) else [args.from_file]
+    outputs = args.output if isinstance(args.output, list) else [args.output]
+    stl_files = [(f, o) for f, o in zip(from_files, outputs) if re.match(r'.*\.stl$', f, re.IGNORECASE)]
+    map_files = [(f, o) for f, o in zip(from_files, outputs) if re.match(r'.*\.(map|mrc|rec)$', f, re.IGNORECASE)]
+    if len(stl_files) + len(map_files) < len(from_files):
         print_date("Rescaling functionality for this filetype yet to be implemented!")
         return 0
+    if len(stl_files) == 1:
+        if args.verbose:
+            print_date("Transforming {}...".format(stl_files[0][0]))
+        _transform_stl_file(*stl_files[0], transform)
+    elif stl_files:
+        # each worker holds a mesh and its binary STL output
+        task_memory = 2 * max(os.path.getsize(from_file) for from_file, _ in stl_files)
+        workers = pool_size(len(stl_files), task_memory) if args.jobs is None else args.jobs
+        if args.verbose:
+            print_date("Transforming {} STL files using {} worker(s)...".format(len(stl_files), workers))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(_transform_stl_file, from_file, output, transform)
+                for from_file, output in stl_files
+            ]
+            for future in concurrent.futures.as_completed(futures):
+                from_file = future.result()
+                if args.verbose:
+                    print_date("Transformed {}".format(from_file))
+    for from_file, output in map_files:
+        status = _transform_map(args, from_file, output, transform)
+        if status != 0:
+            return status
+    if args.verbose:
+        print_date("Done")
+    return 0
 
 
 def construct_transformation_matrix(args):
@@ -387,126 +991,473 @@ def construct_transformation_matrix(args):
     return transform
 
 
-def transform_stl_mesh(mesh, transform):
+def transform_stl_mesh(mesh, transform, in_place=False):
     """Rescale the given STL mesh by the given transform
 
+    All vertices (three per triangle) are transformed by a single product with the homogeneous transform i.e.
+    ``[v, 1] @ transform.T`` which we evaluate as ``v @ rotation.T + translation`` without building the column of
+    ones.
+
     :param mesh: an STL mesh
     :type mesh: :py:class:`numpy.ndarray`
     :param transform: numpy array with ``shape = (4, 4)``
     :type transform: :py:class:`numpy.ndarray`
+    :param bool in_place: transform the vertices of ``mesh`` instead of a copy [default: False]
     :return: an STL mesh transformed
     :rtype: :py:class:`numpy.ndarray`
     """
-    # the rotation sub-matrix of the transformation matrix
-    rotation = transform[0:3, 0:3]
-    # output mesh
-    # we need to copy the data out
-    out_mesh = Mesh(numpy.copy(mesh.data), remove_empty_areas=False)
-    # perform the rotation part of the transformation
-    for i in range(3):
-        out_mesh.vectors[:, i] = numpy.dot(rotation, out_mesh.vectors[:, i].T).T
-    # now perform translations
-    out_mesh.x = out_mesh.x + transform[0, 3]
-    out_mesh.y += transform[1, 3]
-    out_mesh.z += transform[2, 3]
+    if in_place:
+        out_mesh = mesh
+    else:
+        # we need to copy the data out
+        out_mesh = Mesh(numpy.copy(mesh.data), remove_empty_areas=False)
+    # (N, 3, 3) view into the structured mesh data; reshaping it would copy
+    vertices = out_mesh.vectors
+    vertices[...] = numpy.matmul(vertices, transform[0:3, 0:3].T)
+    vertices += transform[0:3, 3]
     return out_mesh
 
 
-async def _mask_is_binary(mask, verbose=False):
-    """Coroutine to check whether individual masks are binary"""
+async def _mask_is_binary(mask, verbose=False, roi=None):
+    """Coroutine to check whether individual masks are binary
+
+    With a region of interest only the region is read and it need not have both voxel values e.g. it may lie
+    entirely inside the masked region.
+    """
     from ..readers.mapreader import Map
-    this_map = Map(mask)
+    if roi is not None:
+        if verbose:
+            print_date(f"info: assessing the region {roi} of {mask}...")
+        voxel_values = numpy.unique(Map(mask, header_only=True).read_region(*roi)).tolist()
+        return _binary_mask_failure(voxel_values, complete=False) is None
+    this_map = Map(mask, mmap=True)
     if verbose:
         print_date(f"info: assessing {mask}...")
     # if a mask is binary but not with non-zero value of 1 fix this
-    if 1 not in this_map._voxel_values:
+    voxel_values = this_map.statistics.values.tolist()
+    if 1 not in voxel_values:
         if verbose:
-            print_date(f"info: fixing {mask} with voxel values {this_map._voxel_values}...")
+            print_date(f"info: fixing {mask} with voxel values {voxel_values}...")
         this_map.fix_mask(mask_value=1)
     return this_map.is_mask
 
 
+def _binary_mask_failure(voxel_values, complete=True):
+    """The reason that a mask with the given voxel values is not binary
+
+    :param voxel_values: the distinct voxel values found in the mask
+    :param bool complete: whether the voxel values are from the whole mask rather than from a sample
+    :return: the reason or ``None`` if the mask is (or, for a sample, could be) binary
+    :rtype: str
+    """
+    voxel_values = sorted(voxel_values)
+    if len(voxel_values) > 2:
+        return f"more than two voxel values e.g. {voxel_values[:5]}"
+    if len(voxel_values) == 2 and 0 not in voxel_values:
+        return f"no background (zero) voxels; voxel values: {voxel_values}"
+    if complete and len(voxel_values) < 2:
+        return f"only one voxel value: {voxel_values}"
+    return None
+
+
+def _assess_mask(mask, sample_sections=16, full_assessment=False, verbose=False):
+    """Assess whether an individual mask is binary
+
+    A random sample of sections is read through a memory map; this catches most non-binary masks while reading only
+    a small part of each file. Masks with no more sections than the sample are read in full. If ``full_assessment``
+    is set then masks that pass on the sample are verified slab by slab, stopping at the third distinct value.
+
+    :param str mask: the mask file name
+    :param int sample_sections: the number of sections to sample
+    :param bool full_assessment: verify every voxel of masks that pass on the sample
+    :param bool verbose: verbosity flag
+    :return: the mask and the reason it is not binary (``None`` if it is binary)
+    :rtype: tuple[str, str]
+    """
+    from ..readers.mapreader import Map
+    this_map = Map(mask, header_only=True)
+    if verbose:
+        print_date(f"info: assessing {mask}...")
+    exhaustive = this_map._ns <= sample_sections
+    if exhaustive:
+        sections = numpy.arange(this_map._ns)
+    else:
+        sections = numpy.sort(numpy.random.default_rng().choice(this_map._ns, size=sample_sections, replace=False))
+    reason = _binary_mask_failure(numpy.unique(this_map.read_sections(sections)).tolist(), complete=exhaustive)
+    if reason is not None:
+        return mask, reason if exhaustive else f"{reason} in {sample_sections} sampled sections"
+    if full_assessment and not exhaustive:
+        if verbose:
+            print_date(f"info: verifying all voxels of {mask}...")
+        voxel_values = set()
+        for slab in this_map.iter_slabs():
+            voxel_values.update(numpy.unique(slab).tolist())
+            if len(voxel_values) > 2:
+                break
+        reason = _binary_mask_failure(voxel_values)
+    return mask, reason
+
+
 async def _check_masks_binary(args, configs):
-    """Corourite to run the event loop for all masks"""
-    awaitables = list()
-    for mask in args.masks:
-        awaitables.append(_mask_is_binary(mask, verbose=args.verbose))
-    return await asyncio.gather(*awaitables)
+    """Coroutine to assess all masks concurrently
 
+    Assessing a mask is blocking (file I/O and numpy) so the masks are assessed in a pool of processes sized from
+    the number of CPUs and the available memory. Each result is reported as soon as it is available.
 
-def check_mask_is_binary(fn, verbose=False):
+    :return: a list of (mask, reason) pairs in the order they were completed; the reason is ``None`` for binary
+        masks
+    :rtype: list[tuple[str, str]]
+    """
+    loop = asyncio.get_running_loop()
+    # each worker holds at most one slab and its sorted copy
+    workers = pool_size(len(args.masks), 2 * SLAB_BYTES)
+    if args.verbose:
+        print_date(f"info: assessing {len(args.masks)} masks using {workers} worker(s)...")
+    assessments = list()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            loop.run_in_executor(
+                executor,
+                functools.partial(
+                    _assess_mask, mask, sample_sections=args.sample_sections,
+                    full_assessment=args.full_assessment, verbose=args.verbose
+                )
+            ) for mask in args.masks
+        ]
+        for future in asyncio.as_completed(futures):
+            mask, reason = await future
+            if reason is not None:
+                print_date(f"warning: non-binary mask {mask}: {reason}")
+            elif args.verbose:
+                print_date(f"info: {mask} is binary")
+            assessments.append((mask, reason))
+    return assessments
+
+
+def check_mask_is_binary(fn, verbose=False, roi=None):
     """Check whether a mask is binary or not
 
     :param str fn: map filename
     :param bool verbose: verbosity flag
+    :param tuple roi: an optional triple of slices (sections, rows, cols); only this region is read
     :return: boolean, True if binary mask
     :rtype: bool
     """
-    if sys.version_info.minor > 6:
-        is_binary = asyncio.run(_mask_is_binary(fn, verbose=verbose))
-    else:
-        loop = asyncio.get_event_loop()
-        if loop.is_closed():
-            loop = asyncio.new_event_loop()
-        is_binary = loop.run_until_complete(_mask_is_binary(fn, verbose=verbose))
-        loop.close()
-    return is_binary
+    return asyncio.run(_mask_is_binary(fn, verbose=verbose, roi=roi))
 
 
 def _masks_all_binary(args, configs):
-    """Check whether all masks are binary"""
-    """Validate that all masks are binary masks"""
-    # todo: for small files read all data
-    # todo: for large files only read the first X bytes
-    # todo: give the user the option to read full files for large files
-    if sys.version_info.minor > 6:
-        all_binary = asyncio.run(_check_masks_binary(args, configs))
-    else:
-        loop = asyncio.get_event_loop()
-        if loop.is_closed():
-            loop = asyncio.new_event_loop()
-        all_binary = loop.run_until_complete(_check_masks_binary(args, configs))
-        loop.close()
-    return all(all_binary)
-
-
-def _masks_no_overlap(args, configs):
-    """Checks that all segments do not overlap"""
-    # make all binary
-    # current_data = None
+    """Validate that all masks are binary masks
+
+    By default, only a random sample of ``args.sample_sections`` sections of each mask is assessed; use
+    ``args.full_assessment`` to also verify every voxel of the masks that pass. Every mask that fails is reported
+    together with the reason.
+    """
+    assessments = asyncio.run(_check_masks_binary(args, configs))
+    return all(reason is None for _, reason in assessments)
+
+
+def _mask_overlaps(args):
+    """Count the voxels shared by each pair of overlapping masks
+
+    We keep a compact occupancy array for one slab of sections at a time: each voxel holds ``0`` if it is
+    unoccupied or the (1-based) index of the first mask to occupy it. Each mask is then only compared with the
+    occupancy at its own non-zero voxels. A voxel shared by more than two masks is counted against the first mask
+    to occupy it.
+
+    :param args: parsed arguments
+    :type args: :py:class:`argparse.Namespace`
+    :return: the number of shared voxels keyed by pairs of (0-based) mask indices ``(earlier, later)``
+    :rtype: dict
+    """
     from ..readers.mapreader import Map
-    previous_mask = None
-    for mask in args.masks:
-        this_map = Map(mask)
-        if 'current_data' not in locals():
-            current_data = numpy.zeros(this_map.voxels.shape)
-        # if current_data is None:
-        #     current_data = this_map.voxels
-        #     continue
-        # add all volumes
-        current_data += this_map.voxels
-        if numpy.amax(current_data) > 1:
-            print_date(f"warning: segment overlap between mask {mask} and {previous_mask}")
-            break
-        previous_mask = mask
-    # the max should be 1
-    max_voxel_value = numpy.amax(current_data)
-    return max_voxel_value == 1
-
-
-def _mergemask(masks: List[str]) -> 'MergedMask':
-    """The mergemask workhorse which does the actual merging"""
+    maps = [Map(mask, header_only=True) for mask in args.masks]
+    # one byte per voxel suffices for the 255 masks that can be merged by summing labels
+    occupancy_dtype = numpy.uint8 if len(maps) <= numpy.iinfo(numpy.uint8).max else numpy.uint16
+    section_bytes = maps[0]._nr * maps[0]._nc * maps[0]._voxel_size
+    sections_per_slab = max(1, SLAB_BYTES // (section_bytes or 1))
+    overlaps = dict()
+    for slabs in zip(*(this_map.iter_slabs(sections_per_slab) for this_map in maps)):
+        occupancy = numpy.zeros(slabs[0].size, dtype=occupancy_dtype)
+        for index, slab in enumerate(slabs, start=1):
+            voxels = numpy.flatnonzero(slab)
+            occupants = occupancy[voxels]
+            occupied = occupants != 0
+            if numpy.any(occupied):
+                previous_indices, counts = numpy.unique(occupants[occupied], return_counts=True)
+                for previous_index, count in zip(previous_indices.tolist(), counts.tolist()):
+                    pair = previous_index - 1, index - 1
+                    overlaps[pair] = overlaps.get(pair, 0) + count
+            occupancy[voxels[~occupied]] = index
+    return overlaps
+
+
+def _masks_no_overlap(args):
+    """Checks that all segments do not overlap
+
+    Every overlapping pair of masks is reported together with the number of voxels they share. This reads every
+    mask so the merge only calls it to report the overlaps once a check has failed.
+    """
+    overlaps = _mask_overlaps(args)
+    for (previous_index, index), count in sorted(overlaps.items()):
+        print_date(f"warning: segment overlap between mask {args.masks[index]} and {args.masks[previous_index]} "
+                   f"({count} voxels)")
+    return not overlaps
+
+
+def _checked_slabs(args, mask, this_map, merged_mask, label_to_mask, sections_per_slab):
+    """Yield the slabs of a mask checking each slab before it is merged
+
+    Overlap is not checked if ``merged_mask`` is ``None``.
+
+    :raises ValueError: as soon as a slab shows that the mask is non-binary (unless ``args.skip_assessment``) or
+        that it overlaps a preceding mask (unless ``args.allow_overlap``)
+    """
+    voxel_values = set()
+    section = 0
+    for slab in this_map.iter_slabs(sections_per_slab):
+        if not args.skip_assessment:
+            voxel_values.update(numpy.unique(slab).tolist())
+            reason = _binary_mask_failure(voxel_values, complete=False)
+            if reason is not None:
+                raise ValueError(f"non-binary mask {mask}: {reason}")
+        if not args.allow_overlap and merged_mask is not None:
+            # the labels of preceding masks under this slab of the mask
+            overlap = merged_mask.data[section:section + len(slab)][slab != 0]
+            overlapping_labels = numpy.unique(overlap[overlap != 0])
+            if overlapping_labels.size > 0:
+                raise ValueError(
+                    f"segment overlap between mask {mask} and {label_to_mask[int(overlapping_labels[0])]}"
+                )
+        section += len(slab)
+        yield slab
+    if not args.skip_assessment:
+        reason = _binary_mask_failure(voxel_values)
+        if reason is not None:
+            raise ValueError(f"non-binary mask {mask}: {reason}")
+
+
+def _mergemask_single_pass(args, data=None) -> 'MergedMask':
+    """Merge the masks reading each mask only once
+
+    In the same pass over each mask we check that the mask is binary (unless ``args.skip_assessment``), that it
+    does not overlap any of the preceding masks (unless ``args.allow_overlap``) and merge it. We stop at the first
+    mask that fails a check; if it overlaps then every overlapping pair of masks is reported. Masks are read in slabs of at most ``args.slab_size`` MiB.
+
+    :param args: parsed arguments
+    :type args: :py:class:`argparse.Namespace`
+    :param data: an optional zero-filled ``int16`` array of the shape of the masks to merge into (e.g. the data of a
+        memory-mapped output file); otherwise the merged mask is held in memory
+    :type data: :py:class:`numpy.ndarray`
+    :return: the merged mask or ``None`` if a mask failed a check
+    :rtype: :py:class:`MergedMask`
+    """
     from ..readers.mapreader import Map
-    import pathlib
-    merged_mask = MergedMask()  # everything is initialised from the first mask since masks are homogeneous
-    for mask in masks:
-        this_map = Map(mask)
-        merged_mask.merge(this_map.voxels, mask_name=pathlib.Path(mask).name)
-    return merged_mask  # that's it!
+    maps = [Map(mask, header_only=True) for mask in args.masks]
+    if data is None:
+        data = numpy.zeros((maps[0]._ns, maps[0]._nr, maps[0]._nc), dtype=numpy.int16)
+    merged_mask = MergedMask(data=data)
+    sections_per_slab = max(1, int(args.slab_size * 2 ** 20) // (data[0].nbytes or 1))
+    label_to_mask = dict()
+    for mask, this_map in zip(args.masks, maps):
+        mask_name = pathlib.Path(mask).name
+        if args.verbose:
+            print_date(f"info: merging {mask}...")
+        try:
+            merged_mask.merge_slabs(
+                _checked_slabs(args, mask, this_map, merged_mask, label_to_mask, sections_per_slab),
+                mask_name=mask_name
+            )
+        except ValueError as value_error:
+            print_date(f"error: {value_error}")
+            if str(value_error).startswith("segment overlap"):
+                _masks_no_overlap(args)
+                print_date("info: if overlapping segments are expected re-run with the --allow-overlap argument; "
+                           "see 'sff prep mergemask' for more information")
+            return None
+        label_to_mask[merged_mask.mask_to_label[mask_name]] = mask
+    return merged_mask
+
+
+def _slab_membership(masks, start, stop):
+    """Find the distinct voxel values and the mask membership of each voxel in sections ``start`` to ``stop`` of the
+    masks
+
+    The membership of a voxel is the set of masks in which it is non-zero packed into bits in the order of the masks
+    (as :py:func:`numpy.packbits`).
+
+    :param list masks: the mask file names
+    :param int start: the first section
+    :param int stop: one past the last section
+    :return: a list of the distinct voxel values for each mask, the distinct memberships (one row per membership)
+        and the index of the membership of each voxel (of the shape of the slab)
+    :rtype: tuple[list[numpy.ndarray], numpy.ndarray, numpy.ndarray]
+    """
+    from ..readers.mapreader import Map
+    voxel_values = list()
+    membership = None
+    shape = None
+    for index, mask in enumerate(masks):
+        slab = Map(mask, header_only=True).read_region(slice(start, stop))
+        shape = slab.shape
+        slab = slab.reshape(-1)
+        voxel_values.append(numpy.unique(slab))
+        if membership is None:
+            membership = numpy.zeros((slab.size, (len(masks) + 7) // 8), dtype=numpy.uint8)
+        membership[:, index // 8] |= (slab != 0).astype(numpy.uint8) << numpy.uint8(7 - index % 8)
+    memberships, indices = numpy.unique(membership, axis=0, return_inverse=True)
+    return voxel_values, memberships, indices.reshape(shape)
+
+
+def _memberships_no_overlap(args, memberships):
+    """Check that no membership has more than one mask, naming the first mask to overlap and the first mask it
+    overlaps (as when merging serially) followed by every overlapping pair of masks
+
+    :param args: parsed arguments
+    :type args: :py:class:`argparse.Namespace`
+    :param memberships: a boolean-valued array with one row for each distinct membership and one column per mask
+    :type memberships: :py:class:`numpy.ndarray`
+    :return: ``True`` if no masks overlap
+    :rtype: bool
+    """
+    memberships = numpy.asarray(memberships, dtype=numpy.int8)
+    # the masks that overlap a preceding mask in each membership
+    overlapping = (memberships == 1) & (numpy.cumsum(memberships, axis=1) > 1)
+    if overlapping.any():
+        index = int(numpy.flatnonzero(overlapping.any(axis=0))[0])
+        previous_index = int(numpy.flatnonzero(memberships[overlapping[:, index], :index].any(axis=0))[0])
+        print_date(f"error: segment overlap between mask {args.masks[index]} and {args.masks[previous_index]}")
+        _masks_no_overlap(args)
+        print_date("info: if overlapping segments are expected re-run with the --allow-overlap argument; "
+                   "see 'sff prep mergemask' for more information")
+        return False
+    return True
+
+
+def _mergemask_bit_planes(args) -> 'BitPlaneMergedMask':
+    """Merge the masks into a :py:class:`BitPlaneMergedMask` reading each mask only once
+
+    Each mask is checked to be binary as it is merged (unless ``args.skip_assessment``) while overlap is checked on
+    the distinct memberships once all masks are merged (unless ``args.allow_overlap``).
+
+    :param args: parsed arguments
+    :type args: :py:class:`argparse.Namespace`
+    :return: the merged mask or ``None`` if a mask failed a check
+    :rtype: :py:class:`BitPlaneMergedMask`
+    """
+    from ..readers.mapreader import Map
+    maps = [Map(mask, header_only=True) for mask in args.masks]
+    merged_mask = BitPlaneMergedMask((maps[0]._ns, maps[0]._nr, maps[0]._nc), len(args.masks))
+    section_bytes = maps[0]._nr * maps[0]._nc * maps[0]._voxel_size
+    sections_per_slab = max(1, int(args.slab_size * 2 ** 20) // (section_bytes or 1))
+    for mask, this_map in zip(args.masks, maps):
+        if args.verbose:
+            print_date(f"info: merging {mask}...")
+        try:
+            merged_mask.merge_slabs(
+                _checked_slabs(args, mask, this_map, None, None, sections_per_slab),
+                mask_name=pathlib.Path(mask).name
+            )
+        except ValueError as value_error:
+            print_date(f"error: {value_error}")
+            return None
+    if not args.allow_overlap and not _memberships_no_overlap(args, merged_mask.memberships):
+        return None
+    return merged_mask
+
+
+def _mergemask_parallel(args, data=None) -> 'MergedMask':
+    """Merge the masks on ``args.jobs`` processes, each working on a different slab of sections
+
+    The labels of a merged mask depend only on which combinations of masks (memberships) occur in the volume, not
+    on where they occur. We therefore read each mask once:
+
+    1.  each process finds the distinct memberships (and voxel values for the binary check) in its slab together
+        with the index of the membership of each voxel, which is written into the merged mask as it arrives;
+    2.  the memberships from all slabs are merged serially (one element per membership), which gives exactly the
+        same labels, ``label_tree`` and ``mask_to_label`` as merging the full volume;
+    3.  the membership indices in each slab of the merged mask are then replaced by the sums of the labels of the
+        masks in each membership.
+
+    :param args: parsed arguments
+    :type args: :py:class:`argparse.Namespace`
+    :param data: an optional ``int16`` array of the shape of the masks to write into (e.g. the data of a
+        memory-mapped output file); otherwise the merged mask is held in memory
+    :type data: :py:class:`numpy.ndarray`
+    :return: the merged mask or ``None`` if a mask failed a check
+    :rtype: :py:class:`MergedMask`
+    """
+    from ..readers.mapreader import Map
+    first_map = Map(args.masks[0], header_only=True)
+    if data is None:
+        data = numpy.zeros((first_map._ns, first_map._nr, first_map._nc), dtype=numpy.int16)
+    # a voxel needs one bit per mask (twice for sorting), the mask value and the membership index
+    voxel_bytes = 2 * ((len(args.masks) + 7) // 8) + first_map._voxel_size + 8
+    sections_per_slab = max(1, int(args.slab_size * 2 ** 20) // (first_map._nr * first_map._nc * voxel_bytes))
+    starts = list(range(0, first_map._ns, sections_per_slab))
+    stops = starts[1:] + [first_map._ns]
+    workers = min(args.jobs, pool_size(len(starts), 2 * int(args.slab_size * 2 ** 20)))
+    if args.verbose:
+        print_date(f"info: merging {len(starts)} slabs using {workers} worker(s)...")
+    slab_voxel_values = list()
+    slab_memberships = list()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        for start, (voxel_values, memberships, indices) in zip(
+                starts, executor.map(functools.partial(_slab_membership, args.masks), starts, stops)
+        ):
+            if len(memberships) > numpy.iinfo(data.dtype).max:
+                print_date(f"error: too many distinct overlaps of masks ({len(memberships)}) for {data.dtype} labels")
+                return None
+            data[start:start + len(indices)] = indices
+            slab_voxel_values.append(voxel_values)
+            slab_memberships.append(memberships)
+    if not args.skip_assessment:
+        for index, mask in enumerate(args.masks):
+            voxel_values = numpy.unique(numpy.concatenate([values[index] for values in slab_voxel_values]))
+            reason = _binary_mask_failure(voxel_values.tolist())
+            if reason is not None:
+                print_date(f"error: non-binary mask {mask}: {reason}")
+                return None
+    memberships = numpy.unique(numpy.concatenate(slab_memberships), axis=0)
+    memberships = numpy.unpackbits(memberships, axis=1)[:, :len(args.masks)]
+    if not args.allow_overlap and not _memberships_no_overlap(args, memberships):
+        return None
+    # reconcile: merge the memberships to get the labels
+    merged_mask = MergedMask(data=numpy.zeros(len(memberships), dtype=numpy.int16))
+    labels = list()
+    for index, mask in enumerate(args.masks):
+        labels.append(int(merged_mask.label))
+        merged_mask.merge_slabs([memberships[:, index]], mask_name=pathlib.Path(mask).name)
+    # the label of a membership is the sum of the labels of its masks
+    labels = numpy.array(labels, dtype=numpy.int64)
+    for start, stop, memberships in zip(starts, stops, slab_memberships):
+        membership_labels = numpy.unpackbits(memberships, axis=1)[:, :len(args.masks)] @ labels
+        data[start:stop] = membership_labels.astype(data.dtype)[data[start:stop]]
+    merged_mask.adopt_data(data)  # the labels now describe the whole volume
+    return merged_mask
+
+
+def _set_header_stats(mrc, sections_per_slab):
+    """Set the header statistics (dmin, dmax, dmean, rms) of an open MRC file one slab at a time
+
+    Unlike :py:meth:`mrcfile.mrcobject.MrcObject.update_header_stats` this never needs more than a slab of memory.
+    """
+    from ..readers.mapreader import MapStatistics
+    statistics = MapStatistics(
+        (mrc.data[section:section + sections_per_slab] for section in range(0, mrc.data.shape[0], sections_per_slab)),
+        mrc.data.dtype
+    )
+    mrc.header.dmin = statistics.min
+    mrc.header.dmax = statistics.max
+    mrc.header.dmean = statistics.mean
+    mrc.header.rms = statistics.rms
 
 
 def mergemask(args, configs):
-    """Merge two or more (max 255) masks into one with a distinct label for each mask
+    """Merge two or more masks into one with a distinct label for each mask
+
+    By default, labels are summed so that overlaps have labels that grow quickly (at most 255 masks); with
+    ``args.bit_planes`` the membership of each voxel is recorded instead which scales to many more masks.
 
     :param args: parsed arguments
     :type args: :py:class:`argparse.Namespace`
@@ -522,31 +1473,79 @@ def mergemask(args, configs):
         print_date("error: the file already exists; use --overwrite to overwrite the existing merged_mask or set a "
                    "new output prefix using --output-prefix")
         return 64
-    # ensure that the files are binary
+    # fail fast on a sample of each mask before reading any mask in full; every voxel is verified as it is merged
+    # anyway so a full assessment (--full-assessment) only helps to report every non-binary mask before merging
     if args.skip_assessment:
         print_date("info: skipping mask assessment; assuming all masks are binary...")
-    elif not _masks_all_binary(args, configs) and not args.skip:
-        print_date("error: one or more masks are non-binary; use --verbose to view details")
+    elif not _masks_all_binary(args, configs):
+        print_date("error: one or more masks are non-binary")
         return 65
     # todo: allow cases where one or more files are non-binary
-    # ensure that they don't overlap each other
-    if not _masks_no_overlap(args, configs) and not args.allow_overlap:
-        print_date("error: one or more masks overlap; use --verbose to view details")
-        print_date("info: if overlapping segments are expected re-run with the --allow-overlap argument; "
-                   "see 'sff prep mergemask' for more information")
-        return 65
-    # now we can merge masks
+    # now we can merge masks; every voxel is checked as it is merged
     if args.verbose:
         print_date("info: proceeding to merge masks...")
-    merged_mask = _mergemask(args.masks)
-    if args.verbose:
-        print_date("info: merge complete...")
-    if args.verbose:
-        print_date(f"info: attempting to write output to '{args.output_prefix}.{args.mask_extension}'...")
-    with mrcfile.new(f"{args.output_prefix}.{args.mask_extension}", overwrite=args.overwrite) as mrc:
-        with mrcfile.open(args.masks[0]) as one_mask:
-            mrc.set_data(merged_mask.data)
-            mrc.voxel_size = one_mask.voxel_size
+    if args.bit_planes:
+        merged_mask = _mergemask_bit_planes(args)
+        if merged_mask is None:
+            return 65
+        if args.verbose:
+            print_date("info: merge complete...")
+            print_date(f"info: attempting to write output to '{outfile}'...")
+        with mrcfile.open(args.masks[0], header_only=True) as one_mask:
+            voxel_size = one_mask.voxel_size
+        if args.out_of_core:
+            # the labels are written straight into the output file
+            with mrcfile.new_mmap(
+                    str(outfile), merged_mask.shape, mrc_mode=mrcfile.utils.mode_from_dtype(merged_mask.dtype),
+                    overwrite=args.overwrite
+            ) as mrc:
+                merged_mask.fill(mrc.data)
+                mrc.voxel_size = voxel_size
+                _set_header_stats(mrc, max(1, int(args.slab_size * 2 ** 20) // (mrc.data[0].nbytes or 1)))
+        else:
+            with mrcfile.new(str(outfile), overwrite=args.overwrite) as mrc:
+                mrc.set_data(merged_mask.data)
+                mrc.voxel_size = voxel_size
+    elif args.out_of_core:
+        # merge straight into the output file
+        with mrcfile.open(args.masks[0], header_only=True) as one_mask:
+            shape = int(one_mask.header.nz), int(one_mask.header.ny), int(one_mask.header.nx)
+            voxel_size = one_mask.voxel_size
+        if args.verbose:
+            print_date(f"info: merging into '{outfile}' without holding the merged mask in memory...")
+        mrc = mrcfile.new_mmap(
+            str(outfile), shape, mrc_mode=mrcfile.utils.mode_from_dtype(numpy.dtype(numpy.int16)), fill=0,
+            overwrite=args.overwrite
+        )
+        if args.jobs > 1:
+            merged_mask = _mergemask_parallel(args, data=mrc.data)
+        else:
+            merged_mask = _mergemask_single_pass(args, data=mrc.data)
+        if merged_mask is None:
+            mrc.close()
+            outfile.unlink()  # partial output
+            return 65
+        if args.verbose:
+            print_date("info: merge complete...")
+            print_date(f"info: attempting to finalise the header of '{outfile}'...")
+        mrc.voxel_size = voxel_size
+        _set_header_stats(mrc, max(1, int(args.slab_size * 2 ** 20) // (mrc.data[0].nbytes or 1)))
+        mrc.close()
+    else:
+        if args.jobs > 1:
+            merged_mask = _mergemask_parallel(args)
+        else:
+            merged_mask = _mergemask_single_pass(args)
+        if merged_mask is None:
+            return 65
+        if args.verbose:
+            print_date("info: merge complete...")
+        if args.verbose:
+            print_date(f"info: attempting to write output to '{args.output_prefix}.{args.mask_extension}'...")
+        with mrcfile.new(f"{args.output_prefix}.{args.mask_extension}", overwrite=args.overwrite) as mrc:
+            with mrcfile.open(args.masks[0], header_only=True) as one_mask:
+                mrc.set_data(merged_mask.data)
+                mrc.voxel_size = one_mask.voxel_size
     if args.verbose:
         print_date(f"info: attempting to write mask metadata below to '{args.output_prefix}.json'...")
     # create the mask metadata
@@ -563,6 +1562,129 @@ def mergemask(args, configs):
     return 0
 
 
+def _label_memberships(label_tree):
+    """Find the mask labels making up each label of a merged mask
+
+    A label that is a direct child of the root (``0``) belongs to one mask; any other label belongs to all the masks
+    of its parents, which may in turn be overlaps (when labels are summed) or masks (with bit-planes).
+
+    :param dict label_tree: the label tree written by :py:func:`mergemask`
+    :return: the set of mask labels for each label
+    :rtype: dict
+    """
+    memberships = dict()
+
+    def _members(label):
+        if label not in memberships:
+            parents = label_tree[str(label)]
+            if parents == 0:
+                memberships[label] = {label}
+            else:
+                memberships[label] = set().union(*(_members(int(parent)) for parent in parents))
+        return memberships[label]
+
+    for label in label_tree:
+        _members(int(label))
+    return memberships
+
+
+def _split_slab(lookup, mrc, section, indices):
+    """Write one slab of a split mask and return its number of foreground voxels"""
+    slab = lookup[indices]
+    mrc.data[section:section + len(slab)] = slab
+    return int(numpy.count_nonzero(slab))
+
+
+def splitmask(args, configs):
+    """Split a merged mask back into the binary masks it was merged from
+
+    Each label of the merged mask is expanded into the masks it belongs to using the label tree. This gives a
+    lookup table from labels to masks so that each slab of the merged mask is read once and every binary mask is
+    written from it by a vectorised lookup. The masks are written concurrently in a pool of threads.
+
+    :param args: parsed arguments
+    :type args: :py:class:`argparse.Namespace`
+    :param configs: configurations object
+    :type configs: :py:class:`sfftk.core.configs.Configs`
+    :return: exit status
+    :rtype: int
+    """
+    from ..readers.mapreader import Map
+    import contextlib
+    with open(args.label_tree) as label_tree_file:
+        mask_metadata = json.load(label_tree_file)
+    mask_to_label = mask_metadata['mask_to_label']
+    memberships = _label_memberships(mask_metadata['label_tree'])
+    if not memberships or not mask_to_label:
+        print_date(f"error: the label tree '{args.label_tree}' has no labels to split '{args.merged_mask}' by")
+        return 65
+    # the lookup tables: lookups[i][label - min_label] is 1 if the label belongs to the i-th mask
+    min_label = min([0, *memberships])
+    known_labels = numpy.zeros(max([0, *memberships]) - min_label + 1, dtype=bool)
+    known_labels[[label - min_label for label in memberships]] = True
+    known_labels[-min_label] = True  # background
+    lookups = list()
+    for mask_label in mask_to_label.values():
+        lookup = numpy.zeros(len(known_labels), dtype=numpy.int8)
+        lookup[[label - min_label for label, members in memberships.items() if mask_label in members]] = 1
+        lookups.append(lookup)
+    outfiles = list()
+    for mask_name in mask_to_label:
+        outfile = pathlib.Path(args.output_directory) / mask_name
+        if outfile.suffix.lower() not in ('.map', '.mrc', '.rec'):
+            outfile = outfile.with_name(f"{outfile.name}.mrc")
+        if not args.overwrite and outfile.exists():
+            print_date(f"error: the file '{outfile}' already exists; use --overwrite to overwrite it or set a new "
+                       f"output directory using --output-directory")
+            return 64
+        outfiles.append(outfile)
+    merged_map = Map(args.merged_mask, header_only=True)
+    shape = merged_map._ns, merged_map._nr, merged_map._nc
+    with mrcfile.open(args.merged_mask, header_only=True) as merged_mrc:
+        voxel_size = merged_mrc.voxel_size
+    sections_per_slab = max(1, int(args.slab_size * 2 ** 20) // (merged_map._nr * merged_map._nc * 8 or 1))
+    # each thread holds one slab of its mask
+    workers = pool_size(len(outfiles), sections_per_slab * merged_map._nr * merged_map._nc) if args.jobs is None \
+        else min(len(outfiles), args.jobs)
+    if args.verbose:
+        print_date(f"info: splitting '{args.merged_mask}' into {len(outfiles)} masks using {workers} thread(s)...")
+    voxel_counts = [0] * len(outfiles)
+    with contextlib.ExitStack() as stack:
+        mrcs = [
+            stack.enter_context(
+                mrcfile.new_mmap(
+                    str(outfile), shape, mrc_mode=mrcfile.utils.mode_from_dtype(numpy.dtype(numpy.int8)),
+                    overwrite=args.overwrite
+                )
+            ) for outfile in outfiles
+        ]
+        executor = stack.enter_context(concurrent.futures.ThreadPoolExecutor(max_workers=workers))
+        section = 0
+        for slab in merged_map.iter_slabs(sections_per_slab):
+            indices = slab.astype(numpy.int64) - min_label
+            if indices.min() < 0 or indices.max() >= len(known_labels) or not numpy.all(known_labels[indices]):
+                print_date(f"error: '{args.merged_mask}' has labels missing from '{args.label_tree}'")
+                stack.close()
+                for outfile in outfiles:
+                    outfile.unlink()  # partial output
+                return 65
+            split_slab = functools.partial(_split_slab, section=section, indices=indices)
+            for index, voxel_count in enumerate(executor.map(split_slab, lookups, mrcs)):
+                voxel_counts[index] += voxel_count
+            section += len(slab)
+        voxel_count = numpy.prod(shape, dtype=numpy.int64)
+        for mrc, mask_voxel_count in zip(mrcs, voxel_counts):
+            mrc.voxel_size = voxel_size
+            mrc.header.dmin = 0
+            mrc.header.dmax = 1 if mask_voxel_count else 0
+            mrc.header.dmean = mask_voxel_count / voxel_count
+            mrc.header.rms = numpy.sqrt(mrc.header.dmean * (1 - mrc.header.dmean))
+    if args.verbose:
+        for outfile, mask_voxel_count in zip(outfiles, voxel_counts):
+            print_date(f"info: wrote '{outfile}' ({mask_voxel_count} voxels)")
+    return 0
+
+
 class RelionCompositeStarReader(RelionStarReader):
     """Relion composite star file reader"""
     maximum_tomograms = None
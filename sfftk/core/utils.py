@@ -0,0 +1,40 @@
+"""
+``sfftk.core.utils``
+==========================
+
+This module consists of utilities shared by the other ``sfftk.core`` modules e.g. to size pools of workers.
+"""
+import os
+
+__author__ = 'Paul K. Korir, PhD'
+__email__ = 'pkorir@ebi.ac.uk, paul.korir@gmail.com'
+__date__ = '2026-10-17'
+
+
+def available_memory():
+    """The available physical memory in bytes or ``None`` if it cannot be determined"""
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def pool_size(task_count, task_memory):
+    """The number of workers to run a number of tasks concurrently
+
+    There are never more workers than tasks, usable CPUs or tasks that fit in the available memory.
+
+    :param int task_count: the number of tasks
+    :param int task_memory: an upper bound on the memory (in bytes) needed by each task
+    :return: the number of workers (at least one)
+    :rtype: int
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    workers = min(task_count, cpus)
+    memory = available_memory()
+    if memory is not None:
+        workers = min(workers, memory // task_memory)
+    return max(1, workers)
@@ -96,11 +96,12 @@ class IlastikSegmentation(object):
         # lattice
         segmentation.lattice_list = schema.SFFLatticeList()
         sections, rows, cols = self._segmentation.shape
+        start_sections, start_rows, start_cols = self._segmentation.start
         segmentation.lattice_list.append(
             schema.SFFLattice(
                 mode=_str(self._segmentation.dtype),
                 size=schema.SFFVolumeStructure(cols=cols, rows=rows, sections=sections),
-                start=schema.SFFVolumeIndex(cols=0, rows=0, sections=0),
+                start=schema.SFFVolumeIndex(cols=start_cols, rows=start_rows, sections=start_sections),
                 data=self._segmentation.data,
             )
         )
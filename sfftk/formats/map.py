@@ -14,6 +14,7 @@ import os
 import sys
 import warnings
 
+import numpy
 import sfftkrw.schema.adapter_v0_8_0_dev1 as schema
 from sfftkrw.core import _xrange
 from sfftkrw.core.print_tools import print_date, get_printable_ascii_string
@@ -27,6 +28,41 @@ __date__ = "2016-11-09"
 __updated__ = '2018-02-23'
 
 
+def _lattice_volume(header, map_obj, roi=None):
+    """The data, size and start of the lattice for a map
+
+    If a region of interest is given then only the voxels in the region are read and the start is shifted by the
+    offset of the region.
+
+    :param header: the annotation or header of the map
+    :param map_obj: the map object
+    :type map_obj: :py:class:`sfftk.readers.mapreader.Map`
+    :param tuple roi: an optional triple of slices (sections, rows, cols)
+    :return: the data, size and start of the lattice
+    :rtype: tuple(:py:class:`numpy.ndarray`, :py:class:`sfftkrw.SFFVolumeStructure`, :py:class:`sfftkrw.SFFVolumeIndex`)
+    """
+    if roi is None:
+        return (
+            map_obj.voxels,
+            schema.SFFVolumeStructure(cols=header.cols, rows=header.rows, sections=header.sections),
+            schema.SFFVolumeIndex(cols=header.start_cols, rows=header.start_rows, sections=header.start_sections),
+        )
+    data = map_obj.read_region(*roi)
+    sections, rows, cols = data.shape
+    start_sections, start_rows, start_cols = (
+        _slice.indices(length)[0] for _slice, length in zip(roi, (header.sections, header.rows, header.cols))
+    )
+    return (
+        data,
+        schema.SFFVolumeStructure(cols=cols, rows=rows, sections=sections),
+        schema.SFFVolumeIndex(
+            cols=header.start_cols + start_cols,
+            rows=header.start_rows + start_rows,
+            sections=header.start_sections + start_sections,
+        ),
+    )
+
+
 class MapAnnotation(Annotation):
     """Annotation class"""
 
@@ -39,10 +75,13 @@ class MapAnnotation(Annotation):
         for attr in dir(self._map_obj):
             if attr[:2] == "__":
                 continue
-            if inspect.ismethod(getattr(self._map_obj, attr)):
-                continue
             if attr == "voxels":  # leave the voxels for the volume
                 continue
+            # checked by name because merely getting these properties would read every voxel
+            if attr in ["is_mask", "statistics"]:
+                continue
+            if inspect.ismethod(getattr(self._map_obj, attr)):
+                continue
             setattr(self, attr, getattr(self._map_obj, attr))
 
     @property
@@ -199,10 +238,13 @@ class MapHeader(Header):
         for attr in dir(self._map_obj):
             if attr[:2] == "__":
                 continue
-            if inspect.ismethod(getattr(self._map_obj, attr)):
-                continue
             if attr == "voxels":  # leave the voxels for the volume
                 continue
+            # checked by name because merely getting these properties would read every voxel
+            if attr in ["is_mask", "statistics"]:
+                continue
+            if inspect.ismethod(getattr(self._map_obj, attr)):
+                continue
             setattr(self, attr, getattr(self._map_obj, attr))
 
     @property
@@ -380,10 +422,13 @@ class MaskAnnotation(Annotation):
         for attr in dir(self._map_obj):
             if attr[:2] == "__":
                 continue
-            if inspect.ismethod(getattr(self._map_obj, attr)):
-                continue
             if attr == "voxels":  # leave the voxels for the volume
                 continue
+            # checked by name because merely getting these properties would read every voxel
+            if attr in ["is_mask", "statistics"]:
+                continue
+            if inspect.ismethod(getattr(self._map_obj, attr)):
+                continue
             setattr(self, attr, getattr(self._map_obj, attr))
 
     @property
@@ -478,8 +523,9 @@ class MaskAnnotation(Annotation):
 class BinaryMaskSegment(Segment):
     """Class representing an individual binary mask segment"""
 
-    def __init__(self, map_obj):
+    def __init__(self, map_obj, roi=None):
         self._map_obj = map_obj
+        self._roi = roi
 
     @property
     def map_obj(self):
@@ -492,20 +538,14 @@ class BinaryMaskSegment(Segment):
 
     def convert(self):
         """Convert to a :py:class:`sfftkrw.SFFSegment` object"""
+        annotation = self.annotation
+        data, size, start = _lattice_volume(annotation, self._map_obj, roi=self._roi)
         lattice = schema.SFFLattice(
-            mode=self.annotation.mode,
-            endianness=self.annotation.endianness,
-            size=schema.SFFVolumeStructure(
-                cols=self.annotation.cols,
-                rows=self.annotation.rows,
-                sections=self.annotation.sections,
-            ),
-            start=schema.SFFVolumeIndex(
-                cols=self.annotation.start_cols,
-                rows=self.annotation.start_rows,
-                sections=self.annotation.start_sections,
-            ),
-            data=self._map_obj.voxels,
+            mode=annotation.mode,
+            endianness=annotation.endianness,
+            size=size,
+            start=start,
+            data=data,
         )
         segment = schema.SFFSegment()
         segment.biological_annotation, segment.colour = self.annotation.convert()
@@ -553,6 +593,43 @@ class MergedMaskSegment(Segment):
         return segment
 
 
+class MaskComponentSegment(Segment):
+    """Class representing a connected component of a binary mask"""
+
+    def __init__(self, label, lattice_id, map_obj, name=None):
+        self._label = label
+        self._lattice_id = lattice_id
+        self._map_obj = map_obj
+        self._name = name
+
+    @property
+    def label(self):
+        return self._label
+
+    @property
+    def lattice_id(self):
+        return self._lattice_id
+
+    @property
+    def map_obj(self):
+        return self._map_obj
+
+    @property
+    def annotation(self):
+        """Segment annotation"""
+        return MaskAnnotation(self._map_obj, name=self._name)
+
+    def convert(self):
+        """Convert to a :py:class:`sfftkrw.SFFSegment` object"""
+        segment = schema.SFFSegment()
+        segment.biological_annotation, segment.colour = self.annotation.convert()
+        segment.three_d_volume = schema.SFFThreeDVolume(
+            lattice_id=self.lattice_id,
+            value=self.label,
+        )
+        return segment
+
+
 class MaskHeader(Header):
     """Class representing mask header"""
 
@@ -562,10 +639,13 @@ class MaskHeader(Header):
         for attr in dir(self._map_obj):
             if attr[:2] == "__":
                 continue
-            if inspect.ismethod(getattr(self._map_obj, attr)):
-                continue
             if attr == "voxels":  # leave the voxels for the volume
                 continue
+            # checked by name because merely getting these properties would read every voxel
+            if attr in ["is_mask", "statistics"]:
+                continue
+            if inspect.ismethod(getattr(self._map_obj, attr)):
+                continue
             setattr(self, attr, getattr(self._map_obj, attr))
 
     @property
@@ -644,17 +724,52 @@ class BinaryMaskSegmentation(Segmentation):
         from sfftk.formats.map import BinaryMaskSegmentation
         map_seg = BinaryMaskSegmentation('binary_mask.mrc')
 
+    If a mask has many disconnected objects then each object may be made a segment of its own by labelling the
+    connected components of the mask: each mask then has one lattice of component labels.
+
+    .. code-block:: python
+
+        map_seg = BinaryMaskSegmentation(['binary_mask.mrc'], components=True)
     """
 
-    def __init__(self, fns, *args, **kwargs):
-        """Initialise a :py:class:`BinaryMaskSegmentation` object"""
-        self._fns = fns
+    def __init__(self, fns, *args, roi=None, components=False, connectivity=1, **kwargs):
+        """Initialise a :py:class:`BinaryMaskSegmentation` object
 
+        :param list fns: the binary mask files
+        :param tuple roi: an optional triple of slices (sections, rows, cols); only this region of each mask is read
+        :param bool components: make each connected component of each mask a segment [default: False]
+        :param int connectivity: neighbours up to this many steps away (1, 2 or 3) belong to the same component
+        """
+        self._fns = fns
+        self._roi = roi
+        self._components = components
+        if self._roi is not None:
+            kwargs['header_only'] = True  # the region is read on conversion
         # set the segmentation attribute
         self._segments = list()
+        self._lattices = list()
         # we will assume that these are homogeneous masks
         for file_index, file in enumerate(self._fns):
-            self._segments.append(BinaryMaskSegment(mapreader.get_data(file, *args, **kwargs)))
+            map_obj = mapreader.get_data(file, *args, **kwargs)
+            if self._components:
+                if self._roi is None:
+                    # slab by slab so that no more than a slab of the mask is read at a time
+                    _, size, start = _lattice_volume(MaskHeader(map_obj), map_obj)
+                    labels, count = map_obj.label_components(connectivity=connectivity)
+                else:
+                    data, size, start = _lattice_volume(MaskHeader(map_obj), map_obj, roi=self._roi)
+                    labels = numpy.zeros(data.shape, dtype=numpy.int32)
+                    count = mapreader.label_components([data], labels, connectivity=connectivity)
+                if count <= numpy.iinfo(numpy.int16).max:
+                    labels = labels.astype(numpy.int16)
+                self._lattices.append((map_obj, labels, size, start))
+                name = os.path.basename(file)
+                for label in range(1, count + 1):
+                    self._segments.append(
+                        MaskComponentSegment(label, file_index, map_obj, name=f"{name} component {label}")
+                    )
+            else:
+                self._segments.append(BinaryMaskSegment(map_obj, roi=self._roi))
 
     @property
     def header(self):
@@ -711,10 +826,25 @@ class BinaryMaskSegmentation(Segmentation):
 
         segment_list = schema.SFFSegmentList()
         lattice_list = schema.SFFLatticeList()
-        for s in self.segments:
-            segment, lattice = s.convert()
-            segment_list.append(segment)
-            lattice_list.append(lattice)
+        if self._components:
+            for lattice_id, (map_obj, labels, size, start) in enumerate(self._lattices):
+                lattice_list.append(
+                    schema.SFFLattice(
+                        id=lattice_id,
+                        mode=str(labels.dtype),
+                        endianness=MaskHeader(map_obj).endianness,
+                        size=size,
+                        start=start,
+                        data=labels,
+                    )
+                )
+            for s in self.segments:
+                segment_list.append(s.convert())
+        else:
+            for s in self.segments:
+                segment, lattice = s.convert()
+                segment_list.append(segment)
+                lattice_list.append(lattice)
 
         # finally pack everything together
         segmentation.segment_list = segment_list
@@ -733,12 +863,20 @@ class MergedMaskSegmentation(Segmentation):
         map_seg = MergedMaskSegmentation('merged_mask.mrc', label_tree='merged_mask.json')
     """
 
-    def __init__(self, fn, label_tree="merged_mask.json"):
-        """Initialise a :py:class:`BinaryMaskSegmentation` object"""
+    def __init__(self, fn, label_tree="merged_mask.json", *args, roi=None, **kwargs):
+        """Initialise a :py:class:`MergedMaskSegmentation` object
+
+        :param str fn: the merged mask file
+        :param str label_tree: the JSON file with the label tree
+        :param tuple roi: an optional triple of slices (sections, rows, cols); only this region of the mask is read
+        """
         self._fn = fn
         self._label_tree_fn = label_tree
+        self._roi = roi
+        if self._roi is not None:
+            kwargs['header_only'] = True  # the region is read on conversion
         # in this case we have only one lattice (merged_mask.mrc)
-        self._map_obj = mapreader.get_data(self._fn)  # there is only one file
+        self._map_obj = mapreader.get_data(self._fn, *args, **kwargs)  # there is only one file
         self._segments = list()
         # let's now unpack the labels
         with open(self._label_tree_fn) as f:
@@ -751,8 +889,8 @@ class MergedMaskSegmentation(Segmentation):
                     MergedMaskSegment(int(label), parent_label, self._map_obj, name=label_to_mask[int(label)])
                 )
             elif isinstance(parent_label, list):
-                l1, l2 = parent_label
-                name = f"Overlapping region between mask with label {l1} and {l2}"
+                *labels, last_label = parent_label  # bit-plane merged masks may have more than two parents
+                name = f"Overlapping region between mask with label {', '.join(map(str, labels))} and {last_label}"
                 # we will only store one parent even though this label is associated with two parents
                 # we can work out the other parent by subtracting the parent_id from the label_id=segment_id
                 # in this way, we can completely reconstruct the label tree from which we can,
@@ -820,21 +958,15 @@ class MergedMaskSegmentation(Segmentation):
 
         segment_list = schema.SFFSegmentList()
         lattice_list = schema.SFFLatticeList()
+        header = self.header
+        data, size, start = _lattice_volume(header, self._map_obj, roi=self._roi)
         lattice_list.append(
             schema.SFFLattice(
-                mode=self.header.mode,
-                endianness=self.header.endianness,
-                size=schema.SFFVolumeStructure(
-                    cols=self.header.cols,
-                    rows=self.header.rows,
-                    sections=self.header.sections,
-                ),
-                start=schema.SFFVolumeIndex(
-                    cols=self.header.start_cols,
-                    rows=self.header.start_rows,
-                    sections=self.header.start_sections,
-                ),
-                data=self._map_obj.voxels,
+                mode=header.mode,
+                endianness=header.endianness,
+                size=size,
+                start=start,
+                data=data,
             )
         )
         for s in self.segments:
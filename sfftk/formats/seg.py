@@ -186,9 +186,15 @@ class SeggerSegmentation(Segmentation):
         seg_seg = SeggerSegmentation('file.seg')
     """
 
-    def __init__(self, fn, top_level=True, *args, **kwargs):
-        """Initialise the reader"""
+    def __init__(self, fn, top_level=True, *args, roi=None, **kwargs):
+        """Initialise the reader
+
+        :param str fn: the name of the .seg file
+        :param bool top_level: only use the top-level (root) regions as segments
+        :param tuple roi: an optional triple of slices (sections, rows, cols) restricting the lattice to a sub-volume
+        """
         self._fn = fn
+        self._roi = roi
         self._segmentation = segreader.get_data(self._fn, *args, **kwargs)
         self._top_level = top_level
         if self._top_level:
@@ -247,14 +253,24 @@ class SeggerSegmentation(Segmentation):
         segmentation.segment_list = segments
         # lattice
         segmentation.lattice_list = schema.SFFLatticeList()
-        # check the order: c,r,s or r,c,s???
-        cols, rows, sections = self.header.map_size
+        if self._roi is None:
+            # check the order: c,r,s or r,c,s???
+            cols, rows, sections = self.header.map_size
+            start_sections, start_rows, start_cols = 0, 0, 0
+            data = self.header.simplified_mask
+        else:
+            # only the hyperslab is read from the file
+            data = self._segmentation.simplify_mask(self._segmentation.read_region(*self._roi))
+            sections, rows, cols = data.shape
+            start_sections, start_rows, start_cols = (
+                _slice.indices(length)[0] for _slice, length in zip(self._roi, self._segmentation.mask_shape)
+            )
         lattice = schema.SFFLattice(
             mode='uint32',
             endianness='little',
             size=schema.SFFVolumeStructure(cols=cols, rows=rows, sections=sections),
-            start=schema.SFFVolumeIndex(cols=0, rows=0, sections=0),
-            data=self.header.simplified_mask
+            start=schema.SFFVolumeIndex(cols=start_cols, rows=start_rows, sections=start_sections),
+            data=data
         )
         segmentation.lattice_list.append(lattice)
         # details
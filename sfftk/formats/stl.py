@@ -11,6 +11,7 @@ import sfftkrw.schema.adapter_v0_8_0_dev1 as schema
 from sfftkrw.core.print_tools import print_date
 
 from .base import Segmentation, Header, Segment, Annotation, Mesh
+from ..core.meshes import weld_vertices
 from ..readers import stlreader
 
 __author__ = "Paul K. Korir, PhD"
@@ -19,56 +20,39 @@ __date__ = "2016-11-11"
 
 
 class STLMesh(Mesh):
-    """Mesh class"""
+    """Mesh class
 
-    def __init__(self, vertices, polygons):
-        self._vertices = vertices
-        self._polygons = polygons
+    Vertices and triangles are kept as contiguous arrays (``float32`` and ``uint32``) all the way to the
+    :py:class:`sfftkrw.SFFMesh`; the conversions below do not copy arrays which already are.
+    """
+
+    def __init__(self, vertices, polygons, weld_tolerance=None):
+        self._vertices = numpy.ascontiguousarray(vertices, dtype=numpy.float32)
+        self._polygons = numpy.ascontiguousarray(polygons, dtype=numpy.uint32)
+        if weld_tolerance is not None:
+            self._vertices, self._polygons = weld_vertices(self._vertices, self._polygons, weld_tolerance)
 
     @property
     def vertices(self):
-        """Vertices in this mesh"""
+        """Vertices in this mesh (``shape = (N, 3)``)"""
         return self._vertices
 
     @property
     def polygons(self):
-        """Polygons in this mesh"""
+        """Polygons in this mesh (``shape = (M, 3)``) as rows of vertices"""
         return self._polygons
 
     def convert(self):
         """Convert to a :py:class:`sfftkrw.SFFMesh` object"""
-        # convert the dict to a list of 4-tuples where the first item is the key
-        indexed_vertices = sorted(((k, v[0], v[1], v[2]) for k, v in self.vertices.items()),
-                                  key=lambda v: v[0])
-        # validate vertices
-        # vertices are valid if len(vertices) == last_index + 1
-        # meaning? all vertices from 0 to last_index exist; no holes
-        try:
-            assert indexed_vertices[0][0] == 0 and len(indexed_vertices) == indexed_vertices[-1][0] + 1
-        except AssertionError:
-            raise ValueError("missing one or more vertices")
         # validate polygons/triangles
-        # now we know that all vertex indexes exist
-        _triangles = list(self.polygons.values())
-        # create triangles
-        triangles = numpy.array(_triangles)
-        vertex_ids = set(self.vertices.keys())
-        polygon_vertex_ids = set(triangles.flatten().tolist())
-        # validate polygons
-        # polygons are valid if all vertex IDs exists in the vertices dict
-        try:
-            assert vertex_ids == polygon_vertex_ids
-        except AssertionError:
+        # polygons are valid if they refer to no non-existent vertex
+        if self.polygons.size and self.polygons.max() >= len(self.vertices):
             raise ValueError(
                 "incompatible vertices and triangles due to reference(s) to non-existent vertex/vertices")
-        # create vertices
-        _vertices = numpy.array(indexed_vertices)
-        # indexed vertices had an extra column of the index value; now we delete that column
-        vertices = numpy.delete(_vertices, 0, axis=1)
         # now we can create the mesh
         mesh = schema.SFFMesh(
-            vertices=schema.SFFVertices.from_array(vertices),
-            triangles=schema.SFFTriangles.from_array(triangles)
+            vertices=schema.SFFVertices.from_array(self.vertices, mode='float32'),
+            triangles=schema.SFFTriangles.from_array(self.polygons, mode='uint32')
         )
         return mesh
 
@@ -93,10 +77,10 @@ class STLAnnotation(Annotation):
 class STLSegment(Segment):
     """Segment class"""
 
-    def __init__(self, name, vertices, polygons):
+    def __init__(self, name, vertices, polygons, weld_tolerance=None):
         self._name = name
-        self._vertices = vertices
-        self._polygons = polygons
+        # welding is done once here rather than on every access to the meshes
+        self._meshes = [STLMesh(vertices, polygons, weld_tolerance=weld_tolerance)]
 
     @property
     def name(self):
@@ -111,7 +95,7 @@ class STLSegment(Segment):
     @property
     def meshes(self):
         """Segment meshes"""
-        return [STLMesh(self._vertices, self._polygons)]
+        return self._meshes
 
     def convert(self):
         """Convert to a :py:class:`sfftkrw.SFFSegment` object"""
@@ -158,14 +142,20 @@ class STLSegmentation(Segmentation):
         stl_seg = STLSegmentation('file.stl')
     """
 
-    def __init__(self, fns, *args, **kwargs):
+    def __init__(self, fns, *args, weld_tolerance=None, **kwargs):
+        """Initialise an STLSegmentation object
+
+        :param list fns: STL file names
+        :param float weld_tolerance: merge vertices closer than this (see :py:func:`sfftk.core.meshes.weld_vertices`)
+            [default: None i.e. only identical vertices are merged]
+        """
         self._fns = fns
         self._segments = list()
         for fn in self._fns:
             print_date("{}: Stereolithography mesh".format(os.path.basename(fn)))
             segment = stlreader.get_data(fn, *args, **kwargs)
             for name, vertices, polygons in segment:
-                self._segments.append(STLSegment(name, vertices, polygons))
+                self._segments.append(STLSegment(name, vertices, polygons, weld_tolerance=weld_tolerance))
 
     @property
     def header(self):
@@ -11,6 +11,7 @@ import sfftkrw.schema.adapter_v0_8_0_dev1 as schema
 from sfftkrw.core import _xrange
 
 from .base import Segmentation, Header, Segment, Annotation, Mesh
+from ..core.meshes import weld_vertices
 from ..readers import surfreader
 
 __author__ = "Paul K. Korir, PhD"
@@ -21,9 +22,10 @@ __date__ = "2016-11-11"
 class AmiraHyperSurfaceMesh(Mesh):
     """Mesh class"""
 
-    def __init__(self, segment):
+    def __init__(self, segment, weld_tolerance=None):
         self._vertices = segment.vertices
         self._triangles = segment.triangles
+        self._weld_tolerance = weld_tolerance
 
     @property
     def vertices(self):
@@ -65,6 +67,8 @@ class AmiraHyperSurfaceMesh(Mesh):
         _vertices = numpy.array(indexed_vertices)
         # indexed vertices had an extra column of the index value; now we delete that column
         vertices = numpy.delete(_vertices, 0, axis=1)
+        if self._weld_tolerance is not None:
+            vertices, triangles = weld_vertices(vertices, triangles, self._weld_tolerance)
         mesh = schema.SFFMesh(
             vertices=schema.SFFVertices.from_array(vertices),
             triangles=schema.SFFTriangles.from_array(triangles)
@@ -111,12 +115,12 @@ class AmiraHyperSurfaceAnnotation(Annotation):
 class AmiraHyperSurfaceSegment(Segment):
     """Segment class"""
 
-    def __init__(self, segment):
+    def __init__(self, segment, weld_tolerance=None):
         self._segment = segment
         self._segment_id = segment[0].id
         self._annotation = AmiraHyperSurfaceAnnotation(segment)
         # meshes
-        self._meshes = [AmiraHyperSurfaceMesh(s) for s in self._segment]
+        self._meshes = [AmiraHyperSurfaceMesh(s, weld_tolerance=weld_tolerance) for s in self._segment]
 
     @property
     def id(self):
@@ -183,13 +187,19 @@ class AmiraHyperSurfaceSegmentation(Segmentation):
         surf_seg = AmiraHyperSurfaceSegmentation('file.surf')
     """
 
-    def __init__(self, fn):
+    def __init__(self, fn, weld_tolerance=None):
+        """Initialise an AmiraHyperSurfaceSegmentation object
+
+        :param str fn: the HyperSurface file name
+        :param float weld_tolerance: merge vertices closer than this (see :py:func:`sfftk.core.meshes.weld_vertices`)
+            [default: None]
+        """
         self._fn = fn
         header, segments = surfreader.get_data(self._fn)
         self._header = AmiraHyperSurfaceHeader(header)
         self._segments = list()
         for segment_id, segment in segments.items():
-            self._segments.append(AmiraHyperSurfaceSegment(segment))
+            self._segments.append(AmiraHyperSurfaceSegment(segment, weld_tolerance=weld_tolerance))
 
     @property
     def header(self):
@@ -105,12 +105,13 @@ class SuRVoSSegmentation(Segmentation):
         lattices = schema.SFFLatticeList()
         # the lattice
         sections, rows, cols = self._segmentation.data.shape
+        start_sections, start_rows, start_cols = self._segmentation.start
         # there is only one lattice
         lattice = schema.SFFLattice(
             mode='int8',  # we make it as small as practically possible; filled values are negative
             endianness='little',
             size=schema.SFFVolumeStructure(cols=cols, rows=rows, sections=sections),
-            start=schema.SFFVolumeIndex(cols=0, rows=0, sections=0),
+            start=schema.SFFVolumeIndex(cols=start_cols, rows=start_rows, sections=start_sections),
             data=self._segmentation.data,  # the numpy data is on the .data attribute
         )
         lattices.append(lattice)
@@ -11,14 +11,26 @@ import numpy
 class IlastikSegmentation(object):
     """Encapsulation of an Ilastik segmentation"""
 
-    def __init__(self, fn, dataset_name='exported_data', axis_order='zyxc', *args, **kwargs):
+    def __init__(self, fn, dataset_name='exported_data', axis_order='zyxc', *args, roi=None, **kwargs):
+        """Initialise the reader
+
+        :param str fn: the name of the HDF5 file
+        :param str dataset_name: the name of the dataset in the file
+        :param str axis_order: the order of the axes in the dataset
+        :param tuple roi: an optional triple of slices (sections, rows, cols); only this hyperslab is read
+        """
         self._fn = fn
         self._axis_order = axis_order
         self._dataset_name = dataset_name
         with h5py.File(fn, 'r') as h:
             self._size = h[dataset_name].size  # number of voxels
             self._dtype = h[dataset_name].dtype  # the data type of each voxel
-            self._data = h[dataset_name][()][:, :, :, 0].astype(int)
+            if roi is None:
+                self._data = h[dataset_name][:, :, :, 0].astype(int)
+                self._start = 0, 0, 0
+            else:
+                self._data = h[dataset_name][tuple(roi) + (0,)].astype(int)
+                self._start = tuple(_slice.indices(length)[0] for _slice, length in zip(roi, h[dataset_name].shape))
             self._shape = self._data.shape  # we don't use the shape provided directly
             self._len = h[dataset_name].len()  # the size of the first axis (usually z)
             # some attributes
@@ -41,6 +53,24 @@ class IlastikSegmentation(object):
     def shape(self):
         return self._shape
 
+    @property
+    def start(self):
+        """The index (sections, rows, cols) of the first voxel read"""
+        return self._start
+
+    def read_region(self, sections=None, rows=None, cols=None):
+        """Read a sub-volume as an HDF5 hyperslab
+
+        :param slice sections: the range of sections (z) [default: all]
+        :param slice rows: the range of rows (y) [default: all]
+        :param slice cols: the range of columns (x) [default: all]
+        :return: the region of shape ``(sections, rows, cols)``
+        :rtype: :py:class:`numpy.ndarray`
+        """
+        region = tuple(slice(None) if _slice is None else _slice for _slice in (sections, rows, cols))
+        with h5py.File(self._fn, 'r') as h:
+            return h[self._dataset_name][region + (0,)].astype(int)
+
     @property
     def num_images(self):
         return self._len
@@ -11,6 +11,7 @@ The following article is useful as it exposes many internals of map files:
 - ftp://ftp.wwpdb.org/pub/emdb/doc/Map-format/current/EMDB_map_format.pdf
 
 """
+import os
 import sys
 
 import numpy
@@ -20,92 +21,194 @@ __author__ = 'Paul K. Korir, PhD'
 __email__ = 'pkorir@ebi.ac.uk'
 __date__ = '2016-07-05'
 
+#: the default upper bound (in bytes) on the voxel data held by a single slab in :py:meth:`Map.iter_slabs`
+SLAB_BYTES = 2 ** 27
+
+
+class MapStatistics(object):
+    """Summary statistics of the voxels in a map
+
+    The statistics are accumulated in a single pass over slabs of sections so that at most one slab is ever held in
+    memory. For integer modes the voxels are histogrammed with :py:func:`numpy.bincount` and every statistic is
+    derived from the histogram; for floating point modes the moments are accumulated slab by slab and only the
+    smallest :py:attr:`MAX_FLOAT_VALUES` distinct values are kept, which is enough to tell a mask from a map without
+    holding every distinct value of a density map in memory.
+
+    :ivar values: the sorted distinct voxel values (for floating point modes at most :py:attr:`MAX_FLOAT_VALUES` of
+        the smallest)
+    :vartype values: :py:class:`numpy.ndarray`
+    :ivar bool values_complete: whether ``values`` holds every distinct voxel value
+    :ivar min: the smallest voxel value
+    :ivar max: the largest voxel value
+    :ivar float mean: the mean voxel value
+    :ivar float rms: the root-mean-square deviation from the mean
+    :ivar int nonzero_count: the number of non-zero voxels
+    :ivar int voxel_count: the number of voxels
+    """
+    #: the number of distinct values kept for floating point modes; one more than a mask can have
+    MAX_FLOAT_VALUES = 3
+
+    def __init__(self, slabs, dtype):
+        """Compute the statistics
+
+        :param slabs: an iterable of arrays all of the same type
+        :param dtype: the type of the voxels
+        :type dtype: :py:class:`numpy.dtype`
+        """
+        dtype = numpy.dtype(dtype)
+        if dtype.kind in 'iu':
+            info = numpy.iinfo(dtype)
+            counts = numpy.zeros(int(info.max) - int(info.min) + 1, dtype=numpy.int64)
+            for slab in slabs:
+                counts += numpy.bincount(
+                    (slab.astype(numpy.int64) - int(info.min)).ravel(), minlength=counts.size
+                )
+            present = numpy.flatnonzero(counts)
+            self.values = (present + int(info.min)).astype(dtype)
+            self.values_complete = True
+            counts = counts[present]
+            self.voxel_count = int(counts.sum())
+            self.nonzero_count = self.voxel_count - int(counts[self.values == 0].sum())
+            total = float(numpy.dot(counts, self.values.astype(numpy.float64)))
+            total_squares = float(numpy.dot(counts, self.values.astype(numpy.float64) ** 2))
+            if self.voxel_count == 0:
+                raise ValueError("no voxels")
+            self.min = self.values[0].item()
+            self.max = self.values[-1].item()
+        else:
+            values = numpy.array([], dtype=dtype)
+            self.values_complete = True
+            self.voxel_count = self.nonzero_count = 0
+            self.min = self.max = None
+            total = total_squares = 0.0
+            for slab in slabs:
+                if slab.size == 0:
+                    continue
+                values = numpy.union1d(values, numpy.unique(slab))
+                if values.size > self.MAX_FLOAT_VALUES:
+                    values = values[:self.MAX_FLOAT_VALUES]
+                    self.values_complete = False
+                slab_min, slab_max = slab.min().item(), slab.max().item()
+                self.min = slab_min if self.min is None else min(self.min, slab_min)
+                self.max = slab_max if self.max is None else max(self.max, slab_max)
+                self.voxel_count += slab.size
+                self.nonzero_count += int(numpy.count_nonzero(slab))
+                total += float(slab.sum(dtype=numpy.float64))
+                total_squares += float(numpy.square(slab, dtype=numpy.float64).sum())
+            self.values = values
+            if self.voxel_count == 0:
+                raise ValueError("no voxels")
+        self.mean = total / self.voxel_count
+        self.rms = max(total_squares / self.voxel_count - self.mean ** 2, 0.0) ** 0.5
+
+    def __repr__(self):
+        return "<MapStatistics: {}{} values; min={}, max={}, mean={}, rms={}, nonzero_count={}>".format(
+            len(self.values), '' if self.values_complete else '+', self.min, self.max, self.mean, self.rms, self.nonzero_count
+        )
+
 
 class Map(object):
     """Class to encapsulate a CCP4 mask"""
 
-    def __init__(self, fn, header_only=False, *args, **kwargs):
+    def __init__(self, fn, header_only=False, mmap=False, *args, **kwargs):
         """Initialise a Map object
 
         :param str fn: file name
         :param bool header_only: whether or not (default) to read the data
+        :param bool mmap: memory-map the voxel data read-only instead of reading it into memory [default: False]
         """
         self._fn = fn
         self._inverted = False
         with open(fn, 'rb') as f:
-            status = self.read(f, header_only=header_only)
+            status = self.read(f, header_only=header_only, mmap=mmap)
         # 0 is good
         assert status == 0
 
     def write(self, f):
         """Write data to an EMDB Map file
 
+        The header is packed once and the voxels are then streamed to the file one slab of sections at a time
+        directly from the array buffer (see :py:meth:`iter_slabs`) so that writing needs no more memory than a
+        single slab. This works equally for voxels held in memory, memory-mapped voxels and header-only maps (whose
+        voxels are read from the source file as they are written).
+
         :param file f: file object
         :return int status: 0 on success; fail otherwise
         """
+        f.write(self._pack_header())
+        f.write(self._extended_header)
+        for slab in self.iter_slabs():
+            # no copy unless the voxels are not already little-endian and of the type declared in the header
+            f.write(numpy.ascontiguousarray(slab, dtype=self.dtype).data)
+        f.flush()
+
+        return 0
+
+    def _pack_header(self):
+        """Pack the 1024-byte main header
+
+        :return: the header
+        :rtype: bytes
+        """
         import struct
 
-        string = struct.pack('<iii', self._nc, self._nr, self._ns)
-        string += struct.pack('<I', self._mode)
-        string += struct.pack('<iii', self._ncstart, self._nrstart, self._nsstart)
-        string += struct.pack('<iii', self._nx, self._ny, self._nz)
-        string += struct.pack('<fff', self._x_length, self._y_length, self._z_length)
-        string += struct.pack('<fff', self._alpha, self._beta, self._gamma)
-        string += struct.pack('<iii', self._mapc, self._mapr, self._maps)
-        string += struct.pack('<fff', self._amin, self._amax, self._amean)
-        string += struct.pack('<iii', self._ispg, self._nsymbt, self._lskflg)
-        string += struct.pack('<' + 'f' * (9), self._s11, self._s12, self._s13, self._s21, self._s22, self._s23,
-                              self._s31, self._s32, self._s33)
-        string += struct.pack('<fff', self._t1, self._t2, self._t3)
-        string += struct.pack('<15i', *self._extra)
-        # string += struct.pack('<4c', self._map)
-        # convert to bytes
-        string += _encode(self._map, 'utf-8')
-        string += _encode(self._machst, 'utf-8')
-        string += struct.pack('<f', self._rms)
+        header = [
+            struct.pack('<iii', self._nc, self._nr, self._ns),
+            struct.pack('<I', self._mode),
+            struct.pack('<iii', self._ncstart, self._nrstart, self._nsstart),
+            struct.pack('<iii', self._nx, self._ny, self._nz),
+            struct.pack('<fff', self._x_length, self._y_length, self._z_length),
+            struct.pack('<fff', self._alpha, self._beta, self._gamma),
+            struct.pack('<iii', self._mapc, self._mapr, self._maps),
+            struct.pack('<fff', self._amin, self._amax, self._amean),
+            struct.pack('<iii', self._ispg, self._nsymbt, self._lskflg),
+            struct.pack('<' + 'f' * (9), self._s11, self._s12, self._s13, self._s21, self._s22, self._s23,
+                        self._s31, self._s32, self._s33),
+            struct.pack('<fff', self._t1, self._t2, self._t3),
+            struct.pack('<15i', *self._extra),
+            # convert to bytes
+            _encode(self._map, 'utf-8'),
+            _encode(self._machst, 'utf-8'),
+            struct.pack('<f', self._rms),
+        ]
 
         # if inverted we will add one more label
         if self._inverted:
-            string += struct.pack('<i', self._nlabl + 1)
+            header.append(struct.pack('<i', self._nlabl + 1))
         else:
-            string += struct.pack('<i', self._nlabl)
+            header.append(struct.pack('<i', self._nlabl))
 
         for i in range(self._nlabl):
-            len_label = len(self.__getattribute__('_label_%s' % i))
-            encoding = _encode(self.__getattribute__('_label_{}'.format(i)), 'utf-8')
-            string += encoding
             # pack the remaining space
-            string += struct.pack('<{}x'.format(80 - len_label))
+            header.append(struct.pack('<80s', _encode(self.__getattribute__('_label_{}'.format(i)), 'utf-8')))
 
         if self._inverted:
             from datetime import datetime
             d = datetime.now()
-            string += _encode("{:<56}{:>24}".format(
+            header.append(_encode("{:<56}{:>24}".format(
                 "sfftk: inverted intensities",
                 d.strftime("%d-%b-%y  %H:%M:%S     ")
-            ), 'utf-8')
+            ), 'utf-8'))
 
+        header = b''.join(header)
         # pad up to full header of 1024 bytes
         try:
-            assert 1024 - len(string) >= 0
+            assert 1024 - len(header) >= 0
         except AssertionError:
             raise ValueError("Header is too long")
 
-        string += struct.pack(
-            '<' + str(1024 - len(string)) + 'x')  # dodgy line because we may need to move one byte forward or back
-
-        string += struct.pack('<' + self._voxel_type * self._voxel_count, *tuple(self._voxels))
+        return header + bytes(1024 - len(header))
 
-        f.write(string)
-        f.flush()
-
-        return 0
-
-    def read(self, f, header_only=False):
+    def read(self, f, header_only=False, mmap=False):
         """Read data from an EMDB Map mask
 
+        The voxels are never unpacked into Python objects: they are either read in a single call to
+        :py:func:`numpy.fromfile` or, if ``mmap=True``, exposed as a read-only :py:class:`numpy.memmap`
+        so that only the pages actually touched are ever loaded.
+
         :param file f: file object
         :param bool header_only: only read the header [default: False]
+        :param bool mmap: memory-map the voxel data instead of reading it [default: False]
         :return int status: 0 on success; fail otherwise
         """
         import struct
@@ -158,6 +261,9 @@ class Map(object):
             f.seek(1024)
         else:
             raise ValueError("Current byte position in file (%s) is past end of header (1024)" % f.tell())
+        # the data starts after the extended header (symmetry table), if any; keep it for writing
+        self._extended_header = f.read(self._nsymbt)
+        self._data_offset = 1024 + self._nsymbt
 
         if self._mode == 0:
             self._voxel_type = 'b'
@@ -174,41 +280,34 @@ class Map(object):
             raise ValueError("No support for complex floating point Fourier maps")
 
         # exit here for header only read
+        # voxel statistics are only computed on demand
+        self._statistics = None
         if header_only:
-            self._voxel_values = set()
             self._voxel_array = None
             return 0
 
-        #         import math
-
         self._voxel_count = self._nc * self._nr * self._ns
-        self._voxels = struct.unpack('<' + self._voxel_type * self._voxel_count,
-                                     f.read(self._voxel_count * self._voxel_size))
-        self._voxel_values = set(self._voxels)
-
-        import numpy
 
-        if self._voxel_type == 'b':
-            data_type = numpy.int8
-        elif self._voxel_type == 'h':
-            data_type = numpy.int16
-        elif self._voxel_type == 'f':
-            data_type = numpy.float32
-
-        self._voxel_array = numpy.array(self._voxels, dtype=data_type)
-        self._voxel_array.shape = self._ns, self._nr, self._nc
-
-        # we are done reading; let's make sure we are at the end
-
-        current_position = f.tell()  # where are we in the file
-        from os import SEEK_END
-        f.seek(0, SEEK_END)
-        final_position = f.tell()  # where the end really is
-
-        # ensure we are the end
-        if current_position != final_position:
+        # make sure that the file holds exactly as much data as the header claims
+        current_position = self._data_offset + self._voxel_count * self._voxel_size
+        final_position = os.fstat(f.fileno()).st_size
+        if current_position < final_position:
             raise ValueError("There is still some data (%s bytes) to read: current_position = %s; end_position = %s" % (
                 final_position - current_position, current_position, final_position))
+        elif current_position > final_position:
+            raise ValueError("Missing data (%s bytes): expected end_position = %s; actual end_position = %s" % (
+                current_position - final_position, current_position, final_position))
+
+        if mmap:
+            self._voxel_array = numpy.memmap(
+                f, dtype=self.dtype, mode='r', offset=self._data_offset, shape=(self._ns, self._nr, self._nc)
+            )
+        else:
+            f.seek(self._data_offset)
+            self._voxel_array = numpy.fromfile(f, dtype=self.dtype, count=self._voxel_count)
+            self._voxel_array.shape = self._ns, self._nr, self._nc
+        # a flat view (no copy) of the voxels in file order
+        self._voxels = self._voxel_array.reshape(-1)
 
         return 0
 
@@ -351,13 +450,138 @@ class Map(object):
         """The voxel mask"""
         return self._voxel_array
 
+    @property
+    def dtype(self):
+        """The little-endian :py:class:`numpy.dtype` of each voxel as stored in the file"""
+        return numpy.dtype('<' + self._voxel_type)
+
+    @property
+    def statistics(self):
+        """Voxel statistics computed in a single slab-wise pass the first time they are needed
+
+        :rtype: :py:class:`MapStatistics`
+        """
+        if self._statistics is None:
+            self._statistics = MapStatistics(self.iter_slabs(), self.dtype)
+        return self._statistics
+
+    def iter_slabs(self, n_sections=None):
+        """Iterate over consecutive blocks of sections (the slowest-changing axis)
+
+        If the voxels were not read (``header_only=True``) each slab is read straight from disk so that only
+        one slab is ever held in memory; otherwise, slabs are views of the (possibly memory-mapped) voxels.
+
+        .. code-block:: python
+
+            my_map = Map('mask.mrc', header_only=True)
+            for slab in my_map.iter_slabs(16):
+                print(slab.shape) # (16, rows, cols) except possibly the last slab
+
+        :param int n_sections: the number of sections per slab [default: as many as fit into ``SLAB_BYTES``]
+        :return: a generator of :py:class:`numpy.ndarray` objects of shape ``(sections, rows, cols)``
+        """
+        section_size = self._nr * self._nc
+        if n_sections is None:
+            n_sections = max(1, SLAB_BYTES // max(1, section_size * self._voxel_size))
+        if n_sections < 1:
+            raise ValueError("invalid number of sections per slab: {}".format(n_sections))
+        if self._voxel_array is not None:
+            for section in _xrange(0, self._ns, n_sections):
+                yield self._voxel_array[section:section + n_sections]
+            return
+        with open(self._fn, 'rb') as f:
+            f.seek(self._data_offset)
+            for section in _xrange(0, self._ns, n_sections):
+                sections = min(n_sections, self._ns - section)
+                slab = numpy.fromfile(f, dtype=self.dtype, count=sections * section_size)
+                if slab.size != sections * section_size:
+                    raise ValueError("Missing data: expected {} voxels at section {} but only found {}".format(
+                        sections * section_size, section, slab.size))
+                slab.shape = sections, self._nr, self._nc
+                yield slab
+
+    def read_region(self, sections=None, rows=None, cols=None):
+        """Read an arbitrary sub-volume
+
+        If the voxels were not read (``header_only=True``) the file is memory-mapped and the region is extracted by
+        strided access so that only the pages spanned by the region are read from disk.
+
+        .. code-block:: python
+
+            my_map = Map('mask.mrc', header_only=True)
+            region = my_map.read_region(slice(10, 20), slice(0, 64), slice(32, None))
+
+        :param slice sections: the range of sections (z) [default: all]
+        :param slice rows: the range of rows (y) [default: all]
+        :param slice cols: the range of columns (x) [default: all]
+        :return: a copy of the region of shape ``(sections, rows, cols)``
+        :rtype: :py:class:`numpy.ndarray`
+        """
+        region = tuple(slice(None) if _slice is None else _slice for _slice in (sections, rows, cols))
+        data = self._read_voxels(region)
+        if data.size == 0:
+            raise ValueError("empty region: sections={}, rows={}, cols={}".format(*region))
+        return data
+
+    def read_sections(self, indices):
+        """Read an arbitrary (e.g. random) selection of whole sections
+
+        As with :py:meth:`read_region`, only the selected sections are read from disk if the voxels were not read.
+
+        :param indices: the indices of the sections
+        :type indices: list[int] or :py:class:`numpy.ndarray`
+        :return: a copy of the sections of shape ``(len(indices), rows, cols)``
+        :rtype: :py:class:`numpy.ndarray`
+        """
+        return self._read_voxels(numpy.asarray(indices, dtype=int))
+
+    def label_components(self, out=None, connectivity=1, n_sections=None):
+        """Label the connected components of the non-zero voxels one slab at a time
+
+        See :py:func:`label_components`.
+
+        :param out: an optional integer array of the shape of the map for the labels [default: a new ``int32``
+            array]
+        :type out: :py:class:`numpy.ndarray`
+        :param int connectivity: neighbours up to this many steps away (1, 2 or 3) belong to the same component
+        :param int n_sections: the number of sections per slab [default: as many as fit into ``SLAB_BYTES``]
+        :return: the labels and the number of components
+        :rtype: tuple(:py:class:`numpy.ndarray`, int)
+        """
+        if out is None:
+            out = numpy.zeros((self._ns, self._nr, self._nc), dtype=numpy.int32)
+        return out, label_components(self.iter_slabs(n_sections), out, connectivity=connectivity)
+
+    def _read_voxels(self, index):
+        """Copy out the voxels selected by ``index`` reading from a memory map of the file if the voxels were not
+        read"""
+        if self._voxel_array is not None:
+            return numpy.array(self._voxel_array[index])
+        voxels = numpy.memmap(
+            self._fn, dtype=self.dtype, mode='r', offset=self._data_offset, shape=(self._ns, self._nr, self._nc)
+        )
+        data = numpy.array(voxels[index])
+        del voxels
+        return data
+
     @property
     def is_mask(self):
         """Determine if this is a mask or not
 
+        Unless the statistics are already known the voxel values are collected slab by slab, stopping as soon as a
+        third value is found.
+
         :return bool status: mask or not
         """
-        if len(self._voxel_values) == 2 and 0.0 in self._voxel_values:
+        if self._statistics is not None:
+            voxel_values = set(self._statistics.values.tolist())
+        else:
+            voxel_values = set()
+            for slab in self.iter_slabs():
+                voxel_values.update(numpy.unique(slab).tolist())
+                if len(voxel_values) > 2:
+                    return False
+        if len(voxel_values) == 2 and 0.0 in voxel_values:
             return True
         else:
             return False
@@ -378,18 +602,19 @@ class Map(object):
         # round values
         import numpy
         self._voxel_array = numpy.around(self._voxel_array, decimals=1)
-        self._voxel_values = set(self._voxel_array.flatten().tolist())
+        voxel_values = numpy.unique(self._voxel_array).tolist()
 
-        if len(self._voxel_values) > voxel_values_threshold:
-            raise ValueError("Unfixable mask: too many values ({0:,}) > {1}!".format(len(self._voxel_values),
+        if len(voxel_values) > voxel_values_threshold:
+            raise ValueError("Unfixable mask: too many values ({0:,}) > {1}!".format(len(voxel_values),
                                                                                      voxel_values_threshold))
         else:
-            for value in self._voxel_values:
+            for value in voxel_values:
                 if value != 0.0:  # only modify masked regions
                     self._voxel_array = (self._voxel_array == value) * mask_value
 
-        # reset voxel_values list
-        self._voxel_values = set(self._voxel_array.flatten().tolist())
+        # the voxels have changed
+        self._voxels = self._voxel_array.reshape(-1)
+        self._statistics = None
 
     def invert(self):
         """Invert the map file (mask or not)"""
@@ -402,7 +627,8 @@ class Map(object):
         self._amax = self._voxel_array.max()
         self._amean = self._voxel_array.mean()
 
-        self._voxels = self._voxel_array.flatten().tolist()
+        self._voxels = self._voxel_array.reshape(-1)
+        self._statistics = None
         self._inverted = True
 
     @property
@@ -466,6 +692,80 @@ class Map(object):
         ]).reshape(3, 4)
 
 
+def label_components(slabs, out, connectivity=1):
+    """Label the connected components of the non-zero voxels of a volume given as consecutive slabs of sections
+
+    Each slab is labelled with :py:func:`scipy.ndimage.label` and written into ``out`` with provisional labels that
+    are unique across slabs. Components that touch across the seam between consecutive slabs are then merged
+    (union-find over the provisional labels using :py:func:`scipy.sparse.csgraph.connected_components`) and ``out``
+    is relabelled one slab at a time so that the components are numbered ``1, 2, ...`` in the order in which they
+    are first met. Only one slab and the last section of the previous slab are held in memory beyond ``out``.
+
+    .. code-block:: python
+
+        my_map = Map('mask.mrc', header_only=True)
+        labels = numpy.zeros((my_map._ns, my_map._nr, my_map._nc), dtype=numpy.int32)
+        count = label_components(my_map.iter_slabs(), labels)
+
+    :param slabs: an iterable of consecutive slabs of the volume
+    :param out: an integer array of the shape of the volume (e.g. a memory map) for the labels
+    :type out: :py:class:`numpy.ndarray`
+    :param int connectivity: neighbours up to this many steps away (1, 2 or 3) belong to the same component
+        [default: 1 (faces)]
+    :return: the number of components
+    :rtype: int
+    """
+    from scipy import ndimage, sparse
+    from scipy.sparse import csgraph
+    structure = ndimage.generate_binary_structure(3, connectivity)
+    # a voxel touches these in-plane offsets in the previous section
+    seam_offsets = [(row - 1, col - 1) for row, col in zip(*numpy.nonzero(structure[0]))]
+    count = 0
+    slab_bounds = list()
+    seam_edges = list()
+    previous_section = None
+    section = 0
+    for slab in slabs:
+        labels, slab_count = ndimage.label(slab, structure=structure)
+        out_slab = out[section:section + len(slab)]
+        out_slab[...] = labels
+        numpy.add(out_slab, count, out=out_slab, where=labels > 0)
+        if previous_section is not None:
+            first_section = out_slab[0]
+            rows, cols = first_section.shape
+            for row_offset, col_offset in seam_offsets:
+                row_slice = slice(max(0, -row_offset), rows - max(0, row_offset))
+                col_slice = slice(max(0, -col_offset), cols - max(0, col_offset))
+                before = previous_section[row_slice, col_slice]
+                after = first_section[
+                    row_slice.start + row_offset:row_slice.stop + row_offset,
+                    col_slice.start + col_offset:col_slice.stop + col_offset
+                ]
+                touching = (before > 0) & (after > 0)
+                seam_edges.append(numpy.stack([before[touching], after[touching]], axis=1))
+        previous_section = numpy.array(out_slab[-1])
+        slab_bounds.append((section, section + len(slab)))
+        count += slab_count
+        section += len(slab)
+    if seam_edges:
+        edges = numpy.unique(numpy.concatenate(seam_edges), axis=0)
+    else:
+        edges = numpy.empty((0, 2), dtype=numpy.int64)
+    graph = sparse.coo_matrix(
+        (numpy.ones(len(edges), dtype=numpy.int8), (edges[:, 0], edges[:, 1])), shape=(count + 1, count + 1)
+    )
+    _, roots = csgraph.connected_components(graph, directed=False)
+    # number the merged components in the order of their first provisional label
+    _, first_labels, inverse = numpy.unique(roots[1:], return_index=True, return_inverse=True)
+    ranks = numpy.empty(len(first_labels), dtype=numpy.int64)
+    ranks[numpy.argsort(first_labels)] = numpy.arange(1, len(first_labels) + 1)
+    lookup = numpy.zeros(count + 1, dtype=out.dtype)
+    lookup[1:] = ranks[inverse]
+    for start, stop in slab_bounds:
+        out[start:stop] = lookup[out[start:stop]]
+    return len(first_labels)
+
+
 def get_data(fn, inverted=False, *args, **kwargs):
     """Get structured data from EMDB Map file
 
@@ -182,6 +182,23 @@ class SeggerSegmentation(object):
         """The mask (TM)"""
         return self._seg_handler['mask'][()]
 
+    @property
+    def mask_shape(self):
+        """The shape of the mask (sections, rows, cols) without reading it"""
+        return self._seg_handler['mask'].shape
+
+    def read_region(self, sections=None, rows=None, cols=None):
+        """Read a sub-volume of the mask as an HDF5 hyperslab
+
+        :param slice sections: the range of sections (z) [default: all]
+        :param slice rows: the range of rows (y) [default: all]
+        :param slice cols: the range of columns (x) [default: all]
+        :return: the region of shape ``(sections, rows, cols)``
+        :rtype: :py:class:`numpy.ndarray`
+        """
+        region = tuple(slice(None) if _slice is None else _slice for _slice in (sections, rows, cols))
+        return self._seg_handler['mask'][region]
+
     def simplify_mask(self, mask, replace=True):
         """Simplify the mask by replacing all `region_ids` with their `root_parent_id`
 
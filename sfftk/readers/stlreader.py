@@ -6,57 +6,77 @@ Ad hoc reader for Stereolithography (STL) files
 
 - Depends on the `numpy-stl` package
 
-- Reads both ASCII and binary files
+- Reads both ASCII and binary files; binary files are memory-mapped directly
 """
 import os
 
-from sfftkrw.core import _dict
+import numpy
 
 __author__ = 'Paul K. Korir, PhD'
 __email__ = 'pkorir@ebi.ac.uk, paul.korir@gmail.com'
 __date__ = '2016-08-09'
 __updated__ = '2018-02-14'
 
+#: a binary STL facet: the normal, three vertices and two attribute bytes (50 bytes)
+STL_FACET_DTYPE = numpy.dtype([('normal', '<f4', (3,)), ('vectors', '<f4', (3, 3)), ('attributes', '<u2')])
+#: the bytes before the facets of a binary STL file: an 80 byte header and the facet count
+STL_HEADER_BYTES = 84
+#: the number of facets of a binary STL file read at a time by :py:func:`compute_bounding_box`
+FACETS_PER_CHUNK = 2 ** 20
+
+
+def _binary_facets(fn):
+    """Memory-map the facets of a binary STL file
+
+    A file is binary if its size agrees with the facet count in its header; ASCII files (and malformed binary files)
+    are left to `numpy-stl`.
+
+    :param str fn: filename
+    :return: a read-only structured array of :py:data:`STL_FACET_DTYPE` or `None` if the file is not binary
+    :rtype: :py:class:`numpy.memmap`
+    """
+    size = os.path.getsize(fn)
+    if size < STL_HEADER_BYTES:
+        return None
+    with open(fn, 'rb') as stl_file:
+        stl_file.seek(STL_HEADER_BYTES - 4)
+        facet_count = int(numpy.frombuffer(stl_file.read(4), dtype='<u4')[0])
+    if size != STL_HEADER_BYTES + facet_count * STL_FACET_DTYPE.itemsize:
+        return None
+    if facet_count == 0:  # empty files cannot be mapped
+        return numpy.zeros(0, dtype=STL_FACET_DTYPE)
+    return numpy.memmap(fn, dtype=STL_FACET_DTYPE, mode='r', offset=STL_HEADER_BYTES, shape=(facet_count,))
+
 
 def get_data(fn):
     """Get data from an StL file
 
+    Each facet repeats its corners so we identify the distinct vertices of a mesh with a single
+    :py:func:`numpy.unique` over all corners; the inverse indices are the triangles.
+
     :param str fn: filename
-    :return: a `generator` of meshes; each mesh is a `tuple` of a name, a `dict` of vertices indexed by `vertex_id`
-        and a `dict` of polygons referring to vertices by `vertex_id`
-    :rtype: tuple
+    :return: a `list` of meshes; each mesh is a `tuple` of a name, a :py:class:`numpy.ndarray` of ``float32``
+        vertices (``shape = (N, 3)``) and a :py:class:`numpy.ndarray` of ``uint32`` triangles (``shape = (M, 3)``)
+        referring to vertices by their row
+    :rtype: list
     """
     from stl import mesh
 
     #     stl_meshes = [mesh.Mesh.from_file(fn)]
     meshes = list()
-    stl_meshes = mesh.Mesh.from_multi_file(fn)
+    facets = _binary_facets(fn)
+    if facets is not None:  # a binary file holds a single mesh
+        vectors = [facets['vectors']]
+    else:
+        vectors = (stl_mesh.vectors for stl_mesh in mesh.Mesh.from_multi_file(fn))
     mesh_id = 0
-    for stl_mesh in stl_meshes:
-        vertex_ids = _dict()
-        polygons = _dict()
-        vertex_id = 0
-        polygon_id = 0
-        for facet in stl_mesh.vectors:
-            v0, v1, v2 = facet
-            if tuple(v0) not in vertex_ids:
-                vertex_ids[tuple(v0)] = vertex_id
-                vertex_id += 1
-            if tuple(v1) not in vertex_ids:
-                vertex_ids[tuple(v1)] = vertex_id
-                vertex_id += 1
-            if tuple(v2) not in vertex_ids:
-                vertex_ids[tuple(v2)] = vertex_id
-                vertex_id += 1
-
-            polygons[polygon_id] = vertex_ids[tuple(v0)], vertex_ids[tuple(v1)], vertex_ids[tuple(v2)]
-            polygon_id += 1
-
-        # we now need to reverse the vertex_ids dict
-        vertices = _dict(zip(vertex_ids.values(), vertex_ids.keys()))
-
+    for mesh_vectors in vectors:
+        vertices, triangles = numpy.unique(
+            mesh_vectors.reshape(-1, 3).astype(numpy.float32), axis=0, return_inverse=True
+        )
+        triangles = triangles.astype(numpy.uint32).reshape(-1, 3)
         name = "{}#{}".format(os.path.basename(fn), mesh_id)
-        meshes.append((name, vertices, polygons))
+        meshes.append((name, vertices, triangles))
     return meshes
 
 
@@ -65,11 +85,23 @@ def compute_bounding_box(fn):
 
     Required to check that the transform has correctly aligned the segmentation with the image
 
+    The facets of binary files are streamed in chunks of :py:data:`FACETS_PER_CHUNK` so that the mesh is never held
+    in memory.
+
     :param str fn: filename
     :return: a `list` of `tuple`s of the form `((x_min, y_min, z_min), (x_max, y_max, z_max))`
     :rtype: list
     """
-    from stl import mesh
-    my_stl = mesh.Mesh.from_file(fn)
-    bounds_min, bound_max = my_stl.min_, my_stl.max_
+    facets = _binary_facets(fn)
+    if facets is None:
+        from stl import mesh
+        my_stl = mesh.Mesh.from_file(fn)
+        bounds_min, bound_max = my_stl.min_, my_stl.max_
+        return list(zip(bounds_min, bound_max))
+    bounds_min = numpy.full(3, numpy.inf, dtype=numpy.float32)
+    bound_max = numpy.full(3, -numpy.inf, dtype=numpy.float32)
+    for start in range(0, len(facets), FACETS_PER_CHUNK):
+        vertices = facets['vectors'][start:start + FACETS_PER_CHUNK].reshape(-1, 3)
+        numpy.minimum(bounds_min, vertices.min(axis=0), out=bounds_min)
+        numpy.maximum(bound_max, vertices.max(axis=0), out=bound_max)
     return list(zip(bounds_min, bound_max))
@@ -16,7 +16,14 @@ class SuRVoSSegmentation(object):
     no textual information is saved in segmentation.
     """
 
-    def __init__(self, fn, dataset='/data', mask_value=1):
+    def __init__(self, fn, dataset='/data', mask_value=1, roi=None):
+        """Initialise the reader
+
+        :param str fn: the name of the HDF5 file
+        :param str dataset: the path to the dataset in the file
+        :param int mask_value: the value used to mark segment voxels
+        :param tuple roi: an optional triple of slices (sections, rows, cols); only this hyperslab is read
+        """
         self._fn = fn
         self._dataset = dataset
         self._mask_value = mask_value
@@ -24,7 +31,12 @@ class SuRVoSSegmentation(object):
         self._colours = list()
         self._names = list()
         with h5py.File(fn, 'r') as s:
-            self._data = s[self._dataset][()].astype(int)
+            if roi is None:
+                self._data = s[self._dataset][()].astype(int)
+                self._start = 0, 0, 0
+            else:
+                self._data = s[self._dataset][tuple(roi)].astype(int)
+                self._start = tuple(_slice.indices(length)[0] for _slice, length in zip(roi, s[self._dataset].shape))
             if "label" in s[self._dataset].attrs:
                 self._labels = list(map(int, s[self._dataset].attrs["label"]))
             else:
@@ -44,6 +56,24 @@ class SuRVoSSegmentation(object):
         """The shape of the segmentation volume"""
         return self._data.shape
 
+    @property
+    def start(self):
+        """The index (sections, rows, cols) of the first voxel read"""
+        return self._start
+
+    def read_region(self, sections=None, rows=None, cols=None):
+        """Read a sub-volume as an HDF5 hyperslab
+
+        :param slice sections: the range of sections (z) [default: all]
+        :param slice rows: the range of rows (y) [default: all]
+        :param slice cols: the range of columns (x) [default: all]
+        :return: the region of shape ``(sections, rows, cols)``
+        :rtype: :py:class:`numpy.ndarray`
+        """
+        region = tuple(slice(None) if _slice is None else _slice for _slice in (sections, rows, cols))
+        with h5py.File(self._fn, 'r') as s:
+            return s[self._dataset][region].astype(int)
+
     def segment_ids(self):
         """Returns a frozenset of segment IDs"""
         return frozenset(self._labels)
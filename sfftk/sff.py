@@ -33,6 +33,22 @@ def handle_prep_mergemask(args, configs):
     return 65
 
 
+def handle_prep_splitmask(args, configs):
+    """Handle `prep splitmask`
+
+    :param args: parsed arguments
+    :type args: :py:class:`argparse.Namespace`
+    :param configs: configurations object
+    :type configs: :py:class:`sfftk.core.configs.Configs`
+    :return exit_status: exit status
+    :rtype exit_status: int
+    """
+    if re.search(r'.*\.(map|mrc|rec)$', args.merged_mask, re.IGNORECASE):
+        from .core.prep import splitmask
+        return splitmask(args, configs)
+    return 65
+
+
 def handle_prep_starsplit(args, configs):
     """Handle `prep starsplit`
 
@@ -82,7 +98,8 @@ def handle_prep(args, configs):
             print_date("No prep protocol for file type {}".format(args.from_file))
             return 65
     elif args.prep_subcommand == 'transform':
-        if re.match(r'.*\.(stl)$', args.from_file, re.IGNORECASE):
+        from_files = args.from_file if isinstance(args.from_file, list) else [args.from_file]
+        if all(re.match(r'.*\.(stl|map|mrc|rec)$', from_file, re.IGNORECASE) for from_file in from_files):
             from .core.prep import transform
             return transform(args, configs)
         else:
@@ -90,6 +107,8 @@ def handle_prep(args, configs):
             return 65
     elif args.prep_subcommand == 'mergemask':
         return handle_prep_mergemask(args, configs)
+    elif args.prep_subcommand == 'splitmask':
+        return handle_prep_splitmask(args, configs)
     elif args.prep_subcommand == 'starsplit':
         return handle_prep_starsplit(args, configs)
     elif args.prep_subcommand == 'starcrop':
@@ -121,10 +140,13 @@ def handle_convert(args, configs):  # @UnusedVariable
         if args.multi_file:
             if re.match(r'.*\.(map|mrc|rec)$', args.from_file[0], re.IGNORECASE):
                 from .formats.map import BinaryMaskSegmentation
-                seg = BinaryMaskSegmentation(args.from_file)
+                seg = BinaryMaskSegmentation(
+                    args.from_file, mmap=True, roi=args.roi, components=args.components,
+                    connectivity=args.connectivity
+                )
             elif re.match(r'.*\.stl$', args.from_file[0], re.IGNORECASE):
                 from .formats.stl import STLSegmentation
-                seg = STLSegmentation(args.from_file)
+                seg = STLSegmentation(args.from_file, weld_tolerance=args.weld_tolerance)
             elif re.match(r'.*\.star$', args.from_file[0], re.IGNORECASE):
                 from .formats.star import RelionMultiStarSegmentation
                 seg = RelionMultiStarSegmentation(
@@ -149,20 +171,23 @@ def handle_convert(args, configs):  # @UnusedVariable
                     print_date("Created IMODSegmentation object")
             elif re.match(r'.*\.seg$', args.from_file, re.IGNORECASE):
                 from .formats.seg import SeggerSegmentation
-                seg = SeggerSegmentation(args.from_file, top_level=not args.all_levels)
+                seg = SeggerSegmentation(args.from_file, top_level=not args.all_levels, roi=args.roi)
             elif re.match(r'.*\.surf$', args.from_file, re.IGNORECASE):
                 from sfftk.formats.surf import AmiraHyperSurfaceSegmentation
-                seg = AmiraHyperSurfaceSegmentation(args.from_file)
+                seg = AmiraHyperSurfaceSegmentation(args.from_file, weld_tolerance=args.weld_tolerance)
             elif re.match(r'.*\.am$', args.from_file, re.IGNORECASE):
                 from .formats.am import AmiraMeshSegmentation
                 seg = AmiraMeshSegmentation(args.from_file)
             elif re.match(r'.*\.(map|mrc|rec)$', args.from_file, re.IGNORECASE):
                 if args.label_tree is not None:  # merged mask
                     from .formats.map import MergedMaskSegmentation
-                    seg = MergedMaskSegmentation(args.from_file, label_tree=args.label_tree)
+                    seg = MergedMaskSegmentation(args.from_file, label_tree=args.label_tree, mmap=True, roi=args.roi)
                 else:  # single binary mask
                     from .formats.map import BinaryMaskSegmentation
-                    seg = BinaryMaskSegmentation([args.from_file])
+                    seg = BinaryMaskSegmentation(
+                        [args.from_file], mmap=True, roi=args.roi, components=args.components,
+                        connectivity=args.connectivity
+                    )
             elif re.match(r'.*\.star$', args.from_file, re.IGNORECASE):
                 from .formats.star import RelionStarSegmentation
                 seg = RelionStarSegmentation(
@@ -174,7 +199,7 @@ def handle_convert(args, configs):  # @UnusedVariable
                 )
             elif re.match(r'.*\.stl$', args.from_file, re.IGNORECASE):
                 from .formats.stl import STLSegmentation
-                seg = STLSegmentation([args.from_file])
+                seg = STLSegmentation([args.from_file], weld_tolerance=args.weld_tolerance)
             elif re.match(r'.*\.h5$', args.from_file, re.IGNORECASE):
                 ext = _get_file_extension(args.from_file)
                 # this is how we handle extension disambiguation
@@ -182,10 +207,10 @@ def handle_convert(args, configs):  # @UnusedVariable
                 if args.subtype_index > -1:
                     if args.subtype_index == 0:
                         from .formats.survos import SuRVoSSegmentation
-                        seg = SuRVoSSegmentation(args.from_file)
+                        seg = SuRVoSSegmentation(args.from_file, roi=args.roi)
                     elif args.subtype_index == 1:
                         from .formats.ilastik import IlastikSegmentation
-                        seg = IlastikSegmentation(args.from_file)
+                        seg = IlastikSegmentation(args.from_file, roi=args.roi)
                 else:
                     print_date("Ambiguous file extension '{ext}'. Please select the right type or use the "
                                "--subtype-index <value> option".format(ext=ext))
@@ -199,10 +224,21 @@ def handle_convert(args, configs):  # @UnusedVariable
             transform = compute_transform(args.image)
         sff_seg = seg.convert(details=args.details, verbose=args.verbose,
                               transform=transform)  # convert according to args
+        if args.decimate is not None:
+            from .core.meshes import decimate_segmentation
+            decimate_segmentation(sff_seg, args.decimate, jobs=args.jobs, verbose=args.verbose)
         # export as args.format
         if args.verbose:
             print_date("Exporting to {}".format(args.output))
         sff_seg.export(args.output, args)
+        # each level of detail halves the previous
+        for level in range(1, args.lods + 1):
+            decimate_segmentation(sff_seg, 0.5, jobs=args.jobs, verbose=args.verbose)
+            root, ext = os.path.splitext(args.output)
+            lod_output = f"{root}_lod{level}{ext}"
+            if args.verbose:
+                print_date("Exporting level of detail {} to {}".format(level, lod_output))
+            sff_seg.export(lod_output, args)
         if args.verbose:
             print_date("Done")
 
@@ -2,6 +2,7 @@
 Unit tests for :py:mod:`sfftk.core` package
 """
 import argparse
+import concurrent.futures
 import contextlib
 import json
 import os
@@ -12,6 +13,7 @@ import shutil
 import sys
 import unittest
 from io import StringIO
+from unittest import mock
 
 import mrcfile
 import numpy
@@ -565,6 +567,20 @@ class TestCoreParserPrepBinmap(Py23FixTestCase):
         args, _ = cli('prep binmap --negate file.map')
         self.assertTrue(args.negate)
 
+    def test_contour_levels(self):
+        """Test that we can set several contour levels"""
+        args, _ = cli('prep binmap file.map')
+        self.assertIsNone(args.contour_levels)
+        args, _ = cli('prep binmap file.map -C 0.1 0.5 1.2')
+        self.assertEqual([0.1, 0.5, 1.2], args.contour_levels)
+        # must be increasing
+        args, _ = cli('prep binmap file.map -C 0.5 0.1')
+        self.assertEqual(64, args)
+        args, _ = cli('prep binmap --negate file.map -C 0.1 0.5')
+        self.assertEqual(64, args)
+        args, _ = cli('prep binmap --components file.map -C 0.1 0.5')
+        self.assertEqual(64, args)
+
     def test_bytes_per_voxel(self):
         """Test that we can set bytes per voxel"""
         bytes_per_voxel = random.choice([1, 2, 4, 8, 16])
@@ -665,6 +681,27 @@ class TestCoreParserPrepTransform(Py23FixTestCase):
         self.assertEqual(args.infix, 'something')
         self.assertEqual(args.output, 'file_something.stl')
 
+    def test_many_files(self):
+        """Test transforming several files at once"""
+        args, _ = parse_args('prep transform --lengths 10 10 10 --indices 5 5 5 -j 2 file1.stl file2.stl',
+                             use_shlex=True)
+        self.assertEqual(args.from_file, ['file1.stl', 'file2.stl'])
+        self.assertEqual(args.output, ['file1_transformed.stl', 'file2_transformed.stl'])
+        self.assertEqual(args.jobs, 2)
+        # no single output for many files
+        args, _ = parse_args('prep transform --lengths 10 10 10 --indices 5 5 5 -o my_file.stl file1.stl file2.stl',
+                             use_shlex=True)
+        self.assertEqual(args, 64)
+        args, _ = parse_args('prep transform --lengths 10 10 10 --indices 5 5 5 file1.stl file2.abc',
+                             use_shlex=True)
+        self.assertEqual(args, 64)
+        args, _ = parse_args('prep transform --lengths 10 10 10 --indices 5 5 5 -j 0 file1.stl', use_shlex=True)
+        self.assertEqual(args, 64)
+        args, _ = parse_args('prep transform --lengths 10 10 10 --indices 5 5 5 --overwrite mask.mrc file.stl',
+                             use_shlex=True)
+        self.assertEqual(args.output, ['mask_transformed.mrc', 'file_transformed.stl'])
+        self.assertTrue(args.overwrite)
+
 
 class TestCoreParserPrepStarSplit(Py23FixTestCase):
     def test_default(self):
@@ -941,6 +978,66 @@ class TestCoreParserConvert(Py23FixTestCase):
         with self.assertRaises(SystemExit):
             cli(f"convert {self.test_merged_mask_file} -m --label-tree {self.test_merged_mask_labels_file}")
 
+    def test_roi(self):
+        """Test that we can specify a region of interest for volume segmentations"""
+        args, _ = cli(f'convert {self.test_merged_mask_file} --label-tree {self.test_merged_mask_labels_file} '
+                      f'--roi 2:10,:5,3:')
+        self.assertEqual((slice(2, 10), slice(None, 5), slice(3, None)), args.roi)
+        args, _ = cli(f'convert {self.test_seg_file} --roi ,,')
+        self.assertEqual((slice(None),) * 3, args.roi)
+        # malformed and empty ranges
+        self.assertEqual(64, cli(f'convert {self.test_seg_file} --roi 2:10,5')[0])
+        self.assertEqual(64, cli(f'convert {self.test_seg_file} --roi 2:10,a:b,:')[0])
+        self.assertEqual(64, cli(f'convert {self.test_seg_file} --roi 10:2,:,:')[0])
+        # ranges outside the volume
+        with mock.patch('sfftk.core.parser.print_date') as print_date:
+            self.assertEqual(64, cli(f'convert {self.test_merged_mask_file} --label-tree '
+                                     f'{self.test_merged_mask_labels_file} --roi 20:30,:,:')[0])
+        self.assertRegex(print_date.call_args[0][0], r"--roi: range '20:30' lies outside the volume of shape \(10, ")
+        self.assertEqual(64, cli(f'convert {self.test_seg_file} --roi :,:,100000:')[0])
+        ilastik_file = TEST_DATA_PATH / 'segmentations' / 'test_data_ilastik.h5'
+        self.assertEqual(64, cli(f'convert {ilastik_file} --subtype-index 1 --roi 100000:,:,:')[0])
+        args, _ = cli(f'convert {ilastik_file} --subtype-index 1 --roi 0:2,:,:')
+        self.assertEqual((slice(0, 2), slice(None), slice(None)), args.roi)
+        # only the region of a single mask is checked to be binary
+        from ..readers.mapreader import Map
+        mask_file = TEST_DATA_PATH / 'segmentations' / 'test_data_multi0.map'
+        with mock.patch.object(Map, 'iter_slabs') as iter_slabs:
+            args, _ = cli(f'convert {mask_file} --roi 2:5,:,:')
+        iter_slabs.assert_not_called()
+        self.assertEqual((slice(2, 5), slice(None), slice(None)), args.roi)
+        self.assertEqual(65, cli(f'convert {self.test_merged_mask_file} --roi 2:5,:,:')[0])
+        # non-volume formats
+        self.assertEqual(64, cli(f'convert {self.test_data_file} --roi :,:,:')[0])
+
+    def test_weld_tolerance(self):
+        """Test setting the tolerance for welding mesh vertices"""
+        stl_file = TEST_DATA_PATH / 'segmentations' / 'test_data_binary.stl'
+        args, _ = cli(f'convert {stl_file} --weld-tolerance 0.01')
+        self.assertEqual(0.01, args.weld_tolerance)
+        args, _ = cli(f'convert {stl_file}')
+        self.assertIsNone(args.weld_tolerance)
+        self.assertEqual(64, cli(f'convert {stl_file} --weld-tolerance 0')[0])
+        # only for meshes
+        self.assertEqual(64, cli(f'convert {self.test_seg_file} --weld-tolerance 0.01')[0])
+
+    def test_decimate(self):
+        """Test setting mesh decimation"""
+        stl_file = TEST_DATA_PATH / 'segmentations' / 'test_data_binary.stl'
+        args, _ = cli(f'convert {stl_file} --decimate 0.25 --lods 2 -j 2')
+        self.assertEqual(0.25, args.decimate)
+        self.assertEqual(2, args.lods)
+        self.assertEqual(2, args.jobs)
+        args, _ = cli(f'convert {stl_file} --decimate 1000')
+        self.assertEqual(1000, args.decimate)
+        self.assertIsInstance(args.decimate, int)
+        self.assertEqual(0, args.lods)
+        for value in ['0', '1.5', '-3', 'many']:
+            self.assertEqual(64, cli(f'convert {stl_file} --decimate {value}')[0])
+        self.assertEqual(64, cli(f'convert {stl_file} --lods 2')[0])
+        # only for meshes
+        self.assertEqual(64, cli(f'convert {self.test_seg_file} --decimate 0.5')[0])
+
     def test_star(self):
         """Test convertion of .star file"""
         args, _ = cli(
@@ -2051,6 +2148,78 @@ class TestCoreUtils(Py23FixTestCase):
         self.assertEqual(configs['__TEMP_FILE'], './temp-annotated.json')
         self.assertEqual(configs['__TEMP_FILE_REF'], '@')
 
+    def test_pool_size(self):
+        """Test that the number of workers is bounded by the tasks, CPUs and available memory"""
+        from ..core.utils import pool_size
+        with mock.patch('sfftk.core.utils.os.sched_getaffinity', return_value=set(range(8)), create=True):
+            with mock.patch('sfftk.core.utils.available_memory', return_value=10 * 2 ** 30):
+                self.assertEqual(3, pool_size(3, 2 ** 20))
+                self.assertEqual(8, pool_size(200, 2 ** 20))
+                self.assertEqual(5, pool_size(200, 2 ** 31))
+                self.assertEqual(1, pool_size(200, 2 ** 40))
+            with mock.patch('sfftk.core.utils.available_memory', return_value=None):
+                self.assertEqual(8, pool_size(200, 2 ** 40))
+
+
+class TestCoreMeshes(Py23FixTestCase):
+    def test_weld_vertices(self):
+        """Test that vertices within the tolerance are merged"""
+        from scipy.sparse import csgraph
+        from ..core.meshes import weld_vertices
+        # a random mesh as a triangle soup with noisy repeated vertices
+        vertices = (numpy.random.rand(200, 3) * 10).astype(numpy.float32)
+        triangles = numpy.array([numpy.random.choice(200, 3, replace=False) for _ in range(400)])
+        soup = vertices[triangles].reshape(-1, 3) + numpy.random.normal(0, 1e-5, (1200, 3)).astype(numpy.float32)
+        welded_vertices, welded_triangles = weld_vertices(soup, numpy.arange(1200).reshape(-1, 3), 1e-3)
+        self.assertEqual(numpy.uint32, welded_triangles.dtype)
+        self.assertEqual(len(numpy.unique(triangles)), len(welded_vertices))
+        self.assertEqual(triangles.shape, welded_triangles.shape)
+        self.assertTrue(numpy.allclose(vertices[triangles], welded_vertices[welded_triangles], atol=1e-4))
+        # the same groups as comparing all pairs
+        distances = numpy.linalg.norm(soup[:, numpy.newaxis] - soup[numpy.newaxis], axis=2)
+        count, _ = csgraph.connected_components(distances <= 1e-3, directed=False)
+        self.assertEqual(count, len(welded_vertices))
+        # collapsed triangles are dropped
+        welded_vertices, welded_triangles = weld_vertices(
+            numpy.array([[0, 0, 0], [1, 0, 0], [0, 1, 0], [0, 1e-4, 0]], dtype=numpy.float32),
+            numpy.array([[0, 1, 2], [0, 2, 3]]), 1e-3
+        )
+        self.assertEqual(3, len(welded_vertices))
+        self.assertTrue(numpy.array_equal([[0, 1, 2]], welded_triangles))
+
+    def test_decimate_mesh(self):
+        """Test that decimation simplifies a closed mesh keeping its shape"""
+        from scipy.spatial import ConvexHull
+        from ..core.meshes import decimate_mesh, vertex_normals
+        # a triangulated sphere
+        points = numpy.random.normal(size=(2000, 3))
+        points /= numpy.linalg.norm(points, axis=1)[:, numpy.newaxis]
+        triangles = ConvexHull(points).simplices
+        vertices, decimated = decimate_mesh(points, triangles, 500)
+        self.assertEqual(numpy.float32, vertices.dtype)
+        self.assertEqual(numpy.uint32, decimated.dtype)
+        self.assertLessEqual(len(decimated), 500)
+        self.assertGreater(len(decimated), 400)
+        self.assertEqual(numpy.arange(len(vertices)).tolist(), numpy.unique(decimated).tolist())
+        # still closed: every edge has two triangles
+        edges = numpy.sort(decimated[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2), axis=1)
+        _, counts = numpy.unique(edges, axis=0, return_counts=True)
+        self.assertEqual({2}, set(counts.tolist()))
+        self.assertTrue(numpy.allclose(1, numpy.linalg.norm(vertices, axis=1), atol=0.05))
+        normals = vertex_normals(vertices, decimated)
+        self.assertTrue(numpy.allclose(1, numpy.linalg.norm(normals, axis=1)))
+        # an open grid keeps its boundary and area
+        grid = numpy.arange(400).reshape(20, 20)
+        a, b, c, d = grid[:-1, :-1].ravel(), grid[1:, :-1].ravel(), grid[1:, 1:].ravel(), grid[:-1, 1:].ravel()
+        triangles = numpy.concatenate([numpy.stack([a, b, c], axis=1), numpy.stack([a, c, d], axis=1)])
+        points = numpy.stack([*numpy.divmod(numpy.arange(400), 20), numpy.zeros(400)], axis=1).astype(float)
+        vertices, decimated = decimate_mesh(points, triangles, 100)
+        self.assertLessEqual(len(decimated), 100)
+        self.assertTrue(numpy.allclose([[0, 0, 0], [19, 19, 0]], [vertices.min(axis=0), vertices.max(axis=0)]))
+        corners = vertices[decimated]
+        areas = numpy.linalg.norm(numpy.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]), axis=1)
+        self.assertAlmostEqual(19 * 19, areas.sum() / 2, places=3)
+
 
 class TestCorePrep(Py23FixTestCase):
     def test_binmap_default(self):
@@ -2063,6 +2232,178 @@ class TestCorePrep(Py23FixTestCase):
         # clean up
         os.remove(TEST_DATA_PATH / 'segmentations' / 'test_data_prep.map')
 
+    def test_binmap_slabs(self):
+        """Test that binarising slab by slab gives the same result as binarising the whole volume"""
+        test_map_file = TEST_DATA_PATH / 'segmentations' / 'test_unfixable_mask.map'
+        output = TEST_DATA_PATH / 'segmentations' / 'test_unfixable_mask_binned.map'
+        args, _ = cli(f"prep binmap --contour-level 0.5 --mask-value 3 --jobs 3 --output {output} {test_map_file}")
+        self.assertEqual(3, args.jobs)
+        # force many slabs: one section is 46 * 46 * 4 bytes
+        with mock.patch('sfftk.core.prep.SLAB_BYTES', 46 * 46 * 4 * 5):
+            ex_st = bin_map(args, _)
+        self.assertEqual(ex_st, 0)
+        with mrcfile.open(test_map_file) as original, mrcfile.open(output) as binned:
+            expected = ((original.data > 0.5) * 3).astype(numpy.int8)
+            self.assertEqual(numpy.int8, binned.data.dtype)
+            self.assertTrue(numpy.array_equal(expected, binned.data))
+            for field in ('cella', 'origin', 'nxstart', 'nystart', 'nzstart', 'mapc', 'mapr', 'maps'):
+                self.assertEqual(original.header[field].tolist(), binned.header[field].tolist())
+            self.assertEqual(expected.min(), binned.header.dmin)
+            self.assertEqual(expected.max(), binned.header.dmax)
+            self.assertAlmostEqual(expected.mean(), binned.header.dmean, places=5)
+            self.assertAlmostEqual(expected.std(), binned.header.rms, places=5)
+        # we don't overwrite without --overwrite
+        self.assertEqual(65, bin_map(args, _))
+        os.remove(output)
+        # negated
+        args, _ = cli(f"prep binmap --contour-level 0.5 --negate --output {output} {test_map_file}")
+        self.assertEqual(0, bin_map(args, _))
+        with mrcfile.open(test_map_file) as original, mrcfile.open(output) as binned:
+            self.assertTrue(numpy.array_equal((original.data < 0.5).astype(numpy.int8), binned.data))
+        os.remove(output)
+        args, _ = cli(f"prep binmap --jobs 0 {test_map_file}")
+        self.assertEqual(64, args)
+
+    def test_binmap_contour_levels(self):
+        """Test labelling about several contour levels in one pass"""
+        test_map_file = TEST_DATA_PATH / 'segmentations' / 'test_unfixable_mask.map'
+        output = TEST_DATA_PATH / 'segmentations' / 'test_unfixable_mask_labelled.map'
+        args, _ = cli(f"prep binmap --output {output} {test_map_file} --contour-levels 0.2 0.5 0.8")
+        with mock.patch('sfftk.core.prep.SLAB_BYTES', 46 * 46 * 4 * 5):
+            self.assertEqual(0, bin_map(args, _))
+        with mrcfile.open(test_map_file) as original, mrcfile.open(output) as labelled:
+            expected = sum((original.data > level).astype(numpy.int8) for level in (0.2, 0.5, 0.8))
+            self.assertTrue(numpy.array_equal(expected, labelled.data))
+            self.assertEqual(expected.min(), labelled.header.dmin)
+            self.assertEqual(expected.max(), labelled.header.dmax)
+            self.assertAlmostEqual(expected.mean(), labelled.header.dmean, places=5)
+            self.assertAlmostEqual(expected.std(), labelled.header.rms, places=5)
+        os.remove(output)
+
+    def test_binmap_components(self):
+        """Test labelling the connected components of the binarised map"""
+        from scipy import ndimage
+        test_map_file = TEST_DATA_PATH / 'segmentations' / 'test_unfixable_mask.map'
+        output = TEST_DATA_PATH / 'segmentations' / 'test_unfixable_mask_components.map'
+        args, _ = cli(f"prep binmap --contour-level 0.5 --components --connectivity 3 --output {output} "
+                      f"{test_map_file}")
+        # force many slabs so that components span the seams
+        with mock.patch('sfftk.core.prep.SLAB_BYTES', 46 * 46 * 4 * 5):
+            self.assertEqual(0, bin_map(args, _))
+        with mrcfile.open(test_map_file) as original, mrcfile.open(output) as labelled:
+            expected, count = ndimage.label(original.data > 0.5, structure=numpy.ones((3, 3, 3)))
+            self.assertTrue(numpy.array_equal(expected, labelled.data))
+            self.assertEqual(count, labelled.header.dmax)
+            self.assertEqual(original.header.cella.tolist(), labelled.header.cella.tolist())
+        with open(output.with_suffix('.json')) as label_file:
+            mask_metadata = json.load(label_file)
+        self.assertEqual({str(label): 0 for label in range(1, count + 1)}, mask_metadata['label_tree'])
+        self.assertEqual(count, len(mask_metadata['mask_to_label']))
+        os.remove(output)
+        os.remove(output.with_suffix('.json'))
+
+    def test_binmap_bin_factor(self):
+        """Test downsampling a map"""
+        from ..core.prep import _majority
+        self.assertEqual([2, 1, 0], _majority(numpy.array([[2, 0, 2, 1], [1, 1, 3, 3], [0, 0, 0, 0]])).tolist())
+        test_map_file = TEST_DATA_PATH / 'segmentations' / 'test_unfixable_mask.map'
+        output = TEST_DATA_PATH / 'segmentations' / 'test_unfixable_mask_binned.map'
+        args, _ = cli(f"prep binmap --bin-factor 4 --output {output} {test_map_file}")
+        self.assertIsNone(args.pooling)
+        with mock.patch('sfftk.core.prep.SLAB_BYTES', 46 * 46 * 4 * 5):
+            self.assertEqual(0, bin_map(args, _))
+        with mrcfile.open(test_map_file) as original, mrcfile.open(output) as binned:
+            # 46 is not a multiple of 4 so the last two voxels along each axis are dropped
+            self.assertEqual((11, 11, 11), binned.data.shape)
+            expected = original.data[:44, :44, :44].reshape(11, 4, 11, 4, 11, 4).mean(axis=(1, 3, 5))
+            self.assertTrue(numpy.allclose(expected, binned.data))
+            self.assertEqual(numpy.float32, binned.data.dtype)
+            for axis in 'xyz':
+                self.assertAlmostEqual(original.voxel_size[axis] * 4, binned.voxel_size[axis], places=4)
+            self.assertAlmostEqual(expected.max(), binned.header.dmax, places=5)
+        os.remove(output)
+        # masks are pooled by maximum or majority
+        mask_file = TEST_DATA_PATH / 'segmentations' / 'test_data_multi0.map'
+        for pooling in ('max', 'majority'):
+            args, _ = cli(f"prep binmap --bin-factor 2 --pooling {pooling} --output {output} {mask_file}")
+            self.assertEqual(0, bin_map(args, _))
+            with mrcfile.open(mask_file) as original, mrcfile.open(output) as binned:
+                blocks = original.data.reshape(18, 2, 15, 2, 16, 2).transpose(0, 2, 4, 1, 3, 5).reshape(-1, 8)
+                if pooling == 'max':
+                    expected = blocks.max(axis=1)
+                else:
+                    expected = (blocks.sum(axis=1) > 4).astype(original.data.dtype)  # ties go to zero
+                self.assertEqual(original.data.dtype, binned.data.dtype)
+                self.assertTrue(numpy.array_equal(expected.reshape(18, 15, 16), binned.data))
+            os.remove(output)
+        args, _ = cli(f"prep binmap --bin-factor 1 {mask_file}")
+        self.assertEqual(64, args)
+        args, _ = cli(f"prep binmap --pooling max {mask_file}")
+        self.assertEqual(64, args)
+
+    def test_transform_stl_many(self):
+        """Test transforming several STL files in a process pool"""
+        from ..core.prep import transform
+        data = numpy.zeros(20, dtype=Mesh.dtype)
+        data['vectors'] = numpy.random.rand(20, 3, 3)
+        mesh = Mesh(data.copy(), remove_empty_areas=False)
+        transform_matrix = numpy.array([
+            [2, 0, 0, 1],
+            [0, 3, 0, 2],
+            [0, 0, 4, 3],
+            [0, 0, 0, 1],
+        ], dtype=numpy.float64)
+        # homogeneous coordinates
+        vertices = numpy.c_[mesh.vectors.reshape(-1, 3), numpy.ones(60)]
+        expected = numpy.dot(vertices, transform_matrix.T)[:, :3].reshape(20, 3, 3)
+        self.assertTrue(numpy.allclose(expected, transform_stl_mesh(mesh, transform_matrix).vectors))
+        self.assertTrue(numpy.allclose(data['vectors'], mesh.vectors))  # untouched
+        transform_stl_mesh(mesh, transform_matrix, in_place=True)
+        self.assertTrue(numpy.allclose(expected, mesh.vectors))
+        # many files
+        stl_files = [TEST_DATA_PATH / f'test_transform_{i}.stl' for i in range(3)]
+        for stl_file in stl_files:
+            Mesh(data.copy(), remove_empty_areas=False).save(stl_file)
+        args, configs = cli(f"prep transform --lengths 2 3 4 --indices 1 1 1 --origin 1 2 3 -j 2 "
+                            f"{' '.join(map(str, stl_files))}")
+        self.assertEqual(0, transform(args, configs))
+        for stl_file, output in zip(stl_files, args.output):
+            self.assertTrue(numpy.allclose(expected, Mesh.from_file(output).vectors, atol=1e-5))
+            os.remove(stl_file)
+            os.remove(output)
+
+    def test_transform_map(self):
+        """Test resampling a mask by slabs"""
+        from scipy import ndimage
+        from ..core.prep import transform
+        data = (ndimage.gaussian_filter(numpy.random.rand(20, 24, 28), 2) > 0.5).astype(numpy.int8)
+        mask_file = TEST_DATA_PATH / 'test_transform.mrc'
+        with mrcfile.new(mask_file, data, overwrite=True) as mrc:
+            mrc.voxel_size = 1.5
+        # scale (x, y, z) by (2, 1.5, 0.5) then translate
+        args, configs = cli(f"prep transform --lengths 2 3 1 --indices 1 2 2 --origin 1.3 -2 4 {mask_file}")
+        # array axes are (z, y, x)
+        matrix = numpy.linalg.inv(numpy.diag([0.5, 1.5, 2.0]))
+        offset = -numpy.dot(matrix, [4, -2, 1.3])
+        # one slab; many overlapping slabs in one and in two worker processes
+        for slab_bytes, jobs in ((10 ** 9, None), (3 * 56, 1), (3 * 56, 2)):
+            with self.subTest(slab_bytes=slab_bytes, jobs=jobs):
+                args.overwrite = True
+                args.jobs = jobs
+                with mock.patch('sfftk.core.prep.SLAB_BYTES', slab_bytes):
+                    self.assertEqual(0, transform(args, configs))
+                with mrcfile.open(args.output) as mrc:
+                    self.assertEqual((14, 33, 56), mrc.data.shape)
+                    expected = ndimage.affine_transform(data, matrix, offset=offset, output_shape=(14, 33, 56), order=0)
+                    self.assertTrue(numpy.array_equal(expected, mrc.data))
+                    self.assertTrue(numpy.allclose(1.5, mrc.voxel_size.tolist()))
+                    self.assertEqual(1, mrc.header.dmax)
+        # no overwriting without --overwrite
+        args.overwrite = False
+        self.assertEqual(65, transform(args, configs))
+        os.remove(mask_file)
+        os.remove(args.output)
+
     def test_transform_stl_default(self):
         """Test transform stl"""
         # the original STL file
@@ -2262,21 +2603,84 @@ class TestPrepMergeMask(unittest.TestCase):
         args, configs = cli(f"prep mergemask --verbose {' '.join(unmergeable_masks)}")
         self.assertTrue(_masks_all_binary(args, configs))
 
+    def test_masks_all_binary_sampling(self):
+        """Test that the sampled and full binary assessments report non-binary masks with reasons"""
+        from ..core.prep import _masks_all_binary, mergemask
+        import tempfile
+        mergeable_masks = [
+            str(TEST_DATA_PATH / 'segmentations' / f'mergeable_{_}.map') for _ in range(1, 3)
+        ]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # every section has three voxel values
+            noisy_mask = os.path.join(tmpdir, 'noisy.map')
+            data = numpy.zeros((10, 10, 10), dtype=numpy.int8)
+            data[:, 0, 0] = 1
+            data[:, 0, 1] = 2
+            with mrcfile.new(noisy_mask) as mrc:
+                mrc.set_data(data)
+            # only one section has a stray value
+            stray_mask = os.path.join(tmpdir, 'stray.map')
+            data[:, 0, 1] = 0
+            data[7, 5, 5] = 3
+            with mrcfile.new(stray_mask) as mrc:
+                mrc.set_data(data)
+            args, configs = cli(f"prep mergemask --sample-sections 1 {' '.join(mergeable_masks)} {noisy_mask}")
+            with mock.patch('sfftk.core.prep.print_date') as print_date:
+                self.assertFalse(_masks_all_binary(args, configs))
+            self.assertEqual(1, print_date.call_count)
+            self.assertRegex(print_date.call_args[0][0], r"non-binary mask .*noisy\.map: more than two voxel values")
+            # the stray value is only guaranteed to be found by reading every section
+            args, configs = cli(f"prep mergemask --sample-sections 10 {' '.join(mergeable_masks)} {stray_mask}")
+            self.assertFalse(_masks_all_binary(args, configs))
+            args, configs = cli(
+                f"prep mergemask --sample-sections 1 --full-assessment {' '.join(mergeable_masks)} {stray_mask}"
+            )
+            self.assertTrue(args.full_assessment)
+            self.assertFalse(_masks_all_binary(args, configs))
+            # when merging the full assessment runs before any mask is merged
+            with mock.patch('sfftk.core.prep._masks_all_binary', side_effect=_masks_all_binary) as masks_all_binary:
+                with mock.patch('sfftk.core.prep.print_date') as print_date:
+                    self.assertEqual(65, mergemask(args, configs))
+            masks_all_binary.assert_called_once_with(args, configs)
+            self.assertRegex(print_date.call_args_list[0][0][0], r"non-binary mask .*stray\.map")
+            self.assertEqual("error: one or more masks are non-binary", print_date.call_args[0][0])
+        # invalid sample size
+        args, _ = cli(f"prep mergemask --sample-sections 0 {' '.join(mergeable_masks)}")
+        self.assertEqual(64, args)
+
     def test_masks_overlap(self):
         """Test that we can detect overlapping masks"""
-        from ..core.prep import _masks_no_overlap
+        from ..core.prep import _masks_no_overlap, _mask_overlaps
         # positive case
         mergeable_masks = [
             str(TEST_DATA_PATH / 'segmentations' / f'mergeable_{_}.map') for _ in range(1, 4)
         ]
         args, configs = cli(f"prep mergemask --verbose {' '.join(mergeable_masks)}")
-        self.assertTrue(_masks_no_overlap(args, configs))
+        self.assertTrue(_masks_no_overlap(args))
         # negative case
         unmergeable_masks = [
             str(TEST_DATA_PATH / 'segmentations' / f'unmergeable_{_}.map') for _ in range(1, 4)
         ]
         args, configs = cli(f"prep mergemask --verbose {' '.join(unmergeable_masks)}")
-        self.assertFalse(_masks_no_overlap(args, configs))
+        with mock.patch('sfftk.core.prep.print_date') as print_date:
+            self.assertFalse(_masks_no_overlap(args))
+        # every overlapping pair is reported
+        overlaps = _mask_overlaps(args)
+        self.assertEqual(len(overlaps), print_date.call_count)
+        # each mask's shared voxels are counted once against the first mask to occupy them
+        occupied = None
+        for index, mask in enumerate(unmergeable_masks):
+            with mrcfile.open(mask) as mrc:
+                voxels = mrc.data != 0
+            if occupied is None:
+                occupied = voxels
+                continue
+            self.assertEqual(
+                int(numpy.sum(occupied & voxels)),
+                sum(count for (_, _index), count in overlaps.items() if _index == index)
+            )
+            occupied = occupied | voxels
+        self.assertEqual(72, overlaps[(0, 1)])
 
     def test_mergemask(self):
         """Test that we can merge masks"""
@@ -2285,8 +2689,8 @@ class TestPrepMergeMask(unittest.TestCase):
             str(TEST_DATA_PATH / 'segmentations' / f'mergeable_{_}.map') for _ in range(1, 4)
         ]
         args, configs = cli(f"prep mergemask --verbose {' '.join(mergeable_masks)}")
-        from ..core.prep import _mergemask
-        merged_mask = _mergemask(args.masks)
+        from ..core.prep import _mergemask_single_pass
+        merged_mask = _mergemask_single_pass(args)
         # after the merge we expect the following to be true
         # max voxel value is equal to the cardinality of the masks
         self.assertEqual(
@@ -2308,6 +2712,189 @@ class TestPrepMergeMask(unittest.TestCase):
         # no change in shape
         self.assertEqual((10, 10, 10), merged_mask.shape)  # I know this!
 
+    @staticmethod
+    def _merge_in_memory(masks):
+        """The expected merged mask from merging the masks whole and in order"""
+        from ..core.prep import MergedMask
+        merged_mask = MergedMask()
+        for mask in masks:
+            with mrcfile.open(mask) as mrc:
+                merged_mask.merge(numpy.array(mrc.data), mask_name=os.path.basename(mask))
+        return merged_mask
+
+    def test_mergemask_single_pass(self):
+        """Test that the checks and the merge happen while reading each mask once"""
+        from ..core.prep import _mergemask_single_pass
+        from ..readers.mapreader import Map
+        mergeable_masks = [
+            str(TEST_DATA_PATH / 'segmentations' / f'mergeable_{_}.map') for _ in range(1, 4)
+        ]
+        args, configs = cli(f"prep mergemask {' '.join(mergeable_masks)}")
+        with mock.patch.object(Map, 'read', autospec=True, side_effect=Map.read) as read:
+            merged_mask = _mergemask_single_pass(args)
+        self.assertEqual(len(mergeable_masks), read.call_count)
+        self.assertEqual(self._merge_in_memory(args.masks), merged_mask)
+        self.assertEqual({'1': 0, '2': 0, '3': 0}, merged_mask.label_tree)
+        # overlap: the offending pair is named
+        unmergeable_masks = [
+            str(TEST_DATA_PATH / 'segmentations' / f'unmergeable_{_}.map') for _ in range(1, 4)
+        ]
+        args, configs = cli(f"prep mergemask {' '.join(unmergeable_masks)}")
+        with mock.patch('sfftk.core.prep.print_date') as print_date:
+            self.assertIsNone(_mergemask_single_pass(args))
+        self.assertRegex(
+            print_date.call_args_list[0][0][0], r"overlap between mask .*unmergeable_2\.map and .*unmergeable_1\.map"
+        )
+        args, configs = cli(f"prep mergemask --allow-overlap {' '.join(unmergeable_masks)}")
+        self.assertEqual(self._merge_in_memory(args.masks), _mergemask_single_pass(args))
+        # non-binary: stop at the offending mask
+        args, configs = cli(f"prep mergemask {' '.join(mergeable_masks)}")
+        args.masks[1] = str(TEST_DATA_PATH / 'segmentations' / 'merged_mask.mrc')  # mode 1 so not via the parser
+        with mock.patch('sfftk.core.prep.print_date') as print_date:
+            self.assertIsNone(_mergemask_single_pass(args))
+        self.assertRegex(print_date.call_args[0][0], r"non-binary mask .*merged_mask\.mrc")
+
+    def test_mergemask_parallel(self):
+        """Test that merging slabs on several processes gives the same result as merging serially"""
+        from ..core.prep import _mergemask_parallel
+        unmergeable_masks = [
+            str(TEST_DATA_PATH / 'segmentations' / f'unmergeable_{_}.map') for _ in range(1, 4)
+        ]
+        args, configs = cli(f"prep mergemask --jobs 2 --allow-overlap {' '.join(unmergeable_masks)}")
+        self.assertEqual(2, args.jobs)
+        args.slab_size = 2 ** -11  # a few sections per slab
+        merged_mask = _mergemask_parallel(args)
+        serial_merged_mask = self._merge_in_memory(args.masks)
+        self.assertEqual(serial_merged_mask, merged_mask)
+        self.assertEqual(serial_merged_mask.label_tree, merged_mask.label_tree)
+        self.assertEqual(serial_merged_mask.mask_to_label, merged_mask.mask_to_label)
+        # each slab of each mask is read once (threads so that the reads can be counted)
+        from ..readers.mapreader import Map
+        with mock.patch('sfftk.core.prep.concurrent.futures.ProcessPoolExecutor',
+                        concurrent.futures.ThreadPoolExecutor):
+            with mock.patch.object(Map, 'read_region', autospec=True, side_effect=Map.read_region) as read_region:
+                self.assertEqual(serial_merged_mask, _mergemask_parallel(args))
+        slab_count = len({call[0][1].start for call in read_region.call_args_list})
+        self.assertGreater(slab_count, 1)
+        self.assertEqual(len(unmergeable_masks) * slab_count, read_region.call_count)
+        # overlap: the same pair is named as when merging serially
+        args.allow_overlap = False
+        with mock.patch('sfftk.core.prep.print_date') as print_date:
+            self.assertIsNone(_mergemask_parallel(args))
+        self.assertRegex(
+            print_date.call_args_list[0][0][0], r"overlap between mask .*unmergeable_2\.map and .*unmergeable_1\.map"
+        )
+        # reconciled labels can only be adopted if they are of the same type
+        with self.assertRaises(ValueError):
+            merged_mask.adopt_data(merged_mask.data.astype(numpy.int32))
+        # invalid number of jobs
+        args, configs = cli(f"prep mergemask --jobs 0 {' '.join(unmergeable_masks)}")
+        self.assertEqual(64, args)
+
+    def test_mergemask_bit_planes(self):
+        """Test merging masks as bit-planes"""
+        import tempfile
+        from ..core.prep import BitPlaneMergedMask, mergemask
+        masks = numpy.array([
+            [0, 1, 0, 0],
+            [0, 1, 0, 0],
+            [0, 0, 1, 0],
+            [0, 1, 1, 1],
+            [1, 0, 0, 0],
+            [1, 0, 1, 0],
+        ])
+        merged_mask = BitPlaneMergedMask(shape=(4,), mask_count=len(masks))
+        for mask in masks:
+            merged_mask.merge(mask)
+        # every distinct membership has its own label
+        self.assertEqual(4, len(numpy.unique(merged_mask.data)))
+        self.assertEqual(4, merged_mask.data[3])  # only mask 4
+        for voxel in range(4):
+            parents = merged_mask.label_tree[str(merged_mask.data[voxel])]
+            expected_parents = (numpy.flatnonzero(masks[:, voxel]) + 1).tolist()
+            if parents == 0:
+                self.assertEqual([merged_mask.data[voxel]], expected_parents)
+            else:
+                self.assertEqual(expected_parents, parents)
+        self.assertEqual(numpy.dtype(numpy.int16), merged_mask.dtype)
+        with self.assertRaises(ValueError):
+            merged_mask.merge(masks[0])
+        # more than 64 masks need more than one word per voxel
+        merged_mask = BitPlaneMergedMask(shape=(2, 2), mask_count=70)
+        for index in range(70):
+            merged_mask.merge(numpy.array([[1, 0], [0, index % 2]]))
+        self.assertEqual(0, merged_mask.data[0, 1])
+        self.assertEqual(list(range(1, 71)), merged_mask.label_tree[str(merged_mask.data[0, 0])])
+        self.assertEqual(list(range(2, 71, 2)), merged_mask.label_tree[str(merged_mask.data[1, 1])])
+        # from the command line
+        unmergeable_masks = [
+            str(TEST_DATA_PATH / 'segmentations' / f'unmergeable_{_}.map') for _ in range(1, 4)
+        ]
+        args, configs = cli(f"prep mergemask --bit-planes {' '.join(unmergeable_masks)}")
+        with mock.patch('sfftk.core.prep.print_date') as print_date:
+            self.assertEqual(65, mergemask(args, configs))
+        self.assertRegex(
+            print_date.call_args_list[0][0][0], r"overlap between mask .*unmergeable_2\.map and .*unmergeable_1\.map"
+        )
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output_prefix = os.path.join(tmpdir, 'merged_mask')
+            args, configs = cli(
+                f"prep mergemask --bit-planes --allow-overlap --out-of-core --output-prefix {output_prefix} "
+                f"{' '.join(unmergeable_masks)}"
+            )
+            self.assertEqual(0, mergemask(args, configs))
+            with open(f"{output_prefix}.json") as f:
+                metadata = json.load(f)
+            self.assertEqual({'unmergeable_1.map': 1, 'unmergeable_2.map': 2, 'unmergeable_3.map': 3},
+                             metadata['mask_to_label'])
+            with mrcfile.open(f"{output_prefix}.mrc") as mrc:
+                for label, parents in metadata['label_tree'].items():
+                    if parents != 0:
+                        self.assertTrue(numpy.any(mrc.data == int(label)))
+        args, configs = cli(f"prep mergemask --bit-planes --jobs 2 {' '.join(unmergeable_masks)}")
+        self.assertEqual(64, args)
+
+    def test_splitmask(self):
+        """Test that we recover the binary masks from a merged mask"""
+        import tempfile
+        from ..core.prep import mergemask, splitmask
+        unmergeable_masks = [
+            str(TEST_DATA_PATH / 'segmentations' / f'unmergeable_{_}.map') for _ in range(1, 4)
+        ]
+        for bit_planes in ('', '--bit-planes'):
+            args, configs = cli(f"prep mergemask --allow-overlap --overwrite {bit_planes} {' '.join(unmergeable_masks)}")
+            self.assertEqual(0, mergemask(args, configs))
+            with tempfile.TemporaryDirectory() as tmpdir:
+                args, configs = cli(f"prep splitmask merged_mask.mrc -d {tmpdir} --slab-size 1 --jobs 2")
+                self.assertEqual("merged_mask.json", args.label_tree)
+                self.assertEqual(0, splitmask(args, configs))
+                for mask in unmergeable_masks:
+                    with mrcfile.open(mask) as original, \
+                            mrcfile.open(os.path.join(tmpdir, os.path.basename(mask))) as split:
+                        self.assertEqual(0, split.header.mode)
+                        self.assertTrue(numpy.array_equal(original.data, split.data))
+                # no overwriting by default
+                with mock.patch('sfftk.core.prep.print_date'):
+                    self.assertEqual(64, splitmask(args, configs))
+                # by default the number of threads is bounded by the CPUs and the available memory
+                args.jobs, args.overwrite = None, True
+                with mock.patch('sfftk.core.prep.pool_size', return_value=1) as pool_size:
+                    self.assertEqual(0, splitmask(args, configs))
+                pool_size.assert_called_once()
+                self.assertEqual(len(unmergeable_masks), pool_size.call_args[0][0])
+            os.remove("merged_mask.json")
+        # a label tree without labels e.g. from a mask with no components
+        with tempfile.TemporaryDirectory() as tmpdir:
+            label_tree = os.path.join(tmpdir, 'empty.json')
+            with open(label_tree, 'w') as f:
+                json.dump({'mask_to_label': {}, 'label_tree': {}}, f)
+            args, configs = cli(f"prep splitmask merged_mask.mrc --label-tree {label_tree} -d {tmpdir}")
+            with mock.patch('sfftk.core.prep.print_date') as print_date:
+                self.assertEqual(65, splitmask(args, configs))
+            self.assertRegex(print_date.call_args[0][0], r"^error: the label tree .*empty\.json' has no labels")
+        args, configs = cli("prep splitmask merged_mask.mrc --label-tree missing.json")
+        self.assertEqual(65, args)
+
     def test_mergemask_overlapping_masks(self):
         """Test merging with overlapping masks"""
         # we have N overlapping binary masks in mode 0
@@ -2324,6 +2911,65 @@ class TestPrepMergeMask(unittest.TestCase):
         merge_status = mergemask(args, configs)
         self.assertEqual(0, merge_status)
 
+    def test_mergemask_reports_all_overlaps(self):
+        """Test that every overlapping pair of masks is reported when the merge fails on overlap"""
+        from ..core.prep import mergemask, _mask_overlaps
+        unmergeable_masks = [
+            str(TEST_DATA_PATH / 'segmentations' / f'unmergeable_{_}.map') for _ in range(1, 4)
+        ]
+        for options in ('', '--jobs 2', '--bit-planes'):
+            args, configs = cli(f"prep mergemask {options} {' '.join(unmergeable_masks)}")
+            with mock.patch('sfftk.core.prep.print_date') as print_date:
+                self.assertEqual(65, mergemask(args, configs))
+            output = '\n'.join(call[0][0] for call in print_date.call_args_list)
+            overlaps = _mask_overlaps(args)
+            self.assertEqual(3, len(overlaps))
+            for (previous_index, index), count in overlaps.items():
+                self.assertIn(
+                    f"segment overlap between mask {unmergeable_masks[index]} and "
+                    f"{unmergeable_masks[previous_index]} ({count} voxels)",
+                    output
+                )
+
+    def test_mergemask_out_of_core(self):
+        """Test that merging into a memory-mapped output gives the same result as merging in memory"""
+        from ..core.prep import mergemask
+        unmergeable_masks = [
+            str(TEST_DATA_PATH / 'segmentations' / f'unmergeable_{_}.map') for _ in range(1, 4)
+        ]
+        args, configs = cli(f"prep mergemask --allow-overlap {' '.join(unmergeable_masks)}")
+        self.assertFalse(args.out_of_core)
+        self.assertEqual(128, args.slab_size)
+        self.assertEqual(0, mergemask(args, configs))
+        with open("merged_mask.json") as f:
+            in_memory_metadata = json.load(f)
+        with mrcfile.open("merged_mask.mrc") as mrc:
+            in_memory_data = mrc.data.copy()
+            in_memory_header = mrc.header.copy()
+        args, configs = cli(
+            f"prep mergemask --allow-overlap --out-of-core --overwrite {' '.join(unmergeable_masks)}"
+        )
+        args.slab_size = 3 * 10 * 10 * 2 / 2 ** 20  # three sections of the merged mask per slab
+        self.assertEqual(0, mergemask(args, configs))
+        with open("merged_mask.json") as f:
+            self.assertEqual(in_memory_metadata, json.load(f))
+        with mrcfile.open("merged_mask.mrc") as mrc:
+            self.assertTrue(numpy.array_equal(in_memory_data, mrc.data))
+            self.assertEqual(numpy.dtype(numpy.int16), mrc.data.dtype)
+            for field in ['dmin', 'dmax', 'dmean', 'rms']:
+                self.assertAlmostEqual(float(in_memory_header[field]), float(mrc.header[field]), places=5)
+            self.assertEqual(in_memory_header.cella.tolist(), mrc.header.cella.tolist())
+        # a failed merge leaves no output
+        os.remove("merged_mask.mrc")
+        os.remove("merged_mask.json")
+        args, configs = cli(f"prep mergemask --out-of-core {' '.join(unmergeable_masks)}")
+        with mock.patch('sfftk.core.prep.print_date'):
+            self.assertEqual(65, mergemask(args, configs))
+        self.assertFalse(os.path.exists("merged_mask.mrc"))
+        # invalid slab size
+        args, configs = cli(f"prep mergemask --slab-size 0 {' '.join(unmergeable_masks)}")
+        self.assertEqual(64, args)
+
     def test_merged_mask_class(self):
         """Test that if masks overlap we can construct the implied label tree."""
         from ..core.prep import MergedMask
@@ -2375,6 +3021,32 @@ class TestPrepMergeMask(unittest.TestCase):
         self.assertEqual({1, 2, 3, 4, 5, 6}, merged_mask.label_set)
         self.assertEqual({'1': 0, '2': 0, '3': [1, 2], '4': 0, '5': [1, 4], '6': [2, 4]}, merged_mask.label_tree)
 
+    def test_merged_mask_incremental_labels(self):
+        """Test that tracking labels from the touched voxels only gives the same label tree as a full scan"""
+        from ..core.prep import MergedMask
+        rng = numpy.random.default_rng(1)
+        masks = [(rng.random((6, 7, 8)) > 0.7).astype(numpy.int8) for _ in range(8)]
+        merged_mask = MergedMask()
+        # reference: rescan the whole merged volume after each mask
+        data = numpy.zeros((6, 7, 8), dtype=numpy.int16)
+        label_set, label_tree = set(), dict()
+        for mask in masks:
+            label = int(numpy.amax(data)) + 1
+            self.assertEqual(label, merged_mask.label)
+            merged_mask.merge(mask)
+            data += mask * label
+            label_set.add(label)
+            label_tree[str(label)] = 0
+            for new_label in set(numpy.unique(data).tolist()).difference(label_set.union([0])):
+                for _label in label_set:
+                    if new_label == _label + label:
+                        label_tree[str(new_label)] = sorted([_label, label])
+                label_set.add(new_label)
+        self.assertTrue(numpy.array_equal(data, merged_mask.data))
+        self.assertEqual(label_set, merged_mask.label_set)
+        self.assertEqual(label_tree, merged_mask.label_tree)
+        self.assertEqual(int(numpy.amax(data)) + 1, merged_mask.label)
+
     def _test_merge_with_overlap(self):
         """Development of the algorithm to merge with overlap"""
         mask_shape = (200,)
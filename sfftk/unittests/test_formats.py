@@ -5,8 +5,11 @@ import argparse
 import numbers
 import os
 import sys
+import tempfile
 from io import StringIO
+from unittest import mock
 
+import numpy
 import sfftkrw.schema.adapter_v0_8_0_dev1 as schema
 from sfftkrw.unittests import Py23FixTestCase
 
@@ -205,6 +208,20 @@ class TestFormats(Py23FixTestCase):
         self.assertIsInstance(self.merged_mask_segmentation.segments, list)
         self.assertIsInstance(self.merged_mask_segmentation.segments[0], map.MergedMaskSegment)
 
+    def test_mask_header_reads_no_voxels(self):
+        """Test that building headers and annotations does not read the voxels e.g. for statistics"""
+        mask_file = os.path.join(TEST_DATA_PATH, 'segmentations', 'test_data_multi0.map')
+        with mock.patch.object(mapreader.Map, 'iter_slabs') as iter_slabs:
+            map_obj = mapreader.get_data(mask_file, header_only=True)
+            mask_header = map.MaskHeader(map_obj)
+            map.MaskAnnotation(map_obj)
+            map.MapHeader(map.MapSegment(map_obj))
+            map.MapAnnotation(map_obj)
+        iter_slabs.assert_not_called()
+        self.assertIsNone(map_obj._statistics)
+        self.assertFalse(hasattr(mask_header, 'statistics'))
+        self.assertFalse(hasattr(mask_header, 'is_mask'))
+
     def test_mod_read(self):
         """Read an IMOD (.mod) segmentation"""
         self.read_mod()
@@ -435,6 +452,51 @@ class TestFormats(Py23FixTestCase):
         self.assertIsNotNone(segment.three_d_volume.lattice_id)
         self.assertGreaterEqual(segment.three_d_volume.value, 1)
 
+    def test_merged_mask_roi_convert(self):
+        """Convert only a region of interest of a merged mask"""
+        merged_mask_file = os.path.join(TEST_DATA_PATH, 'segmentations', 'merged_mask.mrc')
+        merged_mask_labels_file = os.path.join(TEST_DATA_PATH, 'segmentations', 'merged_mask.json')
+        args, configs = cli(f'convert {merged_mask_file} --label-tree {merged_mask_labels_file} --roi 2:10,:5,3:')
+        merged_mask_segmentation = map.MergedMaskSegmentation(
+            merged_mask_file, label_tree=merged_mask_labels_file, roi=args.roi
+        )
+        self.assertIsNone(merged_mask_segmentation.map_obj.voxels)  # only the region is read
+        seg = merged_mask_segmentation.convert()
+        lattice = seg.lattice_list[0]
+        self.assertEqual((7, 5, 8), (lattice.size.cols, lattice.size.rows, lattice.size.sections))
+        self.assertEqual((3, 0, 2), (lattice.start.cols, lattice.start.rows, lattice.start.sections))
+        full_mask = map.MergedMaskSegmentation(merged_mask_file, label_tree=merged_mask_labels_file).map_obj.voxels
+        self.assertTrue(numpy.array_equal(full_mask[2:10, :5, 3:], lattice.data_array))
+        self.assertEqual(len(seg.segment_list), 7)
+
+    def test_mask_components_convert(self):
+        """Convert each connected component of a binary mask into a segment"""
+        from scipy import ndimage
+        mask_file = os.path.join(TEST_DATA_PATH, 'segmentations', 'test_data_multi0.map')
+        args, configs = cli(f'convert {mask_file} --components')
+        self.assertTrue(args.components)
+        self.assertEqual(1, args.connectivity)
+        mask = mapreader.get_data(mask_file).voxels
+        # the mask is labelled in slabs of a few sections whose seams are merged
+        with mock.patch('sfftk.readers.mapreader.SLAB_BYTES', mask[0].nbytes * 3):
+            with mock.patch.object(
+                    mapreader.Map, 'label_components', autospec=True, side_effect=mapreader.Map.label_components
+            ) as label_components:
+                map_seg = map.BinaryMaskSegmentation(
+                    [mask_file], mmap=True, components=args.components, connectivity=args.connectivity
+                )
+        label_components.assert_called_once()
+        seg = map_seg.convert()
+        expected_labels, count = ndimage.label(mask != 0)
+        self.assertEqual(count, len(seg.segment_list))
+        self.assertEqual(1, len(seg.lattice_list))
+        self.assertTrue(numpy.array_equal(expected_labels, seg.lattice_list[0].data_array))
+        self.assertEqual(list(range(1, count + 1)), [segment.three_d_volume.value for segment in seg.segment_list])
+        self.assertEqual({0}, {segment.three_d_volume.lattice_id for segment in seg.segment_list})
+        # only for binary masks
+        args, configs = cli(f"convert {os.path.join(TEST_DATA_PATH, 'segmentations', 'test_data.seg')} --components")
+        self.assertEqual(64, args)
+
     def test_mask_nonbinary_fail(self):
         """Test that we can detect if a non-binary mask is assumed to be binary"""
         input_ = os.path.join(TEST_DATA_PATH, 'segmentations', 'merged_mask.mrc')
@@ -632,6 +694,47 @@ class TestFormats(Py23FixTestCase):
         vertex_ids = set(mesh.triangles.data_array.flatten().tolist())
         self.assertEqual(max(vertex_ids), mesh.vertices.num_vertices - 1)
 
+    def test_stl_mesh_convert(self):
+        """Convert STL mesh arrays straight to SFFVertices/SFFTriangles"""
+        vertices = numpy.random.rand(4, 3).astype(numpy.float32)
+        triangles = numpy.array([[0, 1, 2], [0, 2, 3]], dtype=numpy.uint32)
+        mesh = stl.STLMesh(vertices, triangles)
+        self.assertIs(vertices, mesh.vertices)  # no copy
+        self.assertIs(triangles, mesh.polygons)
+        sff_mesh = mesh.convert()
+        self.assertEqual(4, sff_mesh.vertices.num_vertices)
+        self.assertEqual(2, sff_mesh.triangles.num_triangles)
+        self.assertTrue(numpy.array_equal(vertices, sff_mesh.vertices.data_array))
+        self.assertTrue(numpy.array_equal(triangles, sff_mesh.triangles.data_array))
+        # a reference to a non-existent vertex
+        with self.assertRaises(ValueError):
+            stl.STLMesh(vertices, [[0, 1, 4]]).convert()
+
+    def test_stl_weld_convert(self):
+        """Convert an STL file welding near vertices"""
+        from stl import mesh
+        # two triangles meeting along an edge whose vertices differ by noise
+        data = numpy.zeros(2, dtype=mesh.Mesh.dtype)
+        data['vectors'] = [
+            [[0, 0, 0], [1, 0, 0], [1, 1, 0]],
+            [[1e-5, 0, 0], [1, 1, 1e-5], [0, 1, 0]],
+        ]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            stl_file = os.path.join(tmpdir, 'test_weld.stl')
+            mesh.Mesh(data, remove_empty_areas=False).save(stl_file)
+            seg = stl.STLSegmentation([stl_file]).convert()
+            self.assertEqual(6, seg.segment_list[0].mesh_list[0].vertices.num_vertices)
+            with mock.patch('sfftk.formats.stl.weld_vertices', side_effect=stl.weld_vertices) as weld_vertices:
+                stl_segmentation = stl.STLSegmentation([stl_file], weld_tolerance=1e-3)
+                seg = stl_segmentation.convert()
+                # the welded meshes are built once
+                segment = stl_segmentation.segments[0]
+                self.assertIs(segment.meshes, segment.meshes)
+            self.assertEqual(1, weld_vertices.call_count)
+        sff_mesh = seg.segment_list[0].mesh_list[0]
+        self.assertEqual(4, sff_mesh.vertices.num_vertices)
+        self.assertEqual(2, sff_mesh.triangles.num_triangles)
+
     def test_stl_multi_convert(self):
         """Convert several STL files into a single SFFSegmentation object"""
         self.read_stl_multi()
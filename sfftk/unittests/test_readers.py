@@ -6,8 +6,10 @@ This testing module should have no side-effects because it only reads.
 import glob
 import os
 import re
+import tempfile
 import unittest
 from math import cos, sin, radians
+from unittest import mock
 
 import ahds
 import numpy
@@ -91,6 +93,16 @@ class TestReadersIlastikReader(Py23FixTestCase):
         self.assertTrue(len(ilastik_obj.segment_ids) > 0)
         self.assertTrue(ilastik_obj.segment_count > 0)
 
+    def test_read_region(self):
+        """Test that we can read a hyperslab"""
+        ilastik_obj = ilastikreader.get_data(self.ilastik_file)
+        region = slice(1, 4), slice(2, 8), slice(None, 5)
+        self.assertTrue(numpy.array_equal(ilastik_obj.data[region], ilastik_obj.read_region(*region)))
+        ilastik_roi = ilastikreader.get_data(self.ilastik_file, roi=region)
+        self.assertTrue(numpy.array_equal(ilastik_obj.data[region], ilastik_roi.data))
+        self.assertEqual((1, 2, 0), ilastik_roi.start)
+        self.assertEqual((0, 0, 0), ilastik_obj.start)
+
 
 class TestReadersMapReader(Py23FixTestCase):
     def setUp(self):
@@ -156,6 +168,86 @@ class TestReadersMapReader(Py23FixTestCase):
         self.assertEqual(map_.skew_matrix_data, " ".join(map(repr, skew_matrix.flatten().tolist())))
         self.assertEqual(map_.skew_translation_data, " ".join(map(repr, skew_translation.flatten().tolist())))
 
+    def test_mmap(self):
+        """Test that we can memory-map the voxels instead of reading them"""
+        map_file = os.path.join(TEST_DATA_PATH, 'segmentations', 'test_data_multi0.map')
+        map_ = mapreader.get_data(map_file)
+        mmap_ = mapreader.get_data(map_file, mmap=True)
+        self.assertIsInstance(mmap_.voxels, numpy.memmap)
+        self.assertFalse(mmap_.voxels.flags.writeable)
+        self.assertEqual(1024, mmap_._data_offset)
+        self.assertEqual(map_.voxels.dtype, mmap_.voxels.dtype)
+        self.assertEqual((map_._ns, map_._nr, map_._nc), mmap_.voxels.shape)
+        self.assertTrue(numpy.array_equal(map_.voxels, mmap_.voxels))
+        self.assertTrue(numpy.array_equal(map_.statistics.values, mmap_.statistics.values))
+        self.assertEqual(map_.is_mask, mmap_.is_mask)
+
+    def test_iter_slabs(self):
+        """Test that we can iterate over slabs of sections without reading the whole volume"""
+        map_file = os.path.join(TEST_DATA_PATH, 'segmentations', 'test_data_multi0.map')
+        map_ = mapreader.get_data(map_file)
+        header_only_map = mapreader.get_data(map_file, header_only=True)
+        self.assertIsNone(header_only_map.voxels)
+        slabs = list(header_only_map.iter_slabs(5))
+        # 36 sections in slabs of 5 leaves a last slab of 1
+        self.assertEqual(8, len(slabs))
+        self.assertEqual((5, map_._nr, map_._nc), slabs[0].shape)
+        self.assertEqual((1, map_._nr, map_._nc), slabs[-1].shape)
+        self.assertTrue(numpy.array_equal(map_.voxels, numpy.concatenate(slabs)))
+        # slabs from loaded data are the same
+        self.assertTrue(numpy.array_equal(map_.voxels, numpy.concatenate(list(map_.iter_slabs(7)))))
+        # the default slab size holds this small volume in one slab
+        self.assertEqual(1, len(list(header_only_map.iter_slabs())))
+        with self.assertRaises(ValueError):
+            list(header_only_map.iter_slabs(0))
+        # is_mask works on header-only maps too
+        self.assertEqual(map_.is_mask, header_only_map.is_mask)
+        unfixable_mask = mapreader.Map(
+            os.path.join(TEST_DATA_PATH, 'segmentations', 'test_unfixable_mask.map'), header_only=True
+        )
+        self.assertFalse(unfixable_mask.is_mask)
+
+    def test_statistics(self):
+        """Test that voxel statistics are computed lazily in one pass for integer and float modes"""
+        for map_name in ['test_data_multi0.map', 'test_unfixable_mask.map', 'merged_mask.mrc']:
+            map_file = os.path.join(TEST_DATA_PATH, 'segmentations', map_name)
+            map_ = mapreader.get_data(map_file)
+            self.assertIsNone(map_._statistics)
+            header_only_map = mapreader.get_data(map_file, header_only=True)
+            with mock.patch('sfftk.readers.mapreader.SLAB_BYTES', map_._nr * map_._nc * map_._voxel_size * 3):
+                statistics = header_only_map.statistics
+            voxels = map_.voxels.astype(numpy.float64)
+            if map_.voxels.dtype.kind in 'iu':
+                self.assertTrue(statistics.values_complete)
+                self.assertTrue(numpy.array_equal(numpy.unique(map_.voxels), statistics.values))
+            else:
+                # only the smallest few distinct values of a float map are kept
+                self.assertFalse(statistics.values_complete)
+                self.assertTrue(numpy.array_equal(
+                    numpy.unique(map_.voxels)[:mapreader.MapStatistics.MAX_FLOAT_VALUES], statistics.values
+                ))
+            self.assertEqual(voxels.min(), statistics.min)
+            self.assertEqual(voxels.max(), statistics.max)
+            self.assertAlmostEqual(voxels.mean(), statistics.mean)
+            self.assertAlmostEqual(voxels.std(), statistics.rms)
+            self.assertEqual(numpy.count_nonzero(voxels), statistics.nonzero_count)
+            self.assertEqual(voxels.size, statistics.voxel_count)
+            # cached
+            self.assertIs(statistics, header_only_map.statistics)
+            self.assertEqual(map_.is_mask, header_only_map.is_mask)
+
+    def test_read_region(self):
+        """Test that we can read a sub-volume"""
+        map_file = os.path.join(TEST_DATA_PATH, 'segmentations', 'test_data_multi0.map')
+        map_ = mapreader.get_data(map_file)
+        header_only_map = mapreader.get_data(map_file, header_only=True)
+        region = slice(3, 12), slice(None, 10), slice(5, None)
+        self.assertTrue(numpy.array_equal(map_.voxels[region], header_only_map.read_region(*region)))
+        self.assertTrue(numpy.array_equal(map_.voxels[region], map_.read_region(*region)))
+        self.assertTrue(numpy.array_equal(map_.voxels, header_only_map.read_region()))
+        with self.assertRaises(ValueError):
+            header_only_map.read_region(slice(100, 200))
+
     def test_write(self):
         """Test write map file"""
         map_to_write = os.path.join(TEST_DATA_PATH, 'segmentations', 'test_write_map.map')
@@ -169,6 +261,31 @@ class TestReadersMapReader(Py23FixTestCase):
         for m in written_maps:
             os.remove(m)
 
+    def test_write_chunked(self):
+        """Test that writing streams the voxels slab by slab from memory, memory maps and header-only maps"""
+        map_file = os.path.join(TEST_DATA_PATH, 'segmentations', 'test_data_multi0.map')
+        map_to_write = os.path.join(TEST_DATA_PATH, 'segmentations', 'test_write_map.map')
+        with open(map_file, 'rb') as f:
+            original = f.read()
+        try:
+            for kwargs in [dict(), dict(mmap=True), dict(header_only=True)]:
+                map_ = mapreader.get_data(map_file, **kwargs)
+                with mock.patch('sfftk.readers.mapreader.SLAB_BYTES', map_._nr * map_._nc * map_._voxel_size * 5):
+                    with open(map_to_write, 'wb') as f:
+                        self.assertEqual(0, map_.write(f))
+                with open(map_to_write, 'rb') as f:
+                    self.assertEqual(original, f.read())
+            # inverted voxels are cast back to the type in the header
+            map_ = mapreader.get_data(map_file, inverted=True)
+            with open(map_to_write, 'wb') as f:
+                map_.write(f)
+            written_map = mapreader.get_data(map_to_write)
+            self.assertEqual(map_._mode, written_map._mode)
+            self.assertEqual(map_._nlabl + 1, written_map._nlabl)
+            self.assertTrue(numpy.array_equal(map_.voxels.astype(map_.dtype), written_map.voxels))
+        finally:
+            os.remove(map_to_write)
+
     def test_invert(self):
         """Test invert map intensities"""
         map_ = mapreader.get_data(self.map_file, inverted=False)
@@ -676,15 +793,13 @@ class TestReadersStlReader(Py23FixTestCase):
         """Test the main entry point: get_data(...)"""
         meshes = stlreader.get_data(self.stl_file)  # only one mesh here
         name, vertices, polygons = meshes[0]
-        num_vertices = len(vertices)
-        a, b, c = zip(*polygons.values())
-        vertex_ids = set(a + b + c)
         self.assertEqual(name, "{}#{}".format(os.path.basename(self.stl_file), 0))
-        self.assertGreaterEqual(num_vertices, 1)
-        self.assertEqual(min(vertex_ids), min(vertices.keys()))
-        self.assertEqual(max(vertex_ids), max(vertices.keys()))
-        self.assertEqual(sum(set(vertex_ids)), sum(vertices.keys()))
-        self.assertEqual(set(vertex_ids), set(vertices.keys()))
+        self.assertGreaterEqual(len(vertices), 1)
+        self.assertEqual(numpy.float32, vertices.dtype)
+        self.assertEqual(numpy.uint32, polygons.dtype)
+        self.assertEqual(3, polygons.shape[1])
+        # every vertex is used and no other
+        self.assertTrue(numpy.array_equal(numpy.unique(polygons), numpy.arange(len(vertices))))
 
     def test_read_binary(self):
         """Test that we can read a binary STL file"""
@@ -693,10 +808,7 @@ class TestReadersStlReader(Py23FixTestCase):
         self.assertEqual(name, "{}#{}".format(os.path.basename(self.stl_bin_file), 0))
         self.assertTrue(len(vertices) > 0)
         self.assertTrue(len(polygons) > 0)
-        polygon_ids = list()
-        for a, b, c in _dict_iter_values(polygons):
-            polygon_ids += [a, b, c]
-        self.assertCountEqual(set(vertices.keys()), set(polygon_ids))
+        self.assertTrue(numpy.array_equal(numpy.unique(polygons), numpy.arange(len(vertices))))
 
     def test_read_multiple(self):
         """Test that we can read a multi-solid STL file
@@ -707,10 +819,47 @@ class TestReadersStlReader(Py23FixTestCase):
             self.assertEqual(name, "{}#{}".format(os.path.basename(self.stl_multi_file), 0))
             self.assertTrue(len(vertices) > 0)
             self.assertTrue(len(polygons) > 0)
-            polygon_ids = list()
-            for a, b, c in _dict_iter_values(polygons):
-                polygon_ids += [a, b, c]
-            self.assertCountEqual(set(vertices.keys()), set(polygon_ids))
+            self.assertTrue(numpy.array_equal(numpy.unique(polygons), numpy.arange(len(vertices))))
+
+    def test_shared_vertices(self):
+        """Test that facets share vertices"""
+        from stl import mesh
+        # a square of two triangles sharing an edge
+        data = numpy.zeros(2, dtype=mesh.Mesh.dtype)
+        data['vectors'] = [
+            [[0, 0, 0], [1, 0, 0], [1, 1, 0]],
+            [[0, 0, 0], [1, 1, 0], [0, 1, 0]],
+        ]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            stl_file = os.path.join(tmpdir, 'test_shared_vertices.stl')
+            mesh.Mesh(data, remove_empty_areas=False).save(stl_file)
+            [(name, vertices, polygons)] = stlreader.get_data(stl_file)
+        self.assertEqual((4, 3), vertices.shape)
+        self.assertEqual((2, 3), polygons.shape)
+        # the triangles recover the facets
+        self.assertTrue(numpy.array_equal(data['vectors'], vertices[polygons]))
+        self.assertEqual(numpy.uint32, polygons.dtype)
+        self.assertTrue(vertices.flags.c_contiguous and polygons.flags.c_contiguous)
+
+    def test_binary_memmap(self):
+        """Test that binary files are memory-mapped and ASCII files are not"""
+        from stl import mesh, Mode
+        facets = stlreader._binary_facets(self.stl_bin_file)
+        self.assertIsInstance(facets, numpy.memmap)
+        stl_mesh = mesh.Mesh.from_file(self.stl_bin_file)
+        self.assertTrue(numpy.array_equal(stl_mesh.vectors, facets['vectors']))
+        # the streamed bounding box agrees with numpy-stl
+        with mock.patch('sfftk.readers.stlreader.FACETS_PER_CHUNK', 1000):
+            bounding_box = stlreader.compute_bounding_box(self.stl_bin_file)
+        self.assertEqual(list(zip(stl_mesh.min_, stl_mesh.max_)), bounding_box)
+        # ASCII files take the numpy-stl route
+        ascii_file = os.path.join(TEST_DATA_PATH, 'test_ascii.stl')
+        stl_mesh.save(ascii_file, mode=Mode.ASCII)
+        self.assertIsNone(stlreader._binary_facets(ascii_file))
+        [(_, vertices, polygons)] = stlreader.get_data(ascii_file)
+        [(_, bin_vertices, bin_polygons)] = stlreader.get_data(self.stl_bin_file)
+        self.assertTrue(numpy.allclose(bin_vertices[bin_polygons], vertices[polygons], atol=1e-4))
+        os.remove(ascii_file)
 
     def test_compute_bounding_box(self):
         """Test that we can compute the bounding box of an STL file"""